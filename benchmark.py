@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+'''
+Micro benchmarks for the CPU bound parts of kernlog that can run outside of
+the App Engine runtime.
+
+USAGE:
+
+python benchmark.py [corpus ...]
+
+Each corpus argument is either a file holding the markdown source of one
+entry or a directory of such files. Real entries can be pulled out of the
+datastore with the remote_api shell. When no corpus is given a small
+built-in sample is used.
+
+The template benchmarks need the App Engine SDK on sys.path and render every
+template with a sample context, once through webapp's template.render() and
+once through the rendering module.
+'''
+import datetime
+import os
+import sys
+import time
+
+import markdown
+import markdown_pool
+import xss
+
+from formatter import AbstractFormatter
+from htmlentitydefs import entitydefs
+from htmllib import HTMLParser
+from urlparse import urlparse
+from xml.sax.saxutils import quoteattr
+
+ENTRY_EXTENSIONS = ['tables', 'codehilite', 'tagdown', 'mathdown', 'summary']
+
+SAMPLE_CORPUS = [
+u'''Reading through the scheduler code today [#linux] [#sched]
+
+The interesting part is how `pick_next_task` walks the classes:
+
+    :::c
+    for_each_class(class) {
+        p = class->pick_next_task(rq);
+        if (p)
+            return p;
+    }
+
+| class | priority |
+|-------|----------|
+| rt    | high     |
+| fair  | normal   |
+''',
+u'''Short note: the load average is $\\sum_i n_i e^{-t/\\tau}$, not a plain mean.''',
+u'''# Notes on paging
+
+1. The first level table is indexed by the top bits.
+2. The second level holds the frame number.
+
+> Everything is a file, except when it is a page.
+
+See [the docs](http://www.kernel.org/doc/) for more. [#mm]
+''',
+]
+
+# HTML that markdown does not produce but an XSS cleaner has to get right.
+XSS_CORPUS = [
+'<p onclick="alert(1)">Hi <script>alert(document.cookie)</script></p>',
+'<a href="javascript:alert(1)">x</a> <a href="http://example.com/a?b=c" title="t&quot;">y</a>',
+'<a href="/relative">r</a><a href="ftp://ftp.kernel.org/pub">f</a><a href="http://localhost">l</a>',
+'<img src="http://example.com/i.png" alt="i"><img src="data:image/png;base64,AAAA"><br>',
+'<div class="x"><span class=y style="color:red">&amp; &nbsp; &bogus; &#65; &#x41; &#12345678;</span>',
+'<table><tr><td align="left">a<td align=right>b</table><ul><li>one<li>two</ul>',
+'<!-- comment --><b><i>unclosed <em>tags</b> a:b "quoted" <h1>',
+]
+
+# xss.XssCleaner before the output buffer and lookup tables were rewritten.
+# tests/test_xss.py checks that both produce the same output.
+class LegacyXssCleaner(HTMLParser):
+    def __init__(self, fmt = AbstractFormatter):
+        HTMLParser.__init__(self, fmt)
+        self.result = ""
+        self.open_tags = []
+        # A list of the only tags allowed.  Be careful adding to this.  Adding
+        # "script," for example, would not be smart.  'img' is out by default 
+        # because of the danger of IMG embedded commands, and/or web bugs.
+        self.permitted_tags = ['a', 'b', 'blockquote', 'br', 'i', 
+                          'li', 'ol', 'ul', 'p', 'cite', 'h1', 'h2', 
+                          'h3', 'h4', 'h5', 'h6', 'img', 'strong', 
+                          'div', 'span', 'pre', 'code', 'em', 'table', 'thead', 'tbody', 'tr', 'th', 'td']
+
+        # A list of tags that require no closing tag.
+        self.requires_no_close = ['img', 'br']
+
+        # A dictionary showing the only attributes allowed for particular tags.
+        # If a tag is not listed here, it is allowed no attributes.  Adding
+        # "on" tags, like "onhover," would not be smart.  Also be very careful
+        # of "background" and "style."
+        self.allowed_attributes = \
+            {'a':['href','title'],
+             'img':['src','alt'],
+             'blockquote':['type'],
+             'span': ['class'],
+             'th': ['align'],
+             'td': ['align'],
+             'div': ['class']}
+
+        # The only schemes allowed in URLs (for href and src attributes).
+        # Adding "javascript" or "vbscript" to this list would not be smart.
+        self.allowed_schemes = ['http','https','ftp']
+    def handle_data(self, data):
+        if data:
+            self.result += xss.xssescape(data)
+    def handle_charref(self, ref):
+        if len(ref) < 7 and ref.isdigit():
+            self.result += '&#%s;' % ref
+        else:
+            self.result += xss.xssescape('&#%s' % ref)
+    def handle_entityref(self, ref):
+        if ref in entitydefs:
+            self.result += '&%s;' % ref
+        else:
+            self.result += xss.xssescape('&%s' % ref)
+    def handle_comment(self, comment):
+        if comment:
+            self.result += xss.xssescape("<!--%s-->" % comment)
+
+    def handle_starttag(self, tag, method, attrs):
+        if tag not in self.permitted_tags:
+            self.result += xss.xssescape("<%s>" %  tag)
+        else:
+            bt = "<" + tag
+            if tag in self.allowed_attributes:
+                attrs = dict(attrs)
+                self.allowed_attributes_here = \
+                  [x for x in self.allowed_attributes[tag] if x in attrs \
+                   and len(attrs[x]) > 0]
+                for attribute in self.allowed_attributes_here:
+                    if attribute in ['href', 'src', 'background']:
+                        if self.url_is_acceptable(attrs[attribute]):
+                            bt += ' %s="%s"' % (attribute, attrs[attribute])
+                    else:
+                        bt += ' %s=%s' % \
+                           (xss.xssescape(attribute), quoteattr(attrs[attribute]))
+            #if bt == "<a" or bt == "<img":
+            #    return
+            if tag in self.requires_no_close:
+                bt += "/"
+            bt += ">"                     
+            self.result += bt
+            self.open_tags.insert(0, tag)
+            
+    def handle_endtag(self, tag, attrs):
+        bracketed = "</%s>" % tag
+        if tag not in self.permitted_tags:
+            self.result += xss.xssescape(bracketed)
+        elif tag in self.open_tags:
+            self.result += bracketed
+            self.open_tags.remove(tag)
+            
+    def unknown_starttag(self, tag, attributes):
+        self.handle_starttag(tag, None, attributes)
+    def unknown_endtag(self, tag):
+        self.handle_endtag(tag, None)
+    def url_is_acceptable(self,url):
+        ### Requires all URLs to be "absolute."
+        parsed = urlparse(url)
+        return (parsed[0] in self.allowed_schemes and '.' in parsed[1]) or (parsed[0] == '' and parsed[2][0] == '/')
+    def strip(self, rawstring):
+        """Returns the argument stripped of potentially harmful HTML or Javascript code"""
+        self.result = ""
+        self.feed(rawstring)
+        for endtag in self.open_tags:
+            if endtag not in self.requires_no_close:
+                self.result += "</%s>" % endtag
+        return self.result
+
+def load_corpus(paths):
+    corpus = []
+    for path in paths:
+        if os.path.isdir(path):
+            names = sorted(os.listdir(path))
+            corpus.extend(load_corpus([os.path.join(path, n) for n in names]))
+        else:
+            f = open(path)
+            try:
+                corpus.append(f.read().decode('utf-8'))
+            finally:
+                f.close()
+    return corpus
+
+def first_line(source):
+    for line in source.splitlines():
+        if len(line.strip()) > 0:
+            return line
+    return u''
+
+def run(name, func, corpus, rounds, unit='conversions'):
+    start = time.time()
+    for i in range(rounds):
+        for source in corpus:
+            func(source)
+    elapsed = time.time() - start
+    count = rounds * len(corpus)
+    print '%-40s %8d %s %10.1f %s/s' % (name, count, unit, count / elapsed, unit)
+
+def bench_markdown(corpus, rounds):
+    def before(source):
+        # Entry.setMarkdown before the converter pool and summary extension
+        markdown.markdown(source, ENTRY_EXTENSIONS[:-1])
+        markdown.markdown(first_line(source))
+    def after(source):
+        md = markdown_pool.acquire(ENTRY_EXTENSIONS)
+        try:
+            md.convert(source)
+            md.summary
+        finally:
+            markdown_pool.release(md)
+    run('markdown.markdown (new converter)', before, corpus, rounds)
+    run('markdown_pool (pooled, one pass)', after, corpus, rounds)
+
+class SampleProfile(object):
+    username = 'kern'
+    name = 'Kern Log'
+
+class SampleEntry(object):
+    def __init__(self, i):
+        self.key = 'entry%d' % i
+        self.html = '<p>Entry number %d.</p>' % i
+        self.summary = 'Entry number %d.' % i
+        self.markdown = 'Entry number %d.' % i
+        self.modified_at = datetime.datetime(2010, 5, 1, 12, i % 60)
+        self.user_profile = SampleProfile()
+        self.is_private = False
+
+def template_context(size=20):
+    entries = [SampleEntry(i) for i in range(size)]
+    return {'current_profile': SampleProfile(),
+            'person_profile': SampleProfile(),
+            'entries': entries,
+            'entry_fragments': ['<li>%s</li>' % e.html for e in entries],
+            'entry': entries[0],
+            'is_owner': True,
+            'edit_entry': entries[0],
+            'query': 'entry',
+            'tag': 'linux',
+            'next_link': '/kern?cursor=2',
+            'prev_link': '/kern?cursor=0'}
+
+def bench_templates(rounds):
+    try:
+        from google.appengine.ext.webapp import template
+        import rendering
+    except ImportError:
+        print 'templates: skipped, the App Engine SDK is not on sys.path'
+        return
+    context = template_context()
+    for name in sorted(os.listdir(rendering.TEMPLATE_DIR)):
+        path = rendering.path(name)
+        run('template.render %s' % name,
+            lambda c: template.render(path, c), [context], rounds, 'renders')
+        run('rendering.render %s' % name,
+            lambda c: rendering.render(name, c), [context], rounds, 'renders')
+
+def bench_xss(corpus, rounds):
+    md = markdown_pool.acquire(ENTRY_EXTENSIONS)
+    try:
+        documents = [md.convert(source) for source in corpus] + XSS_CORPUS
+    finally:
+        markdown_pool.release(md)
+    # One long entry, where appending to a string costs the most.
+    documents.append(''.join(documents) * 10)
+    different = len([d for d in documents
+                     if LegacyXssCleaner().strip(d) != xss.strip(d)])
+    print 'xss: %d of %d documents cleaned differently' % (different, len(documents))
+    run('XssCleaner (before rewrite)',
+        lambda d: LegacyXssCleaner().strip(d), documents, rounds, 'documents')
+    run('xss.strip', xss.strip, documents, rounds, 'documents')
+
+def main(argv):
+    corpus = load_corpus(argv[1:]) or SAMPLE_CORPUS
+    rounds = max(1, 300 // len(corpus))
+    bench_markdown(corpus, rounds)
+    bench_xss(corpus, rounds)
+    bench_templates(200)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,266 @@
+'''
+This module contains the caches shared by the request handlers.
+
+LRUCache is a bounded, in-process cache. Instances live as long as the
+runtime process, so they are shared by every request the process serves.
+
+Generation is a counter kept in memcache that writers bump to invalidate
+whatever was cached under an older value. DurableGeneration also keeps it in
+the datastore, for values cached in places memcache eviction can not reach.
+
+GenerationalCache puts an LRUCache in front of memcache and namespaces every
+key with a Generation. Bumping the generation makes
+every value cached so far unreachable, which is how writers invalidate
+results without having to know which keys were cached.
+
+Every cache created here is listed in `registry` so that its hit and miss
+counters can be reported by the stats page.
+'''
+import hashlib
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+namespace = 'kl'
+
+# Largest string worth sending to memcache, leaving room under its limit for
+# the key and whatever is stored along with the string.
+MAX_VALUE_BYTES = memcache.MAX_VALUE_SIZE - 16 * 1024
+
+registry = []
+
+def register(cache):
+    '''Adds cache to the registry of caches reported by the stats page. The
+    cache needs a `name` attribute and a stats() method returning a dict.'''
+    registry.append(cache)
+    return cache
+
+def fits_memcache(value):
+    '''Returns True if the string value is small enough to be cached in
+    memcache, whose set calls raise ValueError for larger values.'''
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return len(value) <= MAX_VALUE_BYTES
+
+class LRUCache(object):
+    '''
+    A bounded mapping that evicts the least recently used key once it holds
+    more than max_size keys. If ttl is non-zero, values older than ttl
+    seconds are treated as missing.
+    '''
+
+    def __init__(self, max_size, ttl=0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.clear()
+
+    def clear(self):
+        # Each link is [prev, next, key, value, expires], kept in a circular
+        # list from least (root[1]) to most (root[0]) recently used.
+        self._map = {}
+        self._root = root = []
+        root[:] = [root, root, None, None, None]
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _append(self, link):
+        root = self._root
+        last = root[0]
+        link[0] = last
+        link[1] = root
+        last[1] = link
+        root[0] = link
+
+    def get(self, key, default=None):
+        link = self._map.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        if link[4] and link[4] < time.time():
+            self._unlink(link)
+            del self._map[key]
+            self.misses += 1
+            return default
+        self._unlink(link)
+        self._append(link)
+        self.hits += 1
+        return link[3]
+
+    def set(self, key, value):
+        expires = self.ttl and time.time() + self.ttl
+        link = self._map.get(key)
+        if link is not None:
+            self._unlink(link)
+            link[3] = value
+            link[4] = expires
+        else:
+            link = [None, None, key, value, expires]
+            self._map[key] = link
+        self._append(link)
+        while len(self._map) > self.max_size:
+            oldest = self._root[1]
+            self._unlink(oldest)
+            del self._map[oldest[2]]
+            self.evictions += 1
+
+    def delete(self, key):
+        link = self._map.pop(key, None)
+        if link is not None:
+            self._unlink(link)
+
+    def stats(self):
+        return {'size': len(self._map), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+class Generation(object):
+    '''
+    A number kept in memcache under name that only ever grows. Readers tag
+    what they cache with the current generation and ignore anything tagged
+    with another one.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+
+    def _key(self):
+        return '%s_%s_generation' % (namespace, self.name)
+
+    def get(self):
+        '''Returns the current generation, starting a new one if memcache
+        has lost it.'''
+        generation = memcache.get(self._key())
+        if generation is None:
+            # Start from the clock so a restarted counter does not reuse a
+            # generation that values may still be cached under.
+            generation = int(time.time() * 1000)
+            if not memcache.add(self._key(), generation):
+                generation = memcache.get(self._key()) or generation
+        return generation
+
+    def bump(self):
+        '''Invalidates everything cached under the current generation.'''
+        if memcache.incr(self._key()) is None:
+            memcache.set(self._key(), int(time.time() * 1000))
+
+class StoredGeneration(db.Model):
+    "The value of a DurableGeneration. The key name is the generation's key."
+
+    value = db.IntegerProperty(indexed=False)
+
+class DurableGeneration(Generation):
+    '''
+    A Generation that is also stored in the datastore, so it keeps its
+    value when memcache evicts it. Use it for values cached in the
+    datastore, which would otherwise all be discarded after an eviction.
+    A memcache miss costs a datastore get and a bump a transaction.
+    '''
+
+    def get(self):
+        generation = memcache.get(self._key())
+        if generation is None:
+            entity = StoredGeneration.get_by_key_name(self._key())
+            if entity is None:
+                entity = StoredGeneration.get_or_insert(self._key(),
+                    value=int(time.time() * 1000))
+            generation = entity.value
+            memcache.add(self._key(), generation)
+        return generation
+
+    def bump(self):
+        def txn():
+            entity = StoredGeneration.get_by_key_name(self._key())
+            if entity is None:
+                entity = StoredGeneration(key_name=self._key(), value=0)
+            entity.value = max(entity.value + 1, int(time.time() * 1000))
+            entity.put()
+            return entity.value
+        memcache.set(self._key(), db.run_in_transaction(txn))
+
+def get_generations(generations):
+    '''Returns the current value of each Generation in generations, reading
+    them from memcache at once.'''
+    values = memcache.get_multi([g._key() for g in generations])
+    return [values.get(g._key()) or g.get() for g in generations]
+
+class GenerationalCache(object):
+    '''
+    A two tier (in-process LRU, then memcache) cache whose contents are
+    invalidated all at once by bump().
+
+    USAGE:
+
+    generation = cache.generation()
+    value = cache.get(key, generation)
+    if value is None:
+        value = compute()
+        cache.set(key, value, generation)
+
+    The generation is read before computing the value, so a value computed
+    while a writer bumps the generation is stored under the old one and is
+    never served.
+    '''
+
+    def __init__(self, name, local_size=100, time=0):
+        '''
+        @param name: prefix of the memcache keys, unique among caches
+        @param local_size: number of values kept in process
+        @param time: memcache expiry of the values, in seconds (0 = none)
+        '''
+        self.name = name
+        self.time = time
+        self._generation = Generation(name)
+        self.local = LRUCache(local_size)
+        self.local_hits = 0
+        self.memcache_hits = 0
+        self.misses = 0
+        register(self)
+
+    def _key(self, key, generation):
+        digest = hashlib.md5(repr(key)).hexdigest()
+        return '%s_%s_%d_%s' % (namespace, self.name, generation, digest)
+
+    def generation(self):
+        '''Returns the current generation, starting a new one if memcache
+        has lost it.'''
+        return self._generation.get()
+
+    def bump(self):
+        '''Invalidates every value cached so far.'''
+        self._generation.bump()
+
+    def get(self, key, generation):
+        '''Returns the value cached for key in generation, or None.'''
+        cache_key = self._key(key, generation)
+        value = self.local.get(cache_key)
+        if value is not None:
+            self.local_hits += 1
+            return value
+        value = memcache.get(cache_key)
+        if value is not None:
+            self.memcache_hits += 1
+            self.local.set(cache_key, value)
+            return value
+        self.misses += 1
+        return None
+
+    def set(self, key, value, generation):
+        cache_key = self._key(key, generation)
+        self.local.set(cache_key, value)
+        memcache.set(cache_key, value, self.time)
+
+    def stats(self):
+        return {'local_size': len(self.local), 'local_hits': self.local_hits,
+                'memcache_hits': self.memcache_hits, 'misses': self.misses}
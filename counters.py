@@ -0,0 +1,92 @@
+'''
+This module contains sharded counters.
+
+A counter is spread over NUM_SHARDS CounterShard entities so that
+concurrent increments rarely contend on the same entity group. Reading a
+counter is one memcache get, or one batch get by key of the shards when
+memcache has lost it.
+
+Counters have to be seeded before they are read, since they are usually
+introduced for data that already exists. get_count() returns None for a
+counter that has not been seeded; get_or_seed() seeds it from a function
+that counts the data the slow way.
+'''
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+NUM_SHARDS = 10
+
+# Seconds a count read from the shards is kept in memcache. An increment
+# between reading the shards and caching their sum is lost from the cached
+# value, so it has to expire on its own.
+CACHE_TIME = 60
+
+namespace = 'kl'
+
+class Counter(db.Model):
+    "Marks a counter as seeded. The key name is the name of the counter."
+
+    base = db.IntegerProperty(default=0)
+    "Value added to the sum of the shards."
+
+class CounterShard(db.Model):
+    "One shard of a counter. The key name is made by _shard_key_name()."
+
+    count = db.IntegerProperty(default=0)
+
+def _shard_key_name(name, index):
+    return '%s_%d' % (name, index)
+
+def _memcache_key(name):
+    return '%s_Counter_%s' % (namespace, name)
+
+def _keys(name):
+    return [db.Key.from_path('Counter', name)] +\
+        [db.Key.from_path('CounterShard', _shard_key_name(name, i))
+         for i in range(NUM_SHARDS)]
+
+def get_count(name):
+    '''Returns the value of the counter, or None if it was never seeded.'''
+    count = memcache.get(_memcache_key(name))
+    if count is None:
+        entities = db.get(_keys(name))
+        counter = entities[0]
+        if counter is None:
+            return None
+        count = counter.base + sum([s.count for s in entities[1:] if s])
+        memcache.add(_memcache_key(name), count, CACHE_TIME)
+    return count
+
+def increment(name, delta=1):
+    '''Adds delta to the counter. Counters that were not seeded yet are
+    incremented as well, their seed accounts for it.'''
+    key_name = _shard_key_name(name, random.randint(0, NUM_SHARDS - 1))
+    def increment_txn():
+        shard = CounterShard.get_by_key_name(key_name)
+        if shard is None:
+            shard = CounterShard(key_name=key_name)
+        shard.count += delta
+        shard.put()
+    db.run_in_transaction(increment_txn)
+    if delta >= 0:
+        memcache.incr(_memcache_key(name), delta)
+    else:
+        memcache.decr(_memcache_key(name), -delta)
+
+def seed(name, count):
+    '''Sets the value of the counter to count.'''
+    entities = db.get(_keys(name))
+    shard_total = sum([s.count for s in entities[1:] if s])
+    Counter(key_name=name, base=count - shard_total).put()
+    memcache.set(_memcache_key(name), count, CACHE_TIME)
+
+def get_or_seed(name, count_func):
+    '''Returns the value of the counter, seeding it with the result of
+    count_func() if it was never seeded.'''
+    count = get_count(name)
+    if count is None:
+        count = count_func()
+        seed(name, count)
+    return count
@@ -18,38 +18,123 @@
 
 import os
 import cgi
+import datetime
+import hashlib
 import logging
+import pickle
 import re
-import weakref
+import time
+import urllib
+import zlib
 
 import xss
+import caching
+import counters
 import taggable
 import markdown
+import markdown_pool
+import pagecache
 import paging
+import rendering
+import searchindex
+import timeline
 import BeautifulSoup
 
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import util
 from google.appengine.ext import db
 from google.appengine.api import users
-from google.appengine.ext.webapp import template
+from google.appengine.api import memcache
+from google.appengine.api import datastore
 from google.appengine.ext.db import djangoforms
 from google.appengine.api.labs import taskqueue
 
+def count_entries(name, query):
+    """Returns the value of the counter called name, seeding it the first
+    time by counting the results of query, a keys only query."""
+    def count_all():
+        count = 0
+        keys = query.fetch(1000)
+        while keys:
+            count += len(keys)
+            if len(keys) < 1000:
+                break
+            query.with_cursor(query.cursor())
+            keys = query.fetch(1000)
+        return count
+    return counters.get_or_seed(name, count_all)
+
 class CachedReferenceProperty(db.ReferenceProperty):
-    _cache = weakref.WeakValueDictionary({})
+    # Referenced instances are looked up in a per-property LRU, then in
+    # memcache, then in the datastore. time is the number of seconds an
+    # instance may be served from either cache (0 = until evicted).
+    _properties = []
     def __init__(self,
                  reference_class=None,
                  time=0,
                  verbose_name=None,
                  collection_name=None,
+                 max_cached=1000,
                  **attrs):
         super(CachedReferenceProperty, self).__init__(reference_class, verbose_name, collection_name, **attrs)
         self.time = time
+        self._cache = caching.LRUCache(max_cached, ttl=time)
+        self.memcache_hits = 0
+        self.datastore_gets = 0
+        CachedReferenceProperty._properties.append(self)
+        caching.register(self)
+    @classmethod
+    def memcache_prefix(self):
+        return '%s_CachedReferenceProperty_' % caching.namespace
+    @classmethod
+    def invalidate(self, reference_id):
+        """Drops the instance for reference_id from every cache. Only the
+        in-process caches of the current process can be reached, the others
+        expire after time seconds."""
+        for prop in CachedReferenceProperty._properties:
+            prop._cache.delete(reference_id)
+        memcache.delete(CachedReferenceProperty.memcache_prefix() + str(reference_id))
+    def stats(self):
+        return {'local_hits': self._cache.hits,
+                'local_size': len(self._cache),
+                'memcache_hits': self.memcache_hits,
+                'datastore_gets': self.datastore_gets}
     def __id_attr_name(self):
         return self._attr_name()
     def __resolved_attr_name(self):
         return "_RESOLVED"+self._attr_name()
+    def __resolve(self, reference_ids):
+        found = {}
+        missing = []
+        for reference_id in reference_ids:
+            instance = self._cache.get(reference_id)
+            if instance is not None:
+                found[reference_id] = instance
+            else:
+                missing.append(reference_id)
+        if missing:
+            prefix = CachedReferenceProperty.memcache_prefix()
+            cached = memcache.get_multi([str(k) for k in missing], key_prefix=prefix)
+            not_cached = []
+            for reference_id in missing:
+                instance = cached.get(str(reference_id))
+                if instance is not None:
+                    self.memcache_hits += 1
+                    found[reference_id] = instance
+                    self._cache.set(reference_id, instance)
+                else:
+                    not_cached.append(reference_id)
+            if not_cached:
+                self.datastore_gets += 1
+                loaded = {}
+                for reference_id, instance in zip(not_cached, db.get(not_cached)):
+                    if instance is not None:
+                        found[reference_id] = instance
+                        loaded[str(reference_id)] = instance
+                        self._cache.set(reference_id, instance)
+                if loaded:
+                    memcache.set_multi(loaded, self.time, key_prefix=prefix)
+        return found
     def __get__(self, model_instance, model_class):
         if model_instance is None:
             return self
@@ -62,19 +147,33 @@ class CachedReferenceProperty(db.ReferenceProperty):
             if resolved is not None:
                 return resolved
             else:
-                reference_str = str(reference_id)
-                instance = CachedReferenceProperty._cache.get(reference_id, None)
-                if instance is None:
-                    instance = db.get(reference_id)
-                    CachedReferenceProperty._cache[reference_id] = instance
-                #else:
-                #    logging.info("CachedReferenceProperty - found object in cache: "+str(reference_id))
+                instance = self.__resolve([reference_id]).get(reference_id)
             if instance is None:
                 raise Error('ReferenceProperty failed to be resolved')
             setattr(model_instance, self.__resolved_attr_name(), instance)
             return instance
         else:
             return None
+    def prefetch(self, model_instances):
+        unresolved = {}
+        for model_instance in model_instances:
+            reference_id = getattr(model_instance, self.__id_attr_name(), None)
+            if reference_id is None:
+                continue
+            if getattr(model_instance, self.__resolved_attr_name(), None) is not None:
+                continue
+            unresolved.setdefault(reference_id, []).append(model_instance)
+        if not unresolved:
+            return
+        for reference_id, instance in self.__resolve(unresolved.keys()).items():
+            for model_instance in unresolved[reference_id]:
+                setattr(model_instance, self.__resolved_attr_name(), instance)
+
+def prefetch_references(model_instances, name):
+    """Resolves the CachedReferenceProperty called name of every model
+    instance with a single batch get."""
+    if model_instances:
+        getattr(model_instances[0].__class__, name).prefetch(model_instances)
 
 class UserProfile(db.Model):
     username = db.StringProperty()
@@ -95,7 +194,41 @@ class UserProfile(db.Model):
         return UserProfile.profile_for_user(users.get_current_user())
 
 class EntryIndex(db.Model):
-    bigrams = db.StringListProperty()
+    # Version of the searchindex posting lists the bigrams were added to.
+    # Indexes written before the posting lists existed have version 0.
+    VERSION = 1
+    # Seconds during which posting list changes are gathered into one flush.
+    FLUSH_DELAY = 10
+    bigrams = db.StringListProperty(indexed=False)
+    version = db.IntegerProperty(default=0)
+    # Lower-cased plain text of the entry, used to verify phrase matches
+    # without parsing the entry html at query time.
+    text = db.TextProperty()
+    # md5 of the entry html the index was built from.
+    html_hash = db.StringProperty(indexed=False)
+    @classmethod
+    def key_for(self, entry_key):
+        return db.Key.from_path('EntryIndex', 'index', parent=entry_key)
+    @classmethod
+    def document_counter(self):
+        return 'EntryIndex.documents'
+    @classmethod
+    def document_count(self):
+        """Number of entries in the posting lists, the corpus size that
+        ranked search weighs bigrams against."""
+        q = EntryIndex.all(keys_only=True).filter('version >', 0)
+        return count_entries(EntryIndex.document_counter(), q)
+    def is_posted(self):
+        """Whether the bigrams of this index are in the posting lists. They
+        stay there when VERSION is bumped, until the index is rebuilt."""
+        return self.version > 0
+    @classmethod
+    def get_for(self, entry_key):
+        index = EntryIndex.get(EntryIndex.key_for(entry_key))
+        if index is None:
+            # Indexes used to be stored with automatic ids.
+            index = EntryIndex.all().ancestor(entry_key).get()
+        return index
     @classmethod
     def create_bigram_set(self, text):
         text = text.lower()
@@ -109,11 +242,123 @@ class EntryIndex(db.Model):
                 if len(bigrams) > 4999:
                     break
         return bigrams
+    @classmethod
+    def legacy_lookup(self, bigrams):
+        """Returns the keys of the entries whose index predates the posting
+        lists and contains every one of the bigrams. Those indexes still have
+        their bigrams indexed until they are rebuilt, so they are found with
+        the equality filters search used before."""
+        bigrams = sorted(bigrams)[:100]
+        if not bigrams:
+            return []
+        q = datastore.Query('EntryIndex', {'bigrams =': bigrams}, keys_only=True)
+        return [key.parent() for key in q.Get(1000)]
+    @classmethod
+    def queue_postings(self, entry_key, added=(), removed=()):
+        """Queues the posting list changes of the entry and schedules the
+        flush that applies them. Changes queued within the same FLUSH_DELAY
+        window are applied by one flush."""
+        if not (added or removed):
+            return
+        searchindex.queue_postings(entry_key.id(), added, removed)
+        window = int(time.time()) // EntryIndex.FLUSH_DELAY
+        try:
+            taskqueue.add(name='postings-%d' % window, url='/worker/postings',
+                          countdown=EntryIndex.FLUSH_DELAY)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+    @classmethod
+    def remove(self, entry_key):
+        index = EntryIndex.get_for(entry_key)
+        if index:
+            if index.is_posted():
+                EntryIndex.queue_postings(entry_key, removed=index.bigrams)
+                counters.increment(EntryIndex.document_counter(), -1)
+            index.delete()
+
+class ReindexJob(db.Model):
+    """Checkpoint of a bulk re-index, which walks every Entry by key in
+    slices run by the task queue. The key name is the name of the job."""
+    # Entries read per slice, and seconds a slice spends on posting lists.
+    BATCH_SIZE = 200
+    SLICE_TIME = 20
+    cursor = db.TextProperty()
+    # zlib compressed pickle of the posting changes not applied yet.
+    pending = db.BlobProperty()
+    # zlib compressed pickle of the EntryIndex writes not applied yet: the
+    # keys of the entries whose index is to be put, the keys of the indexes
+    # to delete and the number of entries new to the posting lists.
+    pending_writes = db.BlobProperty()
+    processed = db.IntegerProperty(default=0)
+    slices = db.IntegerProperty(default=0)
+    # Seconds spent in slices so far.
+    elapsed = db.FloatProperty(default=0.0)
+    started_at = db.DateTimeProperty(auto_now_add=True)
+    finished_at = db.DateTimeProperty()
+    def get_pending(self):
+        if not self.pending:
+            return {}
+        return pickle.loads(zlib.decompress(self.pending))
+    def set_pending(self, postings):
+        if postings:
+            self.pending = db.Blob(zlib.compress(pickle.dumps(postings, 2)))
+        else:
+            self.pending = None
+    def get_pending_writes(self):
+        if not self.pending_writes:
+            return [], [], 0
+        entry_keys, to_delete, new_documents = pickle.loads(zlib.decompress(self.pending_writes))
+        return ([db.Key(key) for key in entry_keys],
+                [db.Key(key) for key in to_delete], new_documents)
+    def set_pending_writes(self, entry_keys, to_delete, new_documents):
+        if entry_keys or to_delete:
+            writes = ([str(key) for key in entry_keys],
+                      [str(key) for key in to_delete], new_documents)
+            self.pending_writes = db.Blob(zlib.compress(pickle.dumps(writes, 2)))
+        else:
+            self.pending_writes = None
+    def rate(self):
+        """Entries processed per second."""
+        if not self.elapsed:
+            return 0.0
+        return self.processed / self.elapsed
+    def enqueue(self):
+        try:
+            taskqueue.add(name='%s-%d' % (self.key().name(), self.slices),
+                          url='/_admin/reindex/slice', params={'job': self.key().name()})
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+class TagBackfillJob(db.Model):
+    """Checkpoint of the backfill of the tag timeline, which first moves
+    the legacy Tag.tagged lists into TagMemberships and then copies the
+    tag_membership_fields() of every Entry into its memberships. Both walks
+    go by key in slices run by the task queue. The key name is the name of
+    the job."""
+    BATCH_SIZE = 100
+    # The kind being walked, 'Tag' and then 'Entry'.
+    walking = db.StringProperty(default='Tag')
+    cursor = db.TextProperty()
+    processed = db.IntegerProperty(default=0)
+    slices = db.IntegerProperty(default=0)
+    started_at = db.DateTimeProperty(auto_now_add=True)
+    finished_at = db.DateTimeProperty()
+    def enqueue(self):
+        try:
+            taskqueue.add(name='%s-%d' % (self.key().name(), self.slices),
+                          url='/_admin/backfill/tags/slice', params={'job': self.key().name()})
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
 
 class Entry(db.Model, taggable.Taggable):
-    user_profile = CachedReferenceProperty(UserProfile)
+    markdown_extensions = ['tables', 'codehilite', 'tagdown', 'mathdown', 'summary']
+    # Seconds during which saves of an entry are coalesced into one indexing.
+    INDEX_DELAY = 60
+    user_profile = CachedReferenceProperty(UserProfile, time=600)
     created_at = db.DateTimeProperty(auto_now_add=True)
-    modified_at = db.DateTimeProperty(auto_now=True)
+    # Set by put() rather than auto_now, which would leave the old time on
+    # the instance that the tag memberships and fragments are built from.
+    modified_at = db.DateTimeProperty()
     markdown = db.TextProperty()
     html = db.TextProperty()
     summary = db.StringProperty(default="")
@@ -121,29 +366,203 @@ class Entry(db.Model, taggable.Taggable):
     def __init__(self, parent=None, key_name=None, app=None, **entity_values):
         db.Model.__init__(self, parent, key_name, app, **entity_values)
         taggable.Taggable.__init__(self)
+    def put(self):
+        self.modified_at = datetime.datetime.now()
+        key = db.Model.put(self)
+        self.update_tag_memberships()
+        return key
+    def tag_membership_fields(self):
+        """Fields of the tag timeline, which lists the entries with a tag by
+        -modified_at, optionally for a single user."""
+        return {'user_profile': Entry.user_profile.get_value_for_datastore(self),
+                'is_private': self.is_private,
+                'modified_at': self.modified_at}
+    @classmethod
+    def tag_timeline(self, tag_name, user_key=None, include_private=False):
+        """Keys only query of the TagMemberships of the entries tagged with
+        tag_name, newest first. The entries are the parents of the keys."""
+        q = taggable.TagMembership.all(keys_only=True)
+        q.filter('tag =', taggable.Tag.key_for_name(tag_name))
+        if user_key:
+            q.filter('user_profile =', user_key)
+        if not include_private:
+            q.filter('is_private =', False)
+        q.order('-modified_at')
+        return q
+    @classmethod
+    def user_counter(self, user_key, is_private):
+        return 'Entry.user.%s.%s' % (user_key.id_or_name(), 'private' if is_private else 'public')
+    def page_paths(self):
+        """Paths of the cached pages that show this entry, for
+        pagecache.invalidate_paths()."""
+        paths = ['/%s' % self.user_profile.username, '/entry/%s' % self.key()]
+        if not self.is_private:
+            paths.append('/')
+            paths.extend(['/tag/%s' % tag.tag for tag in self.tags])
+        return paths
+    @classmethod
+    def cursor_generation(self, user_key):
+        """Bumped whenever an entry of the user is written, which discards
+        the persisted cursors of paged queries over their entries."""
+        return caching.DurableGeneration('cursors_%s' % user_key.id_or_name())
+    def counter_names(self):
+        """Names of the counters this entry is counted in."""
+        user_key = Entry.user_profile.get_value_for_datastore(self)
+        return [Entry.user_counter(user_key, self.is_private)]
+    def update_counters(self, old_names, new_names):
+        for name in set(old_names) - set(new_names):
+            counters.increment(name, -1)
+        for name in set(new_names) - set(old_names):
+            counters.increment(name)
     def setMarkdown(self, source):
         self.markdown = source
         tag_names = re.findall(r'\[#(\w+)\]', source)
         tag_names = map(lambda x: x.lower(), tag_names)
         self.tags = tag_names
-        cleaner = xss.XssCleaner()
-        html = markdown.markdown(self.markdown, ['tables', 'codehilite', 'tagdown', 'mathdown'])
-        self.html = cleaner.strip(html)
-        source_lines = source.splitlines()
-        for line in source_lines:
-            if len(line.strip()) > 0:
-                summary = re.compile(r'<.*?>').sub('', markdown.markdown(line))
-                if len(summary) > 255:
-                    summary = summary[:255]
-                self.summary = summary
-                break
-    def index(self):
+        md = markdown_pool.acquire(Entry.markdown_extensions)
+        try:
+            html = md.convert(self.markdown)
+            self.summary = md.summary
+        finally:
+            markdown_pool.release(md)
+        self.html = xss.strip(html)
+    @classmethod
+    def enqueue_index(self, key):
+        """Schedules indexing of the entry with the given key. Saves within
+        the same INDEX_DELAY window share one named task, which runs after
+        the window has ended and so indexes the last of them."""
+        window = int(time.time()) // Entry.INDEX_DELAY
+        try:
+            taskqueue.add(name='index-%s-%d' % (key, window),
+                          url='/worker/searchindex', params={'key': key},
+                          countdown=Entry.INDEX_DELAY)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+    def html_hash(self):
+        return hashlib.md5((self.html or u'').encode('utf-8')).hexdigest()
+    def plain_text(self):
+        """The lower-cased text of the entry html, as searched."""
         soup = BeautifulSoup.BeautifulSoup(self.html)
-        text = ''.join(soup(text=True))
+        return ''.join(soup(text=True)).lower()
+    def build_index(self, old_index):
+        """Returns the EntryIndex to write given the current one, or None if
+        old_index is up to date, with the sets of bigrams to add to and remove
+        from the posting lists."""
+        html_hash = self.html_hash()
+        current = (old_index is not None and old_index.version == EntryIndex.VERSION
+                   and old_index.key() == EntryIndex.key_for(self.key()))
+        if current and old_index.html_hash == html_hash:
+            return None, set(), set()
+        text = self.plain_text()
+        if current and old_index.text == text:
+            # Only the markup changed, the postings are still right.
+            old_index.html_hash = html_hash
+            return old_index, set(), set()
         bigrams = EntryIndex.create_bigram_set(text)
-        index = EntryIndex(parent=self)
+        posted = set()
+        if old_index and old_index.is_posted():
+            # The stored bigrams are those in the posting lists, even when
+            # they were built by an older VERSION.
+            posted = set(old_index.bigrams)
+        index = EntryIndex(key=EntryIndex.key_for(self.key()))
         index.bigrams = list(bigrams)
+        index.version = EntryIndex.VERSION
+        index.text = db.Text(text)
+        index.html_hash = html_hash
+        return index, bigrams - posted, posted - bigrams
+    def index(self):
+        """Brings the search index of the entry up to date. Returns False if
+        search results are unaffected."""
+        old_index = EntryIndex.get_for(self.key())
+        index, added, removed = self.build_index(old_index)
+        if index is None:
+            return False
+        EntryIndex.queue_postings(self.key(), added, removed)
         index.put()
+        if old_index and old_index.key() != index.key():
+            old_index.delete()
+        if not (old_index and old_index.is_posted()):
+            counters.increment(EntryIndex.document_counter())
+        return index is not old_index
+    @classmethod
+    def build_indexes(self, entries):
+        """Builds the indexes of many entries at once. Returns the EntryIndex
+        entities to put, the legacy ones to delete, the posting changes as
+        a dict of entry id to (added, removed) bigrams and the number of
+        entries that were not in the posting lists before."""
+        old_indexes = db.get([EntryIndex.key_for(entry.key()) for entry in entries])
+        to_put = []
+        to_delete = []
+        changes = {}
+        new_documents = 0
+        for entry, old_index in zip(entries, old_indexes):
+            if old_index is None:
+                old_index = EntryIndex.get_for(entry.key())
+            index, added, removed = entry.build_index(old_index)
+            if index is None:
+                continue
+            to_put.append(index)
+            if old_index and old_index.key() != index.key():
+                to_delete.append(old_index)
+            if added or removed:
+                changes[entry.key().id()] = (added, removed)
+            if not (old_index and old_index.is_posted()):
+                new_documents += 1
+        return to_put, to_delete, changes, new_documents
+
+class EntryFragmentCache(object):
+    """Rendered list items of entries, kept in memcache under the entry key,
+    its modified_at, the author's username and whether the viewer owns the
+    entry. Entry.put() sets modified_at on the instance, so an entry rendered
+    right after it was saved gets a new fragment. The username is the one
+    the fragment is rendered with, so a profile cached before a rename only
+    ever fills the key of the old name."""
+    name = 'entry_fragments'
+    def __init__(self, time=86400):
+        self.time = time
+        self.generation = caching.Generation(self.name)
+        self.hits = 0
+        self.misses = 0
+    def _keys(self, entry):
+        """Returns the entry key, author key and author username of an Entry
+        or a timeline.TimelineEntry."""
+        if isinstance(entry, Entry):
+            return entry.key(), entry.user_profile.key(), entry.user_profile.username
+        return entry.key, entry.user_profile.key, entry.user_profile.username
+    def render(self, entries, current_profile):
+        """Returns the list items of entries, rendering only those missing
+        from the cache. Entries that were deleted (None) are left out."""
+        entries = [entry for entry in entries if entry is not None]
+        prefetch_references([entry for entry in entries if isinstance(entry, Entry)],
+                            'user_profile')
+        generation = self.generation.get()
+        viewer_key = current_profile and current_profile.key()
+        keys = []
+        owned = []
+        for entry in entries:
+            entry_key, author_key, username = self._keys(entry)
+            owned.append(author_key == viewer_key)
+            keys.append('%s_%s_%d_%s_%s_%s_%d' % (caching.namespace, self.name, generation,
+                                                  entry_key, entry.modified_at,
+                                                  hashlib.md5((username or u'').encode('utf-8')).hexdigest(),
+                                                  owned[-1]))
+        fragments = memcache.get_multi(keys)
+        missing = [i for i in range(len(keys)) if keys[i] not in fragments]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            rendered = {}
+            for i in missing:
+                rendered[keys[i]] = rendering.render('entry.html', {'entry': entries[i],
+                                                                    'is_owner': owned[i]})
+            fragments.update(rendered)
+            memcache.set_multi(dict([(key, fragment) for key, fragment in rendered.items()
+                                     if caching.fits_memcache(fragment)]), self.time)
+        return [fragments[key] for key in keys]
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+entry_fragments = caching.register(EntryFragmentCache())
 
 class LoginHandler(webapp.RequestHandler):
     def get(self):
@@ -180,8 +599,7 @@ class SignUpHandler(webapp.RequestHandler):
                 'current_profile': current_profile,
                 'form': form
                 }
-                path = os.path.join(os.path.dirname(__file__), 'templates/signup.html')
-                self.response.out.write(template.render(path, template_values))
+                self.response.out.write(rendering.render('signup.html', template_values))
         else:
             self.redirect(users.create_login_url('/signup'))
     def post(self):
@@ -209,8 +627,7 @@ class SignUpHandler(webapp.RequestHandler):
                     'current_profile': current_profile,
                     'form': form
                     }
-                    path = os.path.join(os.path.dirname(__file__), 'templates/signup.html')
-                    self.response.out.write(template.render(path, template_values))
+                    self.response.out.write(rendering.render('signup.html', template_values))
         else:
             self.redirect(users.create_login_url('/signup'))
 
@@ -236,25 +653,30 @@ class SettingsHandler(webapp.RequestHandler):
         'form': form
         }
 
-        path = os.path.join(os.path.dirname(__file__), 'templates/settings.html')
-        self.response.out.write(template.render(path, template_values))
+        self.response.out.write(rendering.render('settings.html', template_values))
     def post(self):
         current_profile = UserProfile.current_profile()
 
         form = SettingsForm(data=self.request.POST)
         if form.is_valid():
+            pagecache.invalidate_paths('/%s' % current_profile.username)
+            if current_profile.username != form.clean_data['username']:
+                # Every page listing entries shows their author's username.
+                pagecache.invalidate()
+                pagecache.invalidate_paths('/%s' % form.clean_data['username'])
             current_profile.username = form.clean_data['username']
             current_profile.email = form.clean_data['email']
             current_profile.name = form.clean_data['name']
             current_profile.web = form.clean_data['web']
             current_profile.bio = form.clean_data['bio']
             current_profile.put()
+            CachedReferenceProperty.invalidate(current_profile.key())
+            timeline.update_author(current_profile)
         template_values = {
         'current_profile': current_profile,
         'form': form
         }
-        path = os.path.join(os.path.dirname(__file__), 'templates/settings.html')
-        self.response.out.write(template.render(path, template_values))
+        self.response.out.write(rendering.render('settings.html', template_values))
 
 class PostHandler(webapp.RequestHandler):
     def post(self):
@@ -268,42 +690,99 @@ class PostHandler(webapp.RequestHandler):
         entry.put()
         entry.setMarkdown(self.request.get('content'))
         key = entry.put()
-        taskqueue.add(url='/worker/searchindex', params={'key': key})
+        entry.update_counters([], entry.counter_names())
+        Entry.cursor_generation(current_profile.key()).bump()
+        pagecache.invalidate_paths(*entry.page_paths())
+        MainHandler.update_timeline(entry)
+        Entry.enqueue_index(key)
         self.redirect('/%s' % current_profile.username)
 
 class SearchHandler(webapp.RequestHandler):
+    # Search results by query, invalidated whenever the search index changes.
+    result_cache = caching.GenerationalCache('search', local_size=200, time=3600)
     def get(self):
         current_profile = UserProfile.current_profile()
         
         query = self.request.get('q')
+        next_link = None
+        prev_link = None
         if len(query) < 2:
             entries = []
+        elif self.request.get('mode') == 'ranked':
+            entries_per_page = 10
+            normalized_query = query.lower()
+            cursor = self.request.get('cursor')
+            generation = SearchHandler.result_cache.generation()
+            cache_key = ('ranked', normalized_query, cursor)
+            ranked = SearchHandler.result_cache.get(cache_key, generation)
+            if ranked is None:
+                bigrams = EntryIndex.create_bigram_set(normalized_query)
+                after = searchindex.parse_cursor(cursor)
+                ranked = searchindex.rank(bigrams, entries_per_page + 1,
+                                          EntryIndex.document_count(), after)
+                SearchHandler.result_cache.set(cache_key, ranked, generation)
+            if len(ranked) > entries_per_page:
+                ranked = ranked[:entries_per_page]
+                next_link = '/search?%s' % urllib.urlencode({
+                    'q': query.encode('utf-8'),
+                    'mode': 'ranked',
+                    'cursor': searchindex.make_cursor(ranked[-1])})
+            keys = [db.Key.from_path('Entry', id) for score, id in ranked]
+            entries = [entry for entry in db.get(keys) if entry is not None]
         else:    
             normalized_query = query.lower()
-            bigrams = EntryIndex.create_bigram_set(normalized_query)
-            q = EntryIndex.all(keys_only=True)
-            filter_count = 0
-            for bigram in bigrams:
-                q.filter('bigrams =', bigram)
-                filter_count += 1
-                if filter_count > 99:
-                    break
-            keys = q.fetch(1000)
-            entries = db.get([k.parent() for k in keys])
-            def query_in_html(normalized_query, html):
-                soup = BeautifulSoup.BeautifulSoup(html)
-                text = ''.join(soup(text=True))
-                text = text.lower()
-                return text.find(normalized_query) > -1
-            entries = [entry for entry in entries if query_in_html(normalized_query, entry.html)]
+            generation = SearchHandler.result_cache.generation()
+            cache_key = ('phrase', normalized_query)
+            keys = SearchHandler.result_cache.get(cache_key, generation)
+            if keys is None:
+                bigrams = EntryIndex.create_bigram_set(normalized_query)
+                if bigrams:
+                    ids = searchindex.lookup(bigrams)[:1000]
+                    keys = [db.Key.from_path('Entry', id) for id in ids]
+                    indexes = db.get([EntryIndex.key_for(key) for key in keys])
+                    # Entries indexed before the posting lists have no
+                    # postings until the re-index job has rebuilt their index.
+                    legacy_keys = EntryIndex.legacy_lookup(bigrams)
+                else:
+                    # A query without two adjacent characters, like "a b",
+                    # has nothing to look up. Its phrase is searched for in
+                    # every index, as search did before the posting lists.
+                    indexes = EntryIndex.all().fetch(1000)
+                    legacy_keys = [index.parent_key() for index in indexes
+                                   if not index.is_posted()]
+                keys = [index.parent_key() for index in indexes
+                        if index and index.text and index.text.find(normalized_query) > -1]
+                if legacy_keys:
+                    keys.extend([entry.key() for entry in db.get(legacy_keys)
+                                 if entry and entry.plain_text().find(normalized_query) > -1])
+                    keys = sorted(set(keys), key=lambda key: key.id())
+                SearchHandler.result_cache.set(cache_key, keys, generation)
+            # Only the entries of the requested page are loaded and rendered.
+            entries_per_page = 10
+            try:
+                page = max(int(self.request.get('page') or 1), 1)
+            except ValueError:
+                page = 1
+            start = (page - 1) * entries_per_page
+            def page_link(page):
+                return '/search?%s' % urllib.urlencode({'q': query.encode('utf-8'),
+                                                        'page': page})
+            if len(keys) > start + entries_per_page:
+                next_link = page_link(page + 1)
+            if page > 1:
+                prev_link = page_link(page - 1)
+            keys = keys[start:start + entries_per_page]
+            entries = [entry for entry in db.get(keys) if entry is not None]
         template_values = {
         'current_profile': current_profile,
         'entries': entries,
-        'query': query
+        'entry_fragments': entry_fragments.render(entries, current_profile),
+        'query': query,
+        'next_link': next_link,
+        'prev_link': prev_link
         }
 
-        path = os.path.join(os.path.dirname(__file__), 'templates/home.html')
-        self.response.out.write(template.render(path, template_values))
+        self.response.out.write(rendering.render('home.html', template_values))
 
 class EditHandler(webapp.RequestHandler):
     def get(self, key):
@@ -319,11 +798,11 @@ class EditHandler(webapp.RequestHandler):
         template_values = {
         'current_profile': current_profile,
         'edit_entry': entry,
-        'entries': [entry]
+        'entries': [entry],
+        'entry_fragments': entry_fragments.render([entry], current_profile)
         }
 
-        path = os.path.join(os.path.dirname(__file__), 'templates/edit.html')
-        self.response.out.write(template.render(path, template_values))
+        self.response.out.write(rendering.render('edit.html', template_values))
     def post(self, key):
         current_profile = UserProfile.current_profile()
         if not current_profile:
@@ -334,26 +813,32 @@ class EditHandler(webapp.RequestHandler):
             self.error(401)
             return
         needs_put = False
+        old_paths = entry.page_paths()
         new_is_private = (self.request.get('status') == 'private')
         if new_is_private != entry.is_private:
+            old_counter_names = entry.counter_names()
             entry.is_private = new_is_private
+            entry.update_counters(old_counter_names, entry.counter_names())
             needs_put = True
         new_content = self.request.get('content')
         if new_content and (new_content != entry.markdown):
             entry.setMarkdown(new_content)
-            taskqueue.add(url='/worker/searchindex', params={'key': key})
+            Entry.enqueue_index(key)
             needs_put = True
         if needs_put:
             entry.put()
+            Entry.cursor_generation(current_profile.key()).bump()
+            pagecache.invalidate_paths('/search', *(old_paths + entry.page_paths()))
+            MainHandler.update_timeline(entry)
 
         template_values = {
         'current_profile': current_profile,
         'edit_entry': entry,
-        'entries': [entry]
+        'entries': [entry],
+        'entry_fragments': entry_fragments.render([entry], current_profile)
         }
 
-        path = os.path.join(os.path.dirname(__file__), 'templates/edit.html')
-        self.response.out.write(template.render(path, template_values))
+        self.response.out.write(rendering.render('edit.html', template_values))
 
 class DeleteHandler(webapp.RequestHandler):
     def get(self, key):
@@ -365,10 +850,21 @@ class DeleteHandler(webapp.RequestHandler):
         if entry.user_profile.key() != current_profile.key():
             self.error(401)
             return
+        paths = entry.page_paths()
+        entry.tags = []
+        entry.update_counters(entry.counter_names(), [])
         entry.delete()
+        Entry.cursor_generation(current_profile.key()).bump()
+        pagecache.invalidate_paths('/search', *paths)
+        MainHandler.update_timeline(deleted_key=entry.key())
+        SearchHandler.result_cache.bump()
+        Entry.enqueue_index(key)
         self.redirect('/%s' % current_profile.username)
 
 class ArchiveHandler(webapp.RequestHandler):
+    cursor_store = caching.register(paging.TieredCursorStore('archive_cursors',
+        paging.LocalCursorStore(), paging.MemcacheCursorStore(),
+        paging.DatastoreCursorStore()))
     def get(self, username):
         current_profile = UserProfile.current_profile()
         
@@ -391,25 +887,43 @@ class ArchiveHandler(webapp.RequestHandler):
             page = 1
         else:
             page = int(page)
+        cursor = self.request.get('cursor')
         
         entries_per_page = 10
         
         q = Entry.all()
         q.filter('user_profile =', person_profile)
-        if current_profile.username != person_profile.username:
+        include_private = (current_profile is not None and
+                           current_profile.key() == person_profile.key())
+        if not include_private:
             q.filter('is_private =', False)
         q.order('-modified_at')
-    	pq = paging.PagedQuery(q, entries_per_page)
-        entries = pq.fetch_page(page)
-        page_count = pq.page_count()
+        def count():
+            count = 0
+            for is_private in ([False, True] if include_private else [False]):
+                count_q = Entry.all(keys_only=True).filter('user_profile =', person_profile).filter('is_private =', is_private)
+                count += count_entries(Entry.user_counter(person_profile.key(), is_private), count_q)
+            return count
+        generation = Entry.cursor_generation(person_profile.key()).get()
+        pq = paging.PagedQuery(q, entries_per_page, count_source=count,
+                               cursor_walk=True, read_ahead=True,
+                               cursor_store=ArchiveHandler.cursor_store,
+                               generation=generation)
+        if cursor:
+            entries = pq.fetch_page_by_token(cursor)
+            page = pq.last_page_number
+        else:
+            entries = pq.fetch_page(page)
         
-        if page_count > page:
-            next_link = '/%s?page=%d' % (username, page + 1)
+        next_token = pq.next_page_token()
+        if next_token and pq.has_page(page + 1):
+            next_link = '/%s?cursor=%s' % (username, next_token)
         else:
             next_link = None
         
-        if page > 1:
-            prev_link = '/%s?page=%d' % (username, page - 1)
+        prev_token = pq.prev_page_token()
+        if prev_token:
+            prev_link = '/%s?cursor=%s' % (username, prev_token)
         else:
             prev_link = None
         
@@ -417,12 +931,12 @@ class ArchiveHandler(webapp.RequestHandler):
         'current_profile': current_profile,
         'person_profile': person_profile,
         'entries': entries,
+        'entry_fragments': entry_fragments.render(entries, current_profile),
         'next_link': next_link,
         'prev_link': prev_link
         }
 
-        path = os.path.join(os.path.dirname(__file__), 'templates/archive.html')
-        self.response.out.write(template.render(path, template_values))
+        self.response.out.write(rendering.render('archive.html', template_values))
 
 class RSSHandler(webapp.RequestHandler):
     def get(self, username):
@@ -443,9 +957,9 @@ class RSSHandler(webapp.RequestHandler):
         entries_per_page = 10
 
         q = Entry.all().filter('user_profile =', person_profile).order('-modified_at')
-    	pq = paging.PagedQuery(q, entries_per_page)
+        pq = paging.PagedQuery(q, entries_per_page)
         entries = pq.fetch_page(page)
-        page_count = pq.page_count()
+        prefetch_references(entries, 'user_profile')
 
         template_values = {
         'current_profile': current_profile,
@@ -453,8 +967,7 @@ class RSSHandler(webapp.RequestHandler):
         'entries': entries,
         }
 
-        path = os.path.join(os.path.dirname(__file__), 'templates/rss.xml')
-        self.response.out.write(template.render(path, template_values))
+        self.response.out.write(rendering.render('rss.xml', template_values))
 
 class TagHandler(webapp.RequestHandler):
     def get(self, username, tag_name):
@@ -469,6 +982,10 @@ class TagHandler(webapp.RequestHandler):
             return
         else:
             person_profile = UserProfile.profile_for_username(username)
+            if not person_profile:
+                self.error(404)
+                self.response.out.write('Sorry, that page doesn\'t exist!')
+                return
 
         page = self.request.get('page')
         if (not page):
@@ -478,26 +995,33 @@ class TagHandler(webapp.RequestHandler):
 
         entries_per_page = 10
 
-        tag = taggable.Tag.get_by_name(tag_name)
-        q = Entry.all().filter('__key__ IN', tag.tagged)
         if person_profile:
-            # cursor does not support MultiQuery so we fall back.
-            q.filter('user_profile =', person_profile)
-            page_count = int(q.count() / entries_per_page + 0.5)
-            offset = (page - 1) * entries_per_page
-            entries = q.fetch(entries_per_page, offset)
+            include_private = (current_profile is not None and
+                               current_profile.key() == person_profile.key())
+            q = Entry.tag_timeline(tag_name, person_profile.key(), include_private)
+            generation = Entry.cursor_generation(person_profile.key()).get()
         else:
-            pq = paging.PagedQuery(q, entries_per_page)
-            entries = pq.fetch_page(page)
-            page_count = pq.page_count()
+            q = Entry.tag_timeline(tag_name)
+            generation = None
+        pq = paging.PagedQuery(q, entries_per_page, cursor_walk=True,
+                               read_ahead=True, generation=generation)
+        cursor = self.request.get('cursor')
+        if cursor:
+            keys = pq.fetch_page_by_token(cursor)
+            page = pq.last_page_number
+        else:
+            keys = pq.fetch_page(page)
+        entries = [e for e in db.get([k.parent() for k in keys]) if e]
 
-        if page_count > page:
-            next_link = '/%s?page=%d' % (username, page + 1)
+        next_token = pq.next_page_token()
+        if next_token and pq.has_page(page + 1):
+            next_link = '/%s/%s?cursor=%s' % (username, tag_name, next_token)
         else:
             next_link = None
 
-        if page > 1:
-            prev_link = '/%s?page=%d' % (username, page - 1)
+        prev_token = pq.prev_page_token()
+        if prev_token:
+            prev_link = '/%s/%s?cursor=%s' % (username, tag_name, prev_token)
         else:
             prev_link = None
 
@@ -506,12 +1030,12 @@ class TagHandler(webapp.RequestHandler):
         'person_profile': person_profile,
         'tag': tag_name,
         'entries': entries,
+        'entry_fragments': entry_fragments.render(entries, current_profile),
         'next_link': next_link,
         'prev_link': prev_link
         }
 
-        path = os.path.join(os.path.dirname(__file__), 'templates/tag.html')
-        self.response.out.write(template.render(path, template_values))
+        self.response.out.write(rendering.render('tag.html', template_values))
 
 class SingleEntryHandler(webapp.RequestHandler):
     def get(self, key):
@@ -523,10 +1047,10 @@ class SingleEntryHandler(webapp.RequestHandler):
         template_values = {
         'current_profile': current_profile,
         'entries': entries,
+        'entry_fragments': entry_fragments.render(entries, current_profile),
         }
 
-        path = os.path.join(os.path.dirname(__file__), 'templates/single.html')
-        self.response.out.write(template.render(path, template_values))
+        self.response.out.write(rendering.render('single.html', template_values))
 
 class AboutHandler(webapp.RequestHandler):
     def get(self):
@@ -536,49 +1060,210 @@ class AboutHandler(webapp.RequestHandler):
         'current_profile': current_profile
         }
 
-        path = os.path.join(os.path.dirname(__file__), 'templates/about.html')
-        self.response.out.write(template.render(path, template_values))
+        self.response.out.write(rendering.render('about.html', template_values))
 
 
-# TODO: Accessing many UserProfiles takes a lot of time. Should
-#       create a public timeline datastore with data from UserProfile
-#       embedded. 
+# The front page is served from the denormalized public timeline, which
+# embeds the author of each entry. Handlers that change public entries keep
+# it up to date.
 class MainHandler(webapp.RequestHandler):
+    entries_per_page = 10
+    @classmethod
+    def rebuild_timeline(self):
+        q = Entry.all().filter('is_private =', False).order('-modified_at')
+        entries = q.fetch(timeline.MAX_ENTRIES)
+        prefetch_references(entries, 'user_profile')
+        timeline.rebuild(entries)
+    @classmethod
+    def update_timeline(self, entry=None, deleted_key=None):
+        if entry:
+            count = timeline.put_entry(entry)
+        else:
+            count = timeline.remove_entry(deleted_key)
+        if count is not None and count < MainHandler.entries_per_page:
+            # Entries left the timeline; refill it from older entries.
+            MainHandler.rebuild_timeline()
     def get(self):
         current_profile = UserProfile.current_profile()
 
-        entries_per_page = 10
-        q = Entry.all().filter('is_private =', False).order('-modified_at')
-        entry_count = q.count()
-        page_count = int(entry_count / entries_per_page + 0.5)
-        entries = q.fetch(entries_per_page)
+        entries = timeline.get()
+        if entries is None:
+            MainHandler.rebuild_timeline()
+            entries = timeline.get() or []
+        entries = timeline.fill_html(entries[:MainHandler.entries_per_page])
 
         template_values = {
         'current_profile': current_profile,
         'entries': entries,
+        'entry_fragments': entry_fragments.render(entries, current_profile),
         }
 
-        path = os.path.join(os.path.dirname(__file__), 'templates/public.html')
-        self.response.out.write(template.render(path, template_values))
+        self.response.out.write(rendering.render('public.html', template_values))
 
 class SearchIndexWorker(webapp.RequestHandler):
     def post(self):
-        key = self.request.get('key')
-        def txn():
-            entry = db.get(key)
-            old_index = EntryIndex.all().ancestor(entry).get()
-            if old_index:
-                old_index.delete()
-            entry.index()
-        db.run_in_transaction(txn)
+        key = db.Key(self.request.get('key'))
+        entry = db.get(key)
+        if entry:
+            if entry.index():
+                SearchHandler.result_cache.bump()
+                pagecache.invalidate_paths('/search')
+        else:
+            EntryIndex.remove(key)
+            SearchHandler.result_cache.bump()
+            pagecache.invalidate_paths('/search')
 
-def real_main():
-    application = webapp.WSGIApplication([('/', MainHandler), ('/about', AboutHandler), ('/search', SearchHandler), ('/worker/searchindex', SearchIndexWorker), ('/login', LoginHandler), ('/logout', LogoutHandler), 
+class PostingsFlushWorker(webapp.RequestHandler):
+    def post(self):
+        start = time.time()
+        flushed = searchindex.flush_postings(start + ReindexJob.SLICE_TIME)
+        if flushed:
+            SearchHandler.result_cache.bump()
+            pagecache.invalidate_paths('/search')
+        if flushed is None or flushed == searchindex.FLUSH_BATCH_SIZE:
+            # More changes are queued than one flush can apply.
+            taskqueue.add(url='/worker/postings')
+
+class ReindexHandler(webapp.RequestHandler):
+    def get(self):
+        self.response.headers['Content-Type'] = 'text/plain'
+        for job in ReindexJob.all().order('-started_at').fetch(10):
+            if job.finished_at:
+                state = 'finished %s' % job.finished_at
+            else:
+                state = 'running'
+            self.response.out.write('%s %d entries %.1f entries/s %s\n' % (
+                job.key().name(), job.processed, job.rate(), state))
+    def post(self):
+        job = ReindexJob(key_name='reindex-%d' % int(time.time()))
+        job.put()
+        job.enqueue()
+        self.redirect('/_admin/reindex')
+
+class ReindexSliceWorker(webapp.RequestHandler):
+    def post(self):
+        start = time.time()
+        job = ReindexJob.get_by_key_name(self.request.get('job'))
+        if job is None or job.finished_at:
+            return
+        postings = job.get_pending()
+        entry_keys, to_delete, new_documents = job.get_pending_writes()
+        if entry_keys or to_delete:
+            # An earlier run of the slice failed before writing the indexes.
+            # Indexes only depend on their entry, so they are built again.
+            to_put = Entry.build_indexes([e for e in db.get(entry_keys) if e])[0]
+        elif not postings:
+            q = Entry.all().order('__key__')
+            if job.cursor:
+                q.with_cursor(job.cursor)
+            entries = q.fetch(ReindexJob.BATCH_SIZE)
+            if not entries:
+                job.finished_at = datetime.datetime.now()
+                job.put()
+                logging.info('%s finished: %d entries in %.1fs, %.1f entries/s',
+                             job.key().name(), job.processed, job.elapsed, job.rate())
+                return
+            to_put, to_delete, changes, new_documents = Entry.build_indexes(entries)
+            postings = searchindex.invert_changes(changes)
+            # Checkpoint the posting changes together with the index writes
+            # they were computed against, so that a failure can lose
+            # neither: a retried slice applies them again.
+            job.cursor = q.cursor()
+            job.processed += len(entries)
+            job.set_pending(postings)
+            entry_keys = [index.parent_key() for index in to_put]
+            to_delete = [index.key() for index in to_delete]
+            job.set_pending_writes(entry_keys, to_delete, new_documents)
+            job.put()
+        if entry_keys or to_delete:
+            db.put(to_put)
+            db.delete(to_delete)
+            if new_documents:
+                counters.increment(EntryIndex.document_counter(), new_documents)
+            job.set_pending_writes([], [], 0)
+            job.put()
+        searchindex.update_postings_multi(postings, start + ReindexJob.SLICE_TIME)
+        job.set_pending(postings)
+        job.slices += 1
+        job.elapsed += time.time() - start
+        job.put()
+        SearchHandler.result_cache.bump()
+        pagecache.invalidate_paths('/search')
+        logging.info('%s: %d entries, %.1f entries/s, %d bigrams pending',
+                     job.key().name(), job.processed, job.rate(), len(postings))
+        job.enqueue()
+
+class TagBackfillHandler(webapp.RequestHandler):
+    def get(self):
+        self.response.headers['Content-Type'] = 'text/plain'
+        for job in TagBackfillJob.all().order('-started_at').fetch(10):
+            if job.finished_at:
+                state = 'finished %s' % job.finished_at
+            else:
+                state = 'running, walking %s' % job.walking
+            self.response.out.write('%s %d entities %s\n' % (
+                job.key().name(), job.processed, state))
+    def post(self):
+        job = TagBackfillJob(key_name='backfill-tags-%d' % int(time.time()))
+        job.put()
+        job.enqueue()
+        self.redirect('/_admin/backfill/tags')
+
+class TagBackfillSliceWorker(webapp.RequestHandler):
+    def post(self):
+        job = TagBackfillJob.get_by_key_name(self.request.get('job'))
+        if job is None or job.finished_at:
+            return
+        if job.walking == 'Tag':
+            q = taggable.Tag.all().order('__key__')
+        else:
+            q = Entry.all().order('__key__')
+        if job.cursor:
+            q.with_cursor(job.cursor)
+        batch = q.fetch(TagBackfillJob.BATCH_SIZE)
+        # Slices are idempotent, the checkpoint is only written once the
+        # batch is done.
+        for entity in batch:
+            if job.walking == 'Tag':
+                entity.migrate_tagged()
+            else:
+                entity.update_tag_memberships()
+        job.processed += len(batch)
+        job.slices += 1
+        if batch:
+            job.cursor = q.cursor()
+        elif job.walking == 'Tag':
+            job.walking = 'Entry'
+            job.cursor = None
+        else:
+            job.finished_at = datetime.datetime.now()
+            job.put()
+            pagecache.invalidate()
+            logging.info('%s finished: %d entities', job.key().name(), job.processed)
+            return
+        job.put()
+        job.enqueue()
+
+class StatsHandler(webapp.RequestHandler):
+    def get(self):
+        self.response.headers['Content-Type'] = 'text/plain'
+        for cache in caching.registry:
+            stats = cache.stats()
+            for name in sorted(stats.keys()):
+                self.response.out.write('%s.%s %d\n' % (cache.name, name, stats[name]))
+
+# Compile the templates once per process, before the first request needs them.
+rendering.warm_up()
+
+def make_application():
+    return webapp.WSGIApplication([('/', MainHandler), ('/about', AboutHandler), ('/search', SearchHandler), ('/worker/searchindex', SearchIndexWorker), ('/worker/postings', PostingsFlushWorker), ('/_admin/stats', StatsHandler), ('/_admin/reindex', ReindexHandler), ('/_admin/reindex/slice', ReindexSliceWorker), ('/_admin/backfill/tags', TagBackfillHandler), ('/_admin/backfill/tags/slice', TagBackfillSliceWorker), ('/login', LoginHandler), ('/logout', LogoutHandler), 
     ('/signup', SignUpHandler), ('/post', PostHandler), ('/settings', SettingsHandler), ('/entry/(.+)', SingleEntryHandler), 
     ('/edit/(.+)', EditHandler), ('/delete/(.+)', DeleteHandler), ('/([a-z][a-z0-9_]*)', ArchiveHandler), 
     ('/([a-z][a-z0-9_]*)/rss', RSSHandler), ('/([a-z][a-z0-9_]*)/(\w+)', TagHandler)],
                                          debug=True)
-    util.run_wsgi_app(application)
+
+def real_main():
+    util.run_wsgi_app(pagecache.PageCache(make_application()))
 
 import traceback
 from google.appengine.api import apiproxy_stub_map
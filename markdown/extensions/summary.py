@@ -0,0 +1,49 @@
+'''
+Summary Extension for Python-Markdown
+=====================================
+
+Captures a plain text summary of the first block of the document while it
+is being converted, so callers do not need a second conversion to get one.
+
+    >>> import markdown
+    >>> md = markdown.Markdown(extensions=['summary'])
+    >>> md.convert(u'Some *emphasised*\\ntext.\\n\\nSecond block.')
+    u'<p>Some <em>emphasised</em>\\ntext.</p>\\n<p>Second block.</p>'
+    >>> md.summary
+    u'Some emphasised text.'
+
+'''
+
+import markdown
+
+
+class SummaryExtension(markdown.Extension):
+    def __init__(self, configs):
+        # set extension defaults
+        self.config = {
+                        'max_length' : [255, 'Maximum length of the summary.'],
+        }
+
+        # Override defaults with user settings
+        for key, value in configs:
+            self.setConfig(key, value)
+
+    def extendMarkdown(self, md, md_globals):
+        self.md = md
+        md.summary = u""
+        summarizer = markdown.treeprocessors.SummaryTreeprocessor(
+                                md, int(self.getConfig('max_length')))
+        md.treeprocessors.add('summary', summarizer, "_end")
+        md.registerExtension(self)
+
+    def reset(self):
+        self.md.summary = u""
+
+
+def makeExtension(configs=None):
+    return SummaryExtension(configs=configs)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -340,3 +340,50 @@ class PrettifyTreeprocessor(Treeprocessor):
                 br.tail = '\n'
             else:
                 br.tail = '\n%s' % br.tail
+
+
+class SummaryTreeprocessor(Treeprocessor):
+    """
+    Capture the text of the first non-blank block of the document.
+
+    The text is stored on the Markdown instance as `summary`, with tags
+    stripped, whitespace collapsed and markup characters escaped the same
+    way the serializer escapes them. It is truncated to `max_length`.
+    """
+
+    RAW_HTML_RE = re.compile(u'%swzxhzdk:(\d+)%s' % (util.STX, util.ETX))
+    TAG_RE = re.compile(r'<.*?>', re.DOTALL)
+
+    def __init__(self, md, max_length=255):
+        self.markdown = md
+        self.max_length = max_length
+
+    def _collectText(self, elem, texts):
+        """ Append the text of elem and its children, without elem.tail. """
+        if elem.text:
+            texts.append(elem.text)
+        for child in elem:
+            self._collectText(child, texts)
+            if child.tail:
+                texts.append(child.tail)
+
+    def _rawHtmlText(self, match):
+        """ Replace a raw html placeholder with the text of the html. """
+        html, safe = self.markdown.htmlStash.rawHtmlBlocks[int(match.group(1))]
+        return self.TAG_RE.sub('', html)
+
+    def run(self, root):
+        self.markdown.summary = u""
+        for block in root:
+            texts = []
+            self._collectText(block, texts)
+            text = u"".join(texts)
+            text = text.replace("&", "&amp;")
+            text = text.replace("<", "&lt;")
+            text = text.replace(">", "&gt;")
+            text = self.RAW_HTML_RE.sub(self._rawHtmlText, text)
+            text = text.replace(util.AMP_SUBSTITUTE, "&")
+            text = u" ".join(text.split())
+            if text:
+                self.markdown.summary = text[:self.max_length]
+                break
@@ -0,0 +1,62 @@
+'''
+This module keeps long-lived markdown.Markdown converters around so that a
+request only pays for the conversion itself. Building a Markdown object
+loads every extension through __import__ and rebuilds all of the processor
+OrderedDicts, which is far more expensive than converting a typical entry.
+
+USAGE:
+
+html = markdown_pool.convert(source, ['tables', 'codehilite'])
+
+or, when the converter itself is needed (eg. to look at its state after
+the conversion):
+
+md = markdown_pool.acquire(['tables', 'codehilite'])
+try:
+    html = md.convert(source)
+finally:
+    markdown_pool.release(md)
+'''
+import markdown
+
+# Converters are pooled per (extensions, safe_mode, output_format). The
+# order of the extensions is part of the key since it decides where each
+# extension inserts its processors.
+_pools = {}
+
+def _pool_key(extensions, safe_mode, output_format):
+    return (tuple(extensions), safe_mode, output_format)
+
+def acquire(extensions=[], safe_mode=False, output_format='xhtml1'):
+    '''Returns a Markdown instance configured with the given extensions,
+    already reset and ready for convert(). The instance must be handed back
+    with release() once the caller is done with it.
+    '''
+    key = _pool_key(extensions, safe_mode, output_format)
+    idle = _pools.setdefault(key, [])
+    if idle:
+        md = idle.pop()
+    else:
+        md = markdown.Markdown(extensions=markdown.load_extensions(extensions),
+                               safe_mode=safe_mode,
+                               output_format=output_format)
+        md._pool_key = key
+    return md
+
+def release(md):
+    '''Resets the converter and returns it to its pool.'''
+    md.reset()
+    _pools.setdefault(md._pool_key, []).append(md)
+
+def convert(text, extensions=[], safe_mode=False, output_format='xhtml1'):
+    '''Drop-in replacement for markdown.markdown() that reuses a pooled
+    converter.'''
+    md = acquire(extensions, safe_mode, output_format)
+    try:
+        return md.convert(text)
+    finally:
+        release(md)
+
+def clear():
+    '''Drops every pooled converter.'''
+    _pools.clear()
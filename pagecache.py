@@ -0,0 +1,154 @@
+'''
+This module contains the page cache, which serves whole responses to
+anonymous visitors from memcache.
+
+PageCache wraps the WSGI application. Anonymous GET requests are looked up
+by path and query string; successful responses are stored on a miss. Every
+page is namespaced by the generation of the whole site and by the
+generation of its section:
+
+  the pages of a user (/<username>, /<username>/rss, /<username>/<tag>)
+  the front page (/), the search results (/search), each site wide tag
+  page (/tag/<tag>) and each single entry page (/entry/<key>)
+  the rest of the site, which does not change with the entries
+
+Writers call invalidate_paths() with the paths of the pages they changed,
+which bumps the generations of their sections only, or invalidate() when
+every page changed.
+
+Responses carry an ETag derived from the cache key and the generations, so
+a conditional request for a page that has not changed is answered with a
+304 from the generations alone. Last-Modified is the time the page was
+cached.
+'''
+import hashlib
+import re
+import time
+import wsgiref.handlers
+
+from google.appengine.api import memcache
+from google.appengine.api import users
+
+import caching
+
+# First path segments that are not usernames.
+RESERVED = frozenset(['', 'about', 'delete', 'edit', 'entry', 'home',
+                      'login', 'logout', 'post', 'search', 'settings',
+                      'signup', 'static', 'tag', 'worker'])
+
+_USER_PATH_RE = re.compile(r'^/([a-z][a-z0-9_]*)(/|$)')
+
+# Site pages that change with the entries, each a section of its own.
+_SITE_SECTION_RE = re.compile(r'^/(?:search|tag/\w+|entry/[^/]+)?$')
+
+def _site_generation():
+    return caching.Generation('pages')
+
+def _section(path):
+    '''Returns the name of the section of the page at path.'''
+    match = _USER_PATH_RE.match(path)
+    if match and match.group(1) not in RESERVED:
+        return 'user_%s' % match.group(1)
+    if _SITE_SECTION_RE.match(path):
+        if path.startswith('/tag/'):
+            # Tag names are not case sensitive.
+            return path.lower()
+        return path
+    return 'static'
+
+def _section_generation(section):
+    return caching.Generation('pages_%s' % section)
+
+def invalidate():
+    '''Invalidates every cached page.'''
+    _site_generation().bump()
+
+def invalidate_paths(*paths):
+    '''Invalidates the cached pages in the sections of paths, whatever their
+    query string. /<username> invalidates every page of the user.'''
+    for section in set(map(_section, paths)):
+        _section_generation(section).bump()
+
+class PageCacheMetrics(object):
+    "Process wide hit counters of the page cache, reported by the stats page."
+
+    name = 'pages'
+
+    def __init__(self):
+        self.counts = {'hits': 0, 'misses': 0, 'not_modified': 0, 'too_large': 0}
+
+    def increment(self, counter):
+        self.counts[counter] += 1
+
+    def stats(self):
+        return dict(self.counts)
+
+metrics = caching.register(PageCacheMetrics())
+
+class PageCache(object):
+    '''
+    WSGI middleware caching the responses of app for anonymous visitors
+    for at most time seconds.
+
+    application = PageCache(webapp.WSGIApplication(...))
+    '''
+
+    def __init__(self, app, time=3600):
+        self.app = app
+        self.time = time
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD') != 'GET' or users.get_current_user():
+            return self.app(environ, start_response)
+
+        path = environ.get('PATH_INFO', '/')
+        query = environ.get('QUERY_STRING', '')
+        site, section = caching.get_generations([_site_generation(),
+                                                 _section_generation(_section(path))])
+        digest = hashlib.md5('%s?%s' % (path, query)).hexdigest()
+        key = '%s_page_%d_%d_%s' % (caching.namespace, site, section, digest)
+        etag = '"%s"' % hashlib.md5(key).hexdigest()
+
+        if etag in [tag.strip() for tag in
+                    environ.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+            metrics.increment('not_modified')
+            start_response('304 Not Modified', [('ETag', etag)])
+            return []
+
+        page = memcache.get(key)
+        if page is not None:
+            status, headers, body = page
+            since = environ.get('HTTP_IF_MODIFIED_SINCE')
+            if since and since == dict(headers).get('Last-Modified'):
+                metrics.increment('not_modified')
+                start_response('304 Not Modified', [('ETag', etag)])
+                return []
+            metrics.increment('hits')
+            start_response(status, headers)
+            return [body]
+
+        metrics.increment('misses')
+        response = {}
+        def capture_start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+            return response.setdefault('body', []).append
+        result = self.app(environ, capture_start_response)
+        body = ''.join(response.get('body', []) + list(result))
+        if hasattr(result, 'close'):
+            result.close()
+        status = response['status']
+        headers = response['headers']
+        if status.startswith('200'):
+            headers = [(name, value) for name, value in headers
+                       if name.lower() not in ('etag', 'last-modified',
+                                               'set-cookie')]
+            headers.append(('ETag', etag))
+            headers.append(('Last-Modified',
+                            wsgiref.handlers.format_date_time(time.time())))
+            if caching.fits_memcache(body):
+                memcache.set(key, (status, headers, body), self.time)
+            else:
+                metrics.increment('too_large')
+        start_response(status, headers)
+        return [body]
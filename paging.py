@@ -3,11 +3,263 @@ This module contains classes for managing paging.
 '''
 import google.appengine.ext.db as db
 import google.appengine.api.memcache as memcache
+import caching
+import copy
+import hashlib
 import logging
 import pickle
+import re
+import time
 
 namespace = 'he3'
 
+#seconds a page fetched ahead is served from the persisted form
+LOOKAHEAD_TIME = 30
+
+#tokens for pages beyond this one fetch the first page
+MAX_TOKEN_PAGE = 100
+
+def _canonical_value(value):
+	'''Returns a string representing a filter or ancestor value that is the
+	same in every process for equal values.'''
+	if isinstance(value, db.Model):
+		return 'K' + str(value.key())
+	if isinstance(value, db.Key):
+		return 'K' + str(value)
+	if isinstance(value, (list, tuple)):
+		#the order of IN values does not change the result set
+		return '[%s]' % ','.join(sorted([_canonical_value(v) for v in value]))
+	if isinstance(value, unicode):
+		return 'U' + value.encode('utf-8')
+	return '%s:%r' % (type(value).__name__, value)
+
+class QueryFingerprint(object):
+	'''
+	A canonical description of a query built from its kind, filters, orders
+	and ancestor. Filters are order-insensitive, orders are not. Unlike
+	hashing a pickled query, the digest is cheap to compute and is the same
+	in every process for semantically identical queries.
+	
+	The fingerprint is kept up to date by PagedQuery as its filter(), 
+	order() and ancestor() methods are called.
+	'''
+	
+	_FILTER_RE = re.compile(r'^\s*([^\s]+)(\s+(.*))?$')
+	
+	def __init__(self, kind=None, keys_only=False):
+		self.kind = kind
+		self.keys_only = keys_only
+		self.filters = []
+		self.orders = []
+		self.ancestor = None
+		self.opaque = None
+		self._digest = None
+		
+	@classmethod
+	def from_query(cls, query):
+		'''Builds the fingerprint of an existing db.Query. Queries whose
+		structure is not known (eg. GqlQuery) are fingerprinted by an md5 of
+		their pickle. 
+		@param query: a db.Query or db.GqlQuery object
+		@return: a QueryFingerprint
+		'''
+		query_sets = getattr(query, '_Query__query_sets', None)
+		orderings = getattr(query, '_Query__orderings', None)
+		model_class = getattr(query, '_model_class', None)
+		if query_sets is None or orderings is None or model_class is None:
+			fingerprint = cls()
+			fingerprint.opaque = hashlib.md5(pickle.dumps(query, 2)).hexdigest()
+			return fingerprint
+		
+		fingerprint = cls(model_class.kind(), getattr(query, '_keys_only', False))
+		if len(query_sets) == 1:
+			for property_operator, value in query_sets[0].items():
+				fingerprint.add_filter(property_operator, value)
+		else:
+			#IN and != filters expand into several query sets
+			fingerprint.filters.append('sets:' + '|'.join(sorted([
+				','.join(sorted(['%s=%s' % (k, _canonical_value(v))
+								for k, v in query_set.items()]))
+				for query_set in query_sets])))
+		for ordering in orderings:
+			if isinstance(ordering, tuple):
+				property, direction = ordering
+				fingerprint.orders.append('%s %s' % (property, direction))
+			else:
+				fingerprint.add_order(ordering)
+		ancestor = getattr(query, '_Query__ancestor', None)
+		if ancestor is not None:
+			fingerprint.set_ancestor(ancestor)
+		return fingerprint
+	
+	def add_filter(self, property_operator, value):
+		match = self._FILTER_RE.match(property_operator)
+		operator = (match.group(3) or '=').strip().lower()
+		if operator == '==':
+			operator = '='
+		self.filters.append('%s %s %s' % (match.group(1), operator, 
+										  _canonical_value(value)))
+		self._digest = None
+		
+	def add_order(self, property):
+		if property.startswith('-'):
+			self.orders.append('%s 2' % property[1:])
+		else:
+			self.orders.append('%s 1' % property)
+		self._digest = None
+		
+	def set_ancestor(self, ancestor):
+		self.ancestor = _canonical_value(ancestor)
+		self._digest = None
+		
+	def digest(self):
+		'''Returns a hex string identifying the query'''
+		if not self._digest:
+			parts = [str(self.kind), str(self.keys_only), str(self.opaque),
+					 str(self.ancestor)]
+			parts.extend(sorted(self.filters))
+			parts.append('order')
+			parts.extend(self.orders)
+			self._digest = hashlib.md5('\n'.join(parts)).hexdigest()
+		return self._digest
+
+class PagingMetrics(object):
+	'''
+	Process wide totals of the per query counters kept by PagedQuery 
+	(offset_queries, cursor_queries, restore, ...). Registered with the 
+	caching registry so they are reported by the stats page.
+	'''
+	
+	name = 'paging'
+	
+	def __init__(self):
+		self.counts = {}
+		
+	def increment(self, counter):
+		self.counts[counter] = self.counts.get(counter, 0) + 1
+		
+	def stats(self):
+		return dict(self.counts)
+
+metrics = caching.register(PagingMetrics())
+
+class MemcacheCursorStore(object):
+	'''Keeps the persisted form of queries in memcache. This is the default
+	cursor store.'''
+	
+	def get(self, key):
+		return memcache.Client().get(key)
+	
+	def set(self, key, persisted_form):
+		memcache.Client().set(key, persisted_form)
+		
+	def delete(self, key):
+		memcache.Client().delete(key)
+
+class LocalCursorStore(object):
+	'''Keeps the persisted form of queries in an in-process LRU cache, for
+	at most ttl seconds.'''
+	
+	def __init__(self, max_size=500, ttl=60):
+		self.cache = caching.LRUCache(max_size, ttl)
+		
+	def get(self, key):
+		return self.cache.get(key)
+	
+	def set(self, key, persisted_form):
+		self.cache.set(key, persisted_form)
+		
+	def delete(self, key):
+		self.cache.delete(key)
+
+class PersistedCursors(db.Model):
+	"The persisted form of a PagedQuery. The key name is the query's key."
+	
+	form = db.BlobProperty()
+	"The pickled persisted form, without its lookahead page."
+
+class DatastoreCursorStore(object):
+	'''Keeps the persisted form of hot queries in the datastore, where 
+	memcache eviction can not reach it. A query is hot once cursors for 
+	min_pages pages are known; shallower queries are cheap to rebuild and 
+	are not stored. Lookahead pages are not stored either, so the entity is
+	only written when the cursors change.'''
+	
+	def __init__(self, min_pages=3):
+		self.min_pages = min_pages
+		#the stored cursors of recently seen keys, to skip redundant puts
+		self._stored = caching.LRUCache(500)
+		
+	def _stored_form(self, persisted_form):
+		stored_form = dict(persisted_form)
+		stored_form['lookahead'] = None
+		return stored_form
+		
+	def get(self, key):
+		entity = PersistedCursors.get_by_key_name(key)
+		if entity is None:
+			return None
+		persisted_form = pickle.loads(entity.form)
+		self._stored.set(key, persisted_form)
+		return persisted_form
+	
+	def set(self, key, persisted_form):
+		if len(persisted_form['page_cursors']) < self.min_pages:
+			return
+		stored_form = self._stored_form(persisted_form)
+		if self._stored.get(key) == stored_form:
+			return
+		PersistedCursors(key_name=key, 
+						 form=db.Blob(pickle.dumps(stored_form, 2))).put()
+		self._stored.set(key, stored_form)
+		
+	def delete(self, key):
+		db.delete(db.Key.from_path('PersistedCursors', key))
+		self._stored.delete(key)
+
+class TieredCursorStore(object):
+	'''
+	A cursor store made of several levels, fastest first. Reads try each 
+	level in turn and copy what they find into the levels above; writes and
+	deletes go to every level.
+	
+	store = TieredCursorStore('archive', LocalCursorStore(), 
+							  MemcacheCursorStore(), DatastoreCursorStore())
+	'''
+	
+	def __init__(self, name, *levels):
+		self.name = name
+		self.levels = levels
+		self.hits = [0] * len(levels)
+		self.misses = 0
+		
+	def get(self, key):
+		for i, level in enumerate(self.levels):
+			persisted_form = level.get(key)
+			if persisted_form is not None:
+				self.hits[i] += 1
+				for upper in self.levels[:i]:
+					upper.set(key, persisted_form)
+				return persisted_form
+		self.misses += 1
+		return None
+	
+	def set(self, key, persisted_form):
+		for level in self.levels:
+			level.set(key, persisted_form)
+			
+	def delete(self, key):
+		for level in self.levels:
+			level.delete(key)
+			
+	def stats(self):
+		stats = {'misses': self.misses}
+		for i, level in enumerate(self.levels):
+			stats['%d_%s_hits' % (i, type(level).__name__)] = self.hits[i]
+		return stats
+
+default_cursor_store = MemcacheCursorStore()
+
 class PagedQuery(object):
 	'''
 	This class is a facade to a db.Query object that offers additional
@@ -57,6 +309,56 @@ class PagedQuery(object):
 	To get a count of the number of pages available with the dataset:
 	num_pages = myPagedQuery.page_count()
 	
+	page_count() runs query.count(), which is O(n) in the number of results
+	and capped at 1000. If the number of results is maintained elsewhere 
+	(eg. by a counter), pass a function returning it instead:
+	
+	myPagedQuery = PagedQuery(myQuery, 10, count_source=myCounterFunction)
+	
+	Cursor Walk: By default a page without a known cursor is fetched with an
+	offset, and the datastore reads and discards every skipped result. With
+	cursor_walk=True, PagedQuery instead hops from the nearest page with a
+	known cursor to the requested one using keys only queries, recording the
+	cursor of every page on the way:
+	
+	myPagedQuery = PagedQuery(myQuery, 10, cursor_walk=True)
+	
+	Page Tokens: After fetching a page, next_page_token() and
+	prev_page_token() return opaque strings that identify the adjacent pages
+	together with their cursors. Pass one to fetch_page_by_token() on a later
+	request to fetch that page with a cursor even if memcache lost the cached
+	cursors:
+	
+	myResults = myPagedQuery.fetch_page_by_token(token)
+	
+	Tokens come from the client, so the cursor of a token is only used when
+	no cursor is known for its page, and it is never persisted. Tokens for 
+	pages beyond MAX_TOKEN_PAGE fetch the first page.
+	
+	Read Ahead: With read_ahead=True, fetch_page() fetches the requested page
+	and the one after it in a single RPC. The second page is persisted with
+	the cursors for LOOKAHEAD_TIME seconds and returned without a datastore
+	query if it is requested next. It also tells has_page() whether the next
+	page exists, without a call to page_count():
+	
+	myPagedQuery = PagedQuery(myQuery, 10, read_ahead=True)
+	
+	Cursor Stores: The cursors of a query are persisted in memcache by 
+	default. Any object with get(key), set(key, persisted_form) and 
+	delete(key) methods can be used instead, eg. a TieredCursorStore that 
+	adds an in-process level and a datastore level behind memcache:
+	
+	myPagedQuery = PagedQuery(myQuery, 10, cursor_store=myStore)
+	
+	Since such stores outlive the data, pass a generation number that the 
+	writers of that data change (see caching.Generation, or 
+	caching.DurableGeneration for stores with a datastore level). Persisted 
+	cursors of any other generation are ignored:
+	
+	myPagedQuery = PagedQuery(myQuery, 10, generation=myGeneration.get())
+	
+	The counters of every PagedQuery are summed in paging.metrics.
+	
 	Some necessary implementation details: 
 	
 	Cursor Limits: This class works using the Cursor features introduced in the
@@ -95,12 +397,25 @@ class PagedQuery(object):
 	subsequent pages are cleared from the cache. 
 	'''
 
-	def __init__(self, query, page_size):
+	def __init__(self, query, page_size, count_source=None, cursor_walk=False,
+				 read_ahead=False, cursor_store=None, generation=None):
 		'''
 		Constructor for a paged query.
 		@param query: a google.appengine.ext.db.query object
 		@param page_size: a positive non-zero integer defining the size of 
 		each page.
+		@param count_source: an optional function returning the number of
+		results of the query. When given, page_count() uses it instead of 
+		query.count()
+		@param cursor_walk: If True, pages without a known cursor are reached
+		by walking from the nearest known cursor instead of using an offset.
+		Only available for queries of type db.Query
+		@param read_ahead: If True, each page is fetched together with the 
+		page after it, which is kept for the next request
+		@param cursor_store: where cursors are persisted between requests. 
+		Defaults to memcache
+		@param generation: persisted cursors of another generation are 
+		discarded
 		
 		@raise TypeError: raised if query is not an instance of db.Query or 
 		db.GqlQuery 
@@ -108,8 +423,18 @@ class PagedQuery(object):
 		
 		self._query = query
 		self._page_size = page_size
+		self._count_source = count_source
+		self._cursor_walk = cursor_walk
+		self._read_ahead = read_ahead
+		self._cursor_store = cursor_store or default_cursor_store
+		self._generation = generation
+		self._last_page_number = None
 		self._page_cursors = [None]
+		self._token_cursors = {}
 		self._page_count = None
+		self._lookahead = None
+		self._min_page_count = 0
+		self._max_page_count = None
 		self._id = None
 		self._last_persisted_as = None
 
@@ -119,6 +444,8 @@ class PagedQuery(object):
 		self._num_count_calls = 0
 		self._num_persist = 0
 		self._num_restore = 0
+		self._num_walk_hops = 0
+		self._num_lookahead_hits = 0
 		
 		#find out if we are dealing with another facade object
 		if query.__dict__.has_key('_query'): query_to_check = query._query
@@ -129,6 +456,11 @@ class PagedQuery(object):
 		else: raise TypeError('Query type not supported: '\
 			 + type(query).__name__)
 		
+		if isinstance(query, PagedQuery):
+			self._fingerprint = copy.deepcopy(query._fingerprint)
+		else:
+			self._fingerprint = QueryFingerprint.from_query(query)
+		
 		self._check_page_size(page_size)
 			
 	def fetch_page(self, page_number=1, clear=False):
@@ -151,10 +483,26 @@ class PagedQuery(object):
 		
 		self._check_page_number(page_number)	
 
+		results = self._take_lookahead(page_number)
+		if results is not None:
+			self._last_page_number = page_number
+			self._persist_if_required()
+			return results
+
+		if page_number > 1 and self._cursor_walk\
+			and not self._has_cursor_for_page(page_number):
+			last_page = self._walk_to_page(page_number)
+			if last_page:
+				#the walk ran out of results before reaching the page
+				self._max_page_count = last_page
+				self._last_page_number = page_number
+				self._persist_if_required()
+				return []
+
 		if self._has_cursor_for_page(page_number):
 			offset = 0
 			self._query.with_cursor(self._get_cursor_for_page(page_number))
-			self._num_cursor_queries += 1 
+			self._count('cursor_queries')
 		elif page_number > 1:
 			
 			#if we can not use a cursor, we need to use the offset method
@@ -165,26 +513,76 @@ class PagedQuery(object):
 			offset = (self.page_size * (page_number -1))
 			
 			#record that we did an offset query. Useful for testing
-			self._num_offset_queries += 1
+			self._count('offset_queries')
 		else:
-			self._num_page1_queries += 1
+			self._count('page1_queries')
 			self._query.with_cursor(None)
 			offset= 0
 
-		results = self.fetch(limit=self.page_size, offset=offset)
-		
-		self._update_cursors_with_results(page_number, results)
+		if self._read_ahead:
+			results = self.fetch(limit=2 * self.page_size, offset=offset)
+			ahead = results[self.page_size:]
+			results = results[:self.page_size]
+			self._update_cursors_with_lookahead(page_number, results, ahead)
+		else:
+			results = self.fetch(limit=self.page_size, offset=offset)
+			self._update_cursors_with_results(page_number, results)
+			self._update_page_bounds(page_number, results, 
+									 len(results) < self.page_size)
+		self._last_page_number = page_number
 		
 		self._query.with_cursor(None)
 		self._persist_if_required()
 
 		return results
 	
+	def fetch_page_by_token(self, token):
+		'''Fetches the page identified by a token returned by 
+		next_page_token() or prev_page_token(). Malformed tokens fetch the 
+		first page. The cursor of the token is only used for this request, 
+		and only if no cursor is known for the page.
+		@param token: a page token string
+		@return: A list of all entities on the page
+		'''
+		page_number, cursor = self._parse_page_token(token)
+		if cursor:
+			self.id #force id to be assigned now
+			self._restore_if_required()
+			if not self._has_cursor_for_page(page_number)\
+				and not self._has_lookahead_for_page(page_number):
+				results = self._fetch_page_with_token_cursor(page_number, cursor)
+				if results is not None:
+					return results
+		return self.fetch_page(page_number)
+	
+	def next_page_token(self):
+		'''Returns a token for the page after the last page fetched, or None
+		if the last page fetched was not full (and so is the last page).'''
+		if self._last_page_number is None:
+			return None
+		next_page = self._last_page_number + 1
+		if not self._has_cursor_for_page(next_page)\
+			and not self._has_lookahead_for_page(next_page)\
+			and not self._token_cursors.get(next_page):
+			return None
+		return self._make_page_token(next_page)
+		
+	def prev_page_token(self):
+		'''Returns a token for the page before the last page fetched, or None
+		if the last page fetched was the first.'''
+		if not self._last_page_number or self._last_page_number < 2:
+			return None
+		return self._make_page_token(self._last_page_number - 1)
+	
 	def clear(self):
 		'''Clears the cached data for the current query'''
-		memcache.Client().delete(self._get_memcache_key())
+		self._cursor_store.delete(self._get_memcache_key())
 		self._page_cursors = [None]
+		self._token_cursors = {}
 		self._page_count = None
+		self._lookahead = None
+		self._min_page_count = 0
+		self._max_page_count = None
 		self._last_persisted_as = None
 		self._id = None
 				
@@ -195,14 +593,19 @@ class PagedQuery(object):
 		@warning: The maximum number of pages return is equal to 1000/page_size
 		or the maximum number of pages returned by fetch_page(), whichever is greater.
 		'''
-		if not self._page_count:
+		if self._count_source:
+			#the count source is cheap and more up to date than the cache
+			result_count = self._count_source()
+			(full_pages, remainder) = divmod(result_count, self.page_size)
+			self._page_count = full_pages if remainder == 0 else full_pages + 1
+		elif not self._page_count:
 			result_count = self._query.count()
 			
 			(full_pages, remainder) = divmod(result_count, self.page_size)
 			self._page_count = full_pages if remainder == 0 else full_pages + 1
 			
 			#Record we did a query.count() call 
-			self._num_count_calls += 1
+			self._count('count_calls')
 		return self._page_count 
 				
 	def has_page(self, page_number):
@@ -217,9 +620,17 @@ class PagedQuery(object):
 		has_page(n) == len(fetch_page(n)) > 0'''
 		
 		#we might be able to avoid an unneccesary query.count() if we can see
-		#a cursor already exists for page-number or a higher page.
+		#a cursor already exists for page-number or a higher page, or if the
+		#pages fetched during this request tell us whether it exists.
 		
-		return page_number > 0 and (len(self._page_cursors) > page_number or page_number <= self.page_count())
+		if page_number < 1:
+			return False
+		if len(self._page_cursors) > page_number\
+			or page_number <= self._min_page_count:
+			return True
+		if self._max_page_count is not None:
+			return page_number <= self._max_page_count
+		return page_number <= self.page_count()
 
 	def fetch(self, limit, offset=0):
 		''' executes query against datastore as per db.Query.fetch()
@@ -257,6 +668,7 @@ class PagedQuery(object):
 		self._check_query_type_is('Query')
 		self.clear()
 		self._query = self._query.filter(property_operator, value)
+		self._fingerprint.add_filter(property_operator, value)
 		return self 
 		
 	
@@ -277,6 +689,7 @@ class PagedQuery(object):
 		self._check_query_type_is('Query')
 		self.clear()
 		self._query.order(property)
+		self._fingerprint.add_order(property)
 		return self
 	
 	def ancestor(self, ancestor):
@@ -299,6 +712,7 @@ class PagedQuery(object):
 		self._check_query_type_is('Query')
 		self.clear()
 		self._query.ancestor(ancestor)
+		self._fingerprint.set_ancestor(ancestor)
 		return self
 	
 	def count(self, limit=1000):
@@ -313,6 +727,98 @@ class PagedQuery(object):
 		'''
 		return self._query.count(limit)		
 
+	def _get_last_page_number(self):
+		'''Returns the number of the page last returned by fetch_page() or
+		fetch_page_by_token(), or None if no page was fetched yet'''
+		return self._last_page_number
+	
+	def _make_page_token(self, page_number):
+		'''Returns an opaque token for a page number and its cursor, if known
+		@param page_number: The non-zero positive integer page number
+		@return: a url safe string'''
+		cursor = ''
+		if self._has_cursor_for_page(page_number):
+			cursor = self._get_cursor_for_page(page_number)
+		elif self._token_cursors.get(page_number):
+			cursor = self._token_cursors[page_number]
+		return '%d-%s' % (page_number, cursor)
+	
+	def _parse_page_token(self, token):
+		'''Parses a token made by _make_page_token()
+		@return: a tuple of the page number and cursor (or None)
+		'''
+		try:
+			page_number, cursor = str(token).split('-', 1)
+			page_number = int(page_number)
+		except (ValueError, UnicodeError):
+			return (1, None)
+		if page_number < 1 or page_number > MAX_TOKEN_PAGE:
+			return (1, None)
+		return (page_number, cursor or None)
+	
+	def _fetch_page_with_token_cursor(self, page_number, cursor):
+		'''Fetches a page with the cursor of a page token. The cursor may be
+		forged, so nothing learnt from the fetch is persisted; the cursor of
+		the following page is only kept for next_page_token().
+		@param page_number: The page number of the token
+		@param cursor: The cursor of the token
+		@return: A list of all entities on the page, or None if the cursor
+		is not valid for the query
+		'''
+		try:
+			self._query.with_cursor(cursor)
+			results = self.fetch(limit=self.page_size)
+		except (db.BadValueError, db.BadRequestError, db.BadArgumentError):
+			self._query.with_cursor(None)
+			return None
+		self._count('cursor_queries')
+		self._token_cursors[page_number] = cursor
+		if len(results) == self.page_size:
+			self._token_cursors[page_number + 1] = self._query.cursor()
+		self._update_page_bounds(page_number, results, 
+								 len(results) < self.page_size)
+		self._last_page_number = page_number
+		self._query.with_cursor(None)
+		return results
+	
+	def _keys_only_query(self):
+		'''Returns a keys only copy of the wrapped db.Query, or None if the
+		query can not be copied'''
+		if not isinstance(self._query, db.Query):
+			return None
+		query = copy.copy(self._query)
+		query._keys_only = True
+		return query
+	
+	def _walk_to_page(self, page_number):
+		'''Finds the cursor of page_number by hopping one page at a time from
+		the nearest lower page with a known cursor. Each hop is a keys only
+		query that skips the rest of a page and returns its last key, so no
+		entities are loaded. The cursors of all the pages on the way are 
+		recorded and persisted together with the requested page.
+		@param page_number: The non-zero positive integer page number to 
+		find the cursor for
+		@return: the number of the last page if the walk found that 
+		page_number does not exist, None otherwise
+		'''
+		query = self._keys_only_query()
+		if query is None:
+			return None
+		start = page_number - 1
+		while start > 1 and not self._has_cursor_for_page(start):
+			start -= 1
+		cursor = self._get_cursor_for_page(start) if start > 1 else None
+		for page in range(start, page_number):
+			query.with_cursor(cursor)
+			last_key = query.fetch(1, self.page_size - 1)
+			self._count('walk_hops')
+			if not last_key:
+				#page is not full, so no page after it exists
+				return page
+			cursor = query.cursor()
+			self._set_cursor_for_page(page + 1, cursor)
+		return None
+	
 	def _get_page_size(self):
 		'''Returns the page size set during instantiation or using 
 		set_page_size()
@@ -380,10 +886,11 @@ class PagedQuery(object):
 		return self._id 
 			
 	def _generate_query_id(self):
-		'''Generates a query ID for the PagedQuery from scratch
+		'''Generates a query ID for the PagedQuery from its fingerprint. The 
+		fingerprint is maintained as the query is mutated, so this is cheap.
 		@return: a string ID
 		'''
-		return str(hash(pickle.dumps(self._query,2)))
+		return self._fingerprint.digest()
 		
 			
 	def _check_query_type_is(self, required_query_type):
@@ -445,9 +952,86 @@ class PagedQuery(object):
 			self._set_cursor_for_page(
 						page_number = page_number,
 						cursor = None)
+	def _update_cursors_with_lookahead(self, page_number, results, ahead):
+		'''Updates the cached page cursors and the lookahead page after a 
+		read ahead fetch. The query cursor then points after the lookahead 
+		page, so no cursor is learnt for the page after page_number.
+		@param page_number: non-zero positive integer page number that 
+		generated the results.
+		@param results: List of entities on the page
+		@param ahead: List of entities on the following page
+		@return: Nothing
+		'''
+		if len(ahead) == self.page_size:
+			self._set_cursor_for_page(
+						page_number = page_number + 2,
+						cursor = self._query.cursor())
+		elif len(results) == 0:
+			self._set_cursor_for_page(
+						page_number = page_number,
+						cursor = None)
+		if ahead:
+			self._lookahead = {
+				'page': page_number + 1,
+				'results': ahead,
+				'last': len(ahead) < self.page_size,
+				'expires': time.time() + LOOKAHEAD_TIME
+				}
+			self._update_page_bounds(page_number + 1, ahead, 
+									 len(ahead) < self.page_size)
+		else:
+			self._lookahead = None
+			self._update_page_bounds(page_number, results, True)
+	
+	def _update_page_bounds(self, page_number, results, last):
+		'''Records what a fetched page tells about the number of pages. 
+		The bounds are only kept for the current request.
+		@param page_number: the page the results belong to
+		@param results: List of entities on the page
+		@param last: True if no page follows the results
+		'''
+		if results:
+			self._min_page_count = max(self._min_page_count, page_number)
+		if last:
+			self._max_page_count = page_number if results else page_number - 1
+	
+	def _has_lookahead_for_page(self, page_number):
+		'''Returns True if a page fetched ahead is available for page_number
+		'''
+		return bool(self._lookahead) \
+			and self._lookahead['page'] == page_number\
+			and self._lookahead['expires'] > time.time()
+	
+	def _take_lookahead(self, page_number):
+		'''Returns the results of page_number if they were fetched ahead by
+		an earlier fetch_page() call, or None. The lookahead page is dropped
+		once it is returned.
+		@param page_number: The page number requested
+		@return: a list of entities or None
+		'''
+		if not self._has_lookahead_for_page(page_number):
+			return None
+		lookahead = self._lookahead
+		self._lookahead = None
+		self._count('lookahead_hits')
+		self._update_page_bounds(page_number, lookahead['results'], 
+								 lookahead['last'])
+		return lookahead['results']
+	
+	def _count(self, counter):
+		'''Increments the counter self._num_<counter> of this query and its
+		process wide total in metrics.
+		@param counter: name of the counter, eg. 'offset_queries'
+		'''
+		name = '_num_' + counter
+		setattr(self, name, getattr(self, name) + 1)
+		metrics.increment(counter)
+	
 	def _persist_if_required(self):
 		'''Persists the persistable cached elements of the object for retrieval
-		in a separate request only if conditions are appropriate. 
+		in a separate request only if conditions are appropriate. The cursors
+		and the lookahead page are written together, so a fetch costs at 
+		most one memcache write.
 		@return: nothing
 		'''
 		persisted_form = self._get_persisted_form()
@@ -459,12 +1043,12 @@ class PagedQuery(object):
 			self._last_persisted_as = persisted_form
 			
 	def _persist(self, persisted_form):
-		'''Persists the provided persisted form to the memcache peristence layer
+		'''Persists the provided persisted form to the cursor store
 		@param persisted_form: object to persist
 		@return: nothing
 		''' 
-		memcache.Client().set(self._get_memcache_key(), persisted_form)
-		self._num_persist += 1
+		self._cursor_store.set(self._get_memcache_key(), persisted_form)
+		self._count('persist')
 			
 	def _restore_if_required(self):
 		'''Restores the persisted version of the PagedQuery if required.
@@ -477,12 +1061,17 @@ class PagedQuery(object):
 		within the query and returns the persisted form
 		@return: The persisted form 
 		'''
-		persisted_form = memcache.Client().get(self._get_memcache_key())
+		persisted_form = self._cursor_store.get(self._get_memcache_key())
 		
+		if persisted_form\
+			and persisted_form.get('generation') != self._generation:
+			#cursors persisted before the data changed
+			persisted_form = None
 		if persisted_form:
 			self._page_cursors = [s for s in persisted_form['page_cursors']]
 			self._page_count = persisted_form['page_count']
-			self._num_restore += 1
+			self._lookahead = persisted_form.get('lookahead')
+			self._count('restore')
 		return persisted_form
 	
 	def _get_memcache_key(self):
@@ -498,13 +1087,18 @@ class PagedQuery(object):
 		'''
 		return {
 			'page_cursors':[s for s in self._page_cursors],
-			'page_count':self._page_count
+			'page_count':self._page_count,
+			'lookahead':self._lookahead,
+			'generation':self._generation
 			}
 									
 	page_size = property(fget=_get_page_size, fset=_set_page_size, 
 						doc='Configured page size of the PagedQuery')
 
 	id = property(fget=_get_query_id, doc='unique id of this query')
+	
+	last_page_number = property(fget=_get_last_page_number, 
+						doc='Number of the page last fetched')
 
 
 class PageLinks:
@@ -0,0 +1,101 @@
+'''
+This module contains the template loader used by the request handlers.
+
+webapp's template.render() only caches the template it is given. Its
+{% extends %} parents are read from disk and compiled again by every render,
+because rendering a child template merges the child's blocks into the
+compiled parent. A page at the end of the public -> home -> post -> base
+chain therefore compiles three templates per request.
+
+This loader compiles each template together with its own private copy of its
+parent chain, merges the blocks once, as ExtendsNode.render would on every
+render, and keeps the merged root template for the life of the process.
+Rendering is then a single walk over already compiled nodes.
+
+USAGE:
+
+self.response.out.write(rendering.render('home.html', template_values))
+'''
+import os
+
+# Importing webapp's template module configures django's settings.
+from google.appengine.ext.webapp import template
+
+from django.template import Context
+from django.template import Template
+from django.template import TextNode
+from django.template.loader_tags import BlockNode
+from django.template.loader_tags import ExtendsNode
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+
+_compiled = {}
+
+def path(name):
+    '''Returns the file system path of the template called name.'''
+    return os.path.join(TEMPLATE_DIR, name)
+
+def _read(name):
+    f = open(path(name))
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def _extends(compiled):
+    '''Returns the ExtendsNode of compiled, or None if it extends nothing.
+    Like {% extends %} itself, it has to be the first node that is not
+    text.'''
+    for node in compiled.nodelist:
+        if not isinstance(node, TextNode):
+            if isinstance(node, ExtendsNode):
+                return node
+            break
+    return None
+
+def _merge(extends, parent):
+    '''Merges the blocks of the template starting with the ExtendsNode
+    extends into its compiled parent, the way ExtendsNode.render does.'''
+    parent_extends = _extends(parent)
+    parent_blocks = dict([(n.name, n) for n in
+                          parent.nodelist.get_nodes_by_type(BlockNode)])
+    for block_node in extends.nodelist.get_nodes_by_type(BlockNode):
+        parent_block = parent_blocks.get(block_node.name)
+        if parent_block is None:
+            # The block may be defined further up the chain.
+            if parent_extends:
+                parent_extends.nodelist.append(block_node)
+        else:
+            parent_block.parent = block_node.parent
+            parent_block.add_parent(parent_block.nodelist)
+            parent_block.nodelist = block_node.nodelist
+
+def compile_chain(name):
+    '''Compiles the template called name and its whole extends chain, and
+    returns the root template of the chain with every block merged in.'''
+    compiled = Template(_read(name), None, name)
+    extends = _extends(compiled)
+    while extends:
+        parent = Template(_read(extends.parent_name), None, extends.parent_name)
+        _merge(extends, parent)
+        compiled = parent
+        extends = _extends(compiled)
+    return compiled
+
+def get(name):
+    '''Returns the compiled template called name, compiling it on first
+    use.'''
+    compiled = _compiled.get(name)
+    if compiled is None:
+        compiled = _compiled[name] = compile_chain(name)
+    return compiled
+
+def render(name, context):
+    '''Renders the template called name with the dict context.'''
+    return get(name).render(Context(context))
+
+def warm_up():
+    '''Compiles every template, so that no request pays for it.'''
+    for name in sorted(os.listdir(TEMPLATE_DIR)):
+        if not name.startswith('.'):
+            get(name)
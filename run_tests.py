@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+'''
+Runs the unit tests in tests/ against the stubs of the App Engine SDK.
+
+USAGE:
+
+python run_tests.py SDK_PATH [PATTERN]
+
+SDK_PATH is the google_appengine directory of the SDK. PATTERN selects the
+test modules to run, test_*.py by default.
+'''
+import os
+import sys
+import unittest
+
+def main(argv):
+    if len(argv) < 2:
+        print __doc__
+        return 2
+    sdk_path = argv[1]
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    # The app is written against the SDK's default Django, 0.96.
+    sys.path = [path for path in sys.path if 'django' not in path]
+    sys.path.insert(0, os.path.join(sdk_path, 'lib', 'django-0.96'))
+    root = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, root)
+    pattern = len(argv) > 2 and argv[2] or 'test_*.py'
+    suite = unittest.TestLoader().discover(os.path.join(root, 'tests'), pattern)
+    result = unittest.TextTestRunner(verbosity=2).run(suite)
+    return not result.wasSuccessful()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
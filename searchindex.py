@@ -0,0 +1,400 @@
+'''
+This module contains an inverted bigram index for full text search.
+
+Each bigram has one posting list: the sorted ids of every document that
+contains it. Posting lists are stored as packed arrays of 64 bit ids. A
+PostingList entity holds the ids below the first shard boundary and, once
+a list grows past SHARD_SIZE ids, the rest is split into PostingShard child
+entities that each cover a contiguous range of ids. The boundaries are kept
+in the PostingList so a reader can tell which shard holds an id without
+loading any of them.
+
+Queries start from the rarest bigram and intersect it with the posting
+lists of the others in order of increasing length. Intersections gallop
+through the longer list and only load the shards that the remaining
+candidates fall into, so the cost is driven by the rarest bigram rather
+than by the size of the corpus.
+
+Ranked queries score documents by the summed idf of the query bigrams they
+contain and keep only the best k. Posting lists are read from the rarest
+(highest idf) up; once the k-th best score can not be beaten by a document
+that has not been seen yet, the remaining lists are only probed for the
+documents that are still in the running.
+
+Index changes are not written to the posting lists one document at a time,
+which would run a transaction per bigram of every document and make every
+document contend on the lists of common bigrams. queue_postings() records
+the changes of a document in a PendingPostings entity of its own, and
+flush_postings() later applies the queued changes of many documents with
+one transaction per bigram.
+
+The helpers at the top of the module work on plain sorted lists and do not
+touch the datastore.
+'''
+import bisect
+import heapq
+import math
+import struct
+import time
+
+from google.appengine.ext import db
+
+# Maximum number of ids kept in a single PostingList or PostingShard.
+SHARD_SIZE = 2000
+
+# Maximum number of documents whose queued changes one flush applies.
+FLUSH_BATCH_SIZE = 100
+
+# Slack allowed for rounding when comparing score bounds. Bounds are sums of
+# the same weights taken in a different order than the scores themselves.
+SCORE_EPSILON = 1e-9
+
+def pack_ids(ids):
+    '''Packs a sorted list of integer ids into a compact string.'''
+    return struct.pack('>%dq' % len(ids), *ids)
+
+def unpack_ids(blob):
+    '''Unpacks a string created by pack_ids() into a list of ids.'''
+    if not blob:
+        return []
+    return list(struct.unpack('>%dq' % (len(blob) // 8), blob))
+
+def gallop(ids, target, lo=0):
+    '''Returns the position of the first id in the sorted list ids, at or
+    after lo, that is not less than target. The search probes lo+1, lo+2,
+    lo+4, ... before bisecting, so it is cheap when the answer is near lo.
+    '''
+    n = len(ids)
+    hi = lo
+    step = 1
+    while hi < n and ids[hi] < target:
+        lo = hi + 1
+        hi += step
+        step *= 2
+    return bisect.bisect_left(ids, target, lo, min(hi, n))
+
+def intersect_sorted(candidates, ids):
+    '''Returns the ids present in both sorted lists. candidates should be
+    the shorter of the two.'''
+    result = []
+    i = 0
+    n = len(ids)
+    for doc_id in candidates:
+        i = gallop(ids, doc_id, i)
+        if i == n:
+            break
+        if ids[i] == doc_id:
+            result.append(doc_id)
+    return result
+
+class PostingList(db.Model):
+    "The posting list of one bigram. The key name is made by key_name()."
+
+    count = db.IntegerProperty(default=0)
+    "The number of documents in the posting list."
+
+    doc_ids = db.BlobProperty()
+    "Packed ids below the first shard boundary."
+
+    shard_starts = db.ListProperty(long, indexed=False)
+    "The smallest id covered by each shard, in increasing order."
+
+    shard_names = db.StringListProperty(indexed=False)
+    "The key names of the shards, parallel to shard_starts."
+
+    next_shard = db.IntegerProperty(default=0, indexed=False)
+    "Counter used to name new shards."
+
+    @staticmethod
+    def key_name(bigram):
+        return "b_%s" % bigram
+
+    def shard_index(self, doc_id):
+        '''Returns the index of the shard covering doc_id, or -1 if the id
+        belongs in this entity.'''
+        return bisect.bisect_right(self.shard_starts, doc_id) - 1
+
+    def shard_key(self, index):
+        return db.Key.from_path('PostingShard', self.shard_names[index],
+                                parent=self.key())
+
+class PostingShard(db.Model):
+    "A range of a PostingList that has grown past SHARD_SIZE ids."
+
+    doc_ids = db.BlobProperty()
+    "Packed ids covered by this shard."
+
+class PendingPostings(db.Model):
+    """Posting changes of one document waiting for flush_postings(). The key
+    name is made by key_name()."""
+
+    added = db.StringListProperty(indexed=False)
+    "Bigrams whose posting lists the document is to be added to."
+
+    removed = db.StringListProperty(indexed=False)
+    "Bigrams whose posting lists the document is to be removed from."
+
+    version = db.IntegerProperty(default=0, indexed=False)
+    """Incremented by every queue_postings(), so that a flush only deletes
+    the changes it applied."""
+
+    @staticmethod
+    def key_name(doc_id):
+        return "d_%d" % doc_id
+
+    def doc_id(self):
+        return long(self.key().name()[2:])
+
+def _get_heads(bigrams):
+    bigrams = list(bigrams)
+    heads = PostingList.get_by_key_name(
+                [PostingList.key_name(b) for b in bigrams])
+    return dict(zip(bigrams, heads))
+
+def _get_blocks(head, indexes):
+    '''Returns a dict of shard index to block (the head itself for -1)'''
+    blocks = {-1: head}
+    wanted = [i for i in sorted(set(indexes)) if i >= 0]
+    if wanted:
+        shards = db.get([head.shard_key(i) for i in wanted])
+        blocks.update(zip(wanted, shards))
+    return blocks
+
+def _update_txn(bigram, added, removed):
+    key_name = PostingList.key_name(bigram)
+    head = PostingList.get_by_key_name(key_name)
+    if head is None:
+        if not added:
+            return
+        head = PostingList(key_name=key_name)
+    groups = {}
+    for doc_id in added:
+        groups.setdefault(head.shard_index(doc_id), (set(), set()))[0].add(doc_id)
+    for doc_id in removed:
+        groups.setdefault(head.shard_index(doc_id), (set(), set()))[1].add(doc_id)
+    blocks = _get_blocks(head, groups.keys())
+    to_put = []
+    to_delete = []
+    # Highest shards first, so that inserting or deleting shards does not
+    # move the ones still to be updated.
+    for index in sorted(groups.keys(), reverse=True):
+        block = blocks[index]
+        if block is None:
+            continue
+        adds, removes = groups[index]
+        old_ids = unpack_ids(block.doc_ids)
+        ids = sorted((set(old_ids) | adds) - removes)
+        head.count += len(ids) - len(old_ids)
+        if block is not head and not ids:
+            del head.shard_starts[index]
+            del head.shard_names[index]
+            to_delete.append(block.key())
+            continue
+        # Split blocks that overflow into pieces of half a shard, moving all
+        # but the first into new shards that follow the block.
+        half = SHARD_SIZE // 2
+        pieces = [ids]
+        if len(ids) > SHARD_SIZE:
+            pieces = [ids[i:i + half] for i in range(0, len(ids), half)]
+        for j, piece in enumerate(pieces[1:]):
+            shard_name = 's%d' % head.next_shard
+            head.next_shard += 1
+            head.shard_starts.insert(index + 1 + j, piece[0])
+            head.shard_names.insert(index + 1 + j, shard_name)
+            to_put.append(PostingShard(key_name=shard_name, parent=head,
+                                       doc_ids=db.Blob(pack_ids(piece))))
+        block.doc_ids = db.Blob(pack_ids(pieces[0]))
+        if block is not head:
+            to_put.append(block)
+    if head.count == 0:
+        db.delete([head.shard_key(i) for i in range(len(head.shard_names))]
+                  + to_delete + [head])
+        return
+    db.put([head] + to_put)
+    if to_delete:
+        db.delete(to_delete)
+
+def invert_changes(changes):
+    '''Turns a dict of doc_id to (added, removed) bigrams into a dict of
+    bigram to (added, removed) doc ids, as taken by update_postings_multi().
+    '''
+    postings = {}
+    for doc_id, (added, removed) in changes.iteritems():
+        for bigram in added:
+            postings.setdefault(bigram, ([], []))[0].append(doc_id)
+        for bigram in removed:
+            postings.setdefault(bigram, ([], []))[1].append(doc_id)
+    return postings
+
+def update_postings_multi(postings, deadline=None):
+    '''Applies the changes of many documents at once, with one transaction
+    per bigram. postings is a dict of bigram to (added, removed) doc ids as
+    returned by invert_changes(). Bigrams are removed from the dict as they
+    are applied; if deadline (a time.time() value) passes, the call returns
+    early and the rest can be applied by another call.'''
+    for bigram in sorted(postings.keys()):
+        if deadline is not None and time.time() > deadline:
+            return
+        added, removed = postings[bigram]
+        db.run_in_transaction(_update_txn, bigram, added, removed)
+        del postings[bigram]
+
+def queue_postings(doc_id, added=(), removed=()):
+    '''Queues adding doc_id to the posting lists of the bigrams in added and
+    removing it from those in removed, until the next flush_postings().
+    Changes queued for the same document are merged, the later ones
+    winning.'''
+    added = set(added)
+    removed = set(removed)
+    if not added and not removed:
+        return
+    key_name = PendingPostings.key_name(doc_id)
+    def queue_txn():
+        pending = PendingPostings.get_by_key_name(key_name)
+        if pending is None:
+            pending = PendingPostings(key_name=key_name)
+        pending.added = sorted(added | (set(pending.added) - removed))
+        pending.removed = sorted(removed | (set(pending.removed) - added))
+        pending.version += 1
+        pending.put()
+    db.run_in_transaction(queue_txn)
+
+def _delete_pending_txn(key, version):
+    pending = PendingPostings.get(key)
+    if pending is not None and pending.version == version:
+        pending.delete()
+
+def flush_postings(deadline=None):
+    '''Applies the queued changes of up to FLUSH_BATCH_SIZE documents, with
+    one transaction per bigram. Applying changes is idempotent, so changes
+    are only dequeued once all of them are in place, and only if they were
+    not queued again meanwhile. Returns the number of documents whose
+    changes were applied, or None if deadline (a time.time() value) passed
+    first.'''
+    pending = PendingPostings.all().fetch(FLUSH_BATCH_SIZE)
+    changes = dict([(p.doc_id(), (p.added, p.removed)) for p in pending])
+    postings = invert_changes(changes)
+    update_postings_multi(postings, deadline)
+    if postings:
+        return None
+    for p in pending:
+        db.run_in_transaction(_delete_pending_txn, p.key(), p.version)
+    return len(pending)
+
+def _intersect_head(head, candidates):
+    '''Intersects the sorted candidates with the posting list of head,
+    loading only the shards the candidates fall into.'''
+    groups = {}
+    for doc_id in candidates:
+        groups.setdefault(head.shard_index(doc_id), []).append(doc_id)
+    blocks = _get_blocks(head, groups.keys())
+    result = []
+    for index in sorted(groups.keys()):
+        block = blocks[index]
+        if block is not None:
+            result.extend(intersect_sorted(groups[index],
+                                           unpack_ids(block.doc_ids)))
+    return result
+
+def _all_ids(head):
+    ids = unpack_ids(head.doc_ids)
+    if head.shard_names:
+        for shard in db.get([head.shard_key(i)
+                             for i in range(len(head.shard_names))]):
+            if shard is not None:
+                ids.extend(unpack_ids(shard.doc_ids))
+    return ids
+
+def lookup(bigrams):
+    '''Returns the sorted ids of the documents that contain every one of
+    the bigrams. Every document would match an empty list of bigrams, which
+    the posting lists can not answer, so it returns nothing.'''
+    if not bigrams:
+        return []
+    heads = _get_heads(bigrams).values()
+    if None in heads:
+        return []
+    heads.sort(key=lambda head: head.count)
+    result = _all_ids(heads[0])
+    for head in heads[1:]:
+        if not result:
+            break
+        result = _intersect_head(head, result)
+    return result
+
+def idf(doc_freq, doc_count):
+    '''Returns the BM25 inverse document frequency of a bigram contained in
+    doc_freq out of doc_count documents.'''
+    return math.log(1.0 + (doc_count - doc_freq + 0.5) / (doc_freq + 0.5))
+
+def make_cursor(scored):
+    '''Returns an opaque cursor string for a (score, id) pair returned by
+    rank(), used to continue a ranked query after that result.'''
+    return '%r_%d' % scored
+
+def parse_cursor(cursor):
+    '''Returns the (score, id) pair encoded by make_cursor(), or None if
+    cursor is empty or malformed.'''
+    try:
+        score, doc_id = cursor.split('_')
+        return (float(score), long(doc_id))
+    except ValueError:
+        return None
+
+def _threshold(scores, k, remaining, after):
+    '''Returns the k-th best score among the documents that are certain to
+    rank after the cursor, or None if there are fewer than k of them.'''
+    if after is None:
+        below = scores.values()
+    else:
+        below = [score for doc_id, score in scores.iteritems()
+                 if (score + remaining + SCORE_EPSILON, doc_id) < after]
+    if len(below) < k:
+        return None
+    return heapq.nlargest(k, below)[-1]
+
+def rank(bigrams, k, doc_count, after=None):
+    '''Returns up to k (score, id) pairs, best first, for the documents that
+    contain any of the bigrams. A document scores the idf of every query
+    bigram it contains; ties are broken by the higher id.
+
+    @param doc_count: the number of indexed documents. It is taken to be at
+    least the largest document frequency of the query bigrams, since a
+    counter of the documents may lag behind the posting lists.
+    @param after: a (score, id) pair as returned by parse_cursor(). Only
+    results that rank after it are returned.
+    '''
+    heads = [head for head in _get_heads(bigrams).values() if head is not None]
+    if not heads:
+        return []
+    heads.sort(key=lambda head: (head.count, head.key().name()))
+    doc_count = max(doc_count, heads[-1].count)
+    weights = [idf(head.count, doc_count) for head in heads]
+    remaining = [sum(weights[i:]) for i in range(len(weights))]
+
+    scores = {}
+    excluded = set()
+    for i, head in enumerate(heads):
+        threshold = _threshold(scores, k, remaining[i], after)
+        if threshold is None or remaining[i] + SCORE_EPSILON >= threshold:
+            # A document not seen so far could still make the top k.
+            ids = _all_ids(head)
+        else:
+            for doc_id, score in scores.items():
+                if score + remaining[i] + SCORE_EPSILON < threshold:
+                    del scores[doc_id]
+            if not scores:
+                break
+            ids = _intersect_head(head, sorted(scores.keys()))
+        for doc_id in ids:
+            if doc_id in excluded:
+                continue
+            score = scores.get(doc_id, 0.0) + weights[i]
+            if after is not None and (score, doc_id) >= after:
+                # Scores only grow, so this document ranks before the cursor.
+                excluded.add(doc_id)
+                scores.pop(doc_id, None)
+            else:
+                scores[doc_id] = score
+    return heapq.nlargest(k, [(score, doc_id)
+                              for doc_id, score in scores.iteritems()])
@@ -1,201 +1,427 @@
-from google.appengine.ext import db
-import string
-    
-class Tag(db.Model):
-    "Google AppEngine model for store of tags."
-    
-    tag = db.StringProperty(required=True)
-    "The actual string value of the tag."
-    
-    added = db.DateTimeProperty(auto_now_add=True)
-    "The date and time that the tag was first added to the datastore."
-    
-    tagged = db.ListProperty(db.Key)
-    "A List of db.Key values for the datastore objects that have been tagged with this tag value."
-    
-    tagged_count = db.IntegerProperty(default=0)
-    "The number of entities in tagged."
-
-    @staticmethod
-    def __key_name(tag_name):
-        return "tag_%s" % tag_name
-    
-    def remove_tagged(self, key):
-        def remove_tagged_txn():
-            if key in self.tagged:
-                self.tagged.remove(key)
-                self.tagged_count -= 1
-                self.put()
-        db.run_in_transaction(remove_tagged_txn)
-        Tag.expire_cached_tags()
-
-    def add_tagged(self, key):
-        def add_tagged_txn():
-            if key not in self.tagged:
-                self.tagged.append(key)
-                self.tagged_count += 1
-                self.put()
-        db.run_in_transaction(add_tagged_txn)
-        Tag.expire_cached_tags()
-    
-    def clear_tagged(self):
-        def clear_tagged_txn():
-            self.tagged = []
-            self.tagged_count = 0
-            self.put()
-        db.run_in_transaction(clear_tagged_txn)
-        Tag.expire_cached_tags()
-        
-    @classmethod
-    def get_by_name(cls, tag_name):
-        return Tag.get_by_key_name(Tag.__key_name(tag_name))
-    
-    @classmethod
-    def get_tags_for_key(cls, key):
-        "Set the tags for the datastore object represented by key."
-        tags = db.Query(Tag).filter('tagged =', key).fetch(1000)
-        return tags
-    
-    @classmethod
-    def get_or_create(cls, tag_name):
-        "Get the Tag object that has the tag value given by tag_value."
-        tag_key_name = Tag.__key_name(tag_name)
-        existing_tag = Tag.get_by_key_name(tag_key_name)
-        if existing_tag is None:
-            # The tag does not yet exist, so create it.
-            def create_tag_txn():
-                new_tag = Tag(key_name=tag_key_name, tag = tag_name)
-                new_tag.put()
-                return new_tag
-            existing_tag = db.run_in_transaction(create_tag_txn)
-        return existing_tag
-    
-    @classmethod
-    def get_tags_by_frequency(cls, limit=1000):
-        """Return a list of Tags sorted by the number of objects to which they have been applied,
-        most frequently-used first.  If limit is given, return only that many tags; otherwise,
-        return all."""
-        tag_list = db.Query(Tag).filter('tagged_count >', 0).order("-tagged_count").fetch(limit)
-            
-        return tag_list
-
-    @classmethod
-    def get_tags_by_name(cls, limit=1000, ascending=True):
-        """Return a list of Tags sorted alphabetically by the name of the tag.
-        If a limit is given, return only that many tags; otherwise, return all.
-        If ascending is True, sort from a-z; otherwise, sort from z-a."""
-
-        from google.appengine.api import memcache
-
-        cache_name = 'tags_by_name'
-        if ascending:
-            cache_name += '_asc'
-        else:
-            cache_name += '_desc'
-            
-        tags = memcache.get(cache_name)
-        if tags is None or len(tags) < limit:
-            order_by = "tag"
-            if not ascending:
-                order_by = "-tag"
-            
-            tags = db.Query(Tag).order(order_by).fetch(limit)
-            memcache.add(cache_name, tags, 3600)
-        else:
-            if len(tags) > limit:
-                # Return only as many as requested.
-                tags = tags[:limit]
-                
-        return tags
-        
-    
-    @classmethod
-    def popular_tags(cls, limit=5):
-        from google.appengine.api import memcache
-        
-        tags = memcache.get('popular_tags')
-        if tags is None:
-            tags = Tag.get_tags_by_frequency(limit)
-            memcache.add('popular_tags', tags, 3600)
-        
-        return tags
-
-    @classmethod
-    def expire_cached_tags(cls):
-        from google.appengine.api import memcache
-        
-        memcache.delete('popular_tags')
-        memcache.delete('tags_by_name_asc')
-        memcache.delete('tags_by_name_desc')
-
-class Taggable:
-    """A mixin class that is used for making Google AppEnigne Model classes taggable.
-        Usage:
-            class Post(db.Model, taggable.Taggable):
-                body = db.TextProperty(required = True)
-                title = db.StringProperty()
-                added = db.DateTimeProperty(auto_now_add=True)
-                edited = db.DateTimeProperty()
-            
-                def __init__(self, parent=None, key_name=None, app=None, **entity_values):
-                    db.Model.__init__(self, parent, key_name, app, **entity_values)
-                    taggable.Taggable.__init__(self)
-    """
-    
-    def __init__(self):
-        self.__tags = None
-        self.tag_separator = ","
-        """The string that is used to separate individual tags in a string
-        representation of a list of tags.  Used by tags_string() to join the tags
-        into a string representation and tags setter to split a string into
-        individual tags."""
-
-    def __get_tags(self):
-        "Get a List of Tag objects for all Tags that apply to this object."
-        if self.__tags is None or len(self.__tags) == 0:
-            self.__tags = Tag.get_tags_for_key(self.key())
-        return self.__tags
-
-    def __set_tags(self, tags):
-        import types
-        if type(tags) is types.UnicodeType:
-            # Convert unicode to a plain string
-            tags = str(tags)
-        if type(tags) is types.StringType:
-            # Tags is a string, split it on tag_seperator into a list
-            tags = string.split(tags, self.tag_separator)
-        if type(tags) is types.ListType:
-            self.__get_tags()
-            # Firstly, we will check to see if any tags have been removed.
-            # Iterate over a copy of __tags, as we may need to modify __tags
-            for each_tag in self.__tags[:]:
-                if each_tag not in tags:
-                    # A tag that was previously assigned to this entity is
-                    # missing in the list that is being assigned, so we
-                    # disassocaite this entity and the tag.
-                    each_tag.remove_tagged(self.key())
-                    self.__tags.remove(each_tag)
-            # Secondly, we will check to see if any tags have been added.
-            for each_tag in tags:
-                each_tag = string.strip(each_tag)
-                if len(each_tag) > 0 and each_tag not in self.__tags:
-                    # A tag that was not previously assigned to this entity
-                    # is present in the list that is being assigned, so we
-                    # associate this entity with the tag.
-                    tag = Tag.get_or_create(each_tag)
-                    tag.add_tagged(self.key())
-                    self.__tags.append(tag)
-        else:
-            raise Exception, "tags must be either a unicode, a string or a list"
-        
-    tags = property(__get_tags, __set_tags, None, None)
-    
-    def tags_string(self):
-        "Create a formatted string version of this entity's tags"
-        to_str = ""
-        for each_tag in self.tags:
-            to_str += each_tag.tag
-            if each_tag != self.tags[-1]:
-                to_str += self.tag_separator
-        return to_str
-    
+from google.appengine.api import memcache
+from google.appengine.ext import db
+import bisect
+import counters
+import heapq
+import string
+
+# Minimum number of seconds between two writes of Tag.tagged_count
+COUNT_REFRESH_TIME = 60
+
+# Memcache key of the tag cloud, the list of Tags sorted by name
+TAG_CLOUD_KEY = 'tag_cloud'
+
+# Maximum number of Tags in the tag cloud
+TAG_CLOUD_SIZE = 1000
+
+# Number of compare-and-set attempts before a patch drops the tag cloud
+CAS_RETRIES = 3
+
+class Tag(db.Model):
+    "Google AppEngine model for store of tags."
+    
+    tag = db.StringProperty(required=True)
+    "The actual string value of the tag."
+    
+    added = db.DateTimeProperty(auto_now_add=True)
+    "The date and time that the tag was first added to the datastore."
+    
+    tagged = db.ListProperty(db.Key)
+    """Legacy list of the db.Key values of the tagged datastore objects. It is
+    moved into TagMembership entities by migrate_tagged(), which is left to
+    the backfill job since the list may be long. Requests only move the key
+    they change, with forget_tagged()."""
+    
+    tagged_count = db.IntegerProperty(default=0)
+    """The number of tagged entities, copied from the sharded counter at most
+    every COUNT_REFRESH_TIME seconds. Use count() for the current value."""
+
+    @staticmethod
+    def __key_name(tag_name):
+        return "tag_%s" % tag_name
+    
+    @classmethod
+    def key_for_name(cls, tag_name):
+        return db.Key.from_path('Tag', Tag.__key_name(tag_name))
+    
+    def counter_name(self):
+        return "Tag.%s" % self.tag
+    
+    def membership_key(self, key):
+        return db.Key.from_path('TagMembership', self.key().name(), parent=key)
+    
+    def count(self):
+        "The number of tagged entities."
+        return counters.get_or_seed(self.counter_name(),
+            lambda: TagMembership.all(keys_only=True).filter('tag =', self).count(None))
+    
+    @classmethod
+    def refresh_counts(cls, tags):
+        """Copies the counters of tags into their tagged_count, except for tags
+        whose count was copied in the last COUNT_REFRESH_TIME seconds."""
+        if not tags:
+            return
+        not_added = memcache.add_multi(dict([('Tag_refresh_%s' % tag.tag, True)
+                                             for tag in tags]), COUNT_REFRESH_TIME)
+        changed = []
+        for tag in tags:
+            if 'Tag_refresh_%s' % tag.tag in not_added:
+                continue
+            count = tag.count()
+            if count != tag.tagged_count:
+                tag.tagged_count = count
+                changed.append(tag)
+        if changed:
+            db.put(changed)
+            Tag.patch_tag_cloud(changed)
+    
+    def migrate_tagged(self):
+        """Moves the keys in the legacy tagged list into TagMembership entities,
+        which are given the tag_membership_fields() of the tagged objects. Keys
+        of objects that no longer exist are dropped."""
+        if not self.tagged:
+            return
+        memberships = []
+        for tagged in db.get(self.tagged):
+            if tagged is not None:
+                memberships.append(TagMembership(key_name=self.key().name(),
+                                                 parent=tagged.key(), tag=self,
+                                                 **tagged.tag_membership_fields()))
+        db.put(memberships)
+        self.tagged = []
+        self.put()
+        counters.seed(self.counter_name(),
+            TagMembership.all(keys_only=True).filter('tag =', self).count(None))
+    
+    def forget_tagged(self, key):
+        """Removes key from the legacy tagged list. The caller gives the entity a
+        TagMembership instead, if it stays tagged."""
+        if key not in self.tagged:
+            return
+        def forget_tagged_txn():
+            tag = Tag.get(self.key())
+            if key in tag.tagged:
+                tag.tagged.remove(key)
+                tag.put()
+            return tag.tagged
+        self.tagged = db.run_in_transaction(forget_tagged_txn)
+
+    def tagged_keys(self, limit=1000):
+        """Returns the keys of the tagged entities, including those still in the
+        legacy tagged list. Legacy keys may belong to deleted entities."""
+        keys = [m.parent() for m in
+                TagMembership.all(keys_only=True).filter('tag =', self).fetch(limit)]
+        listed = set(keys)
+        keys.extend([key for key in self.tagged if key not in listed])
+        return keys[:limit]
+    
+    @classmethod
+    def update_tagged(cls, key, added=(), removed=(), fields={}):
+        """Tags the entity with the given key with the Tags in added and untags it
+        from those in removed. The memberships all belong to the entity's group,
+        so they are changed in a single transaction. New memberships are given
+        the extra fields in the fields dict."""
+        added = list(added)
+        removed = list(removed)
+        if not added and not removed:
+            return
+        for tag in added + removed:
+            tag.forget_tagged(key)
+        memberships = [TagMembership(key_name=tag.key().name(), parent=key, tag=tag,
+                                     **fields)
+                       for tag in added]
+        removed_keys = [tag.membership_key(key) for tag in removed]
+        def update_tagged_txn():
+            existing = db.get([m.key() for m in memberships] + removed_keys)
+            to_put = [m for m, e in zip(memberships, existing) if e is None]
+            to_delete = [k for k, e in zip(removed_keys, existing[len(memberships):])
+                         if e is not None]
+            if to_put:
+                db.put(to_put)
+            if to_delete:
+                db.delete(to_delete)
+            return ([m.key().name() for m in to_put], [k.name() for k in to_delete])
+        put_names, deleted_names = db.run_in_transaction(update_tagged_txn)
+        changed = []
+        for tag in added:
+            if tag.key().name() in put_names:
+                counters.increment(tag.counter_name())
+                changed.append(tag)
+        for tag in removed:
+            if tag.key().name() in deleted_names:
+                counters.increment(tag.counter_name(), -1)
+                changed.append(tag)
+        Tag.refresh_counts(changed)
+    
+    def remove_tagged(self, key):
+        Tag.update_tagged(key, removed=[self])
+
+    def add_tagged(self, key):
+        Tag.update_tagged(key, added=[self])
+    
+    def clear_tagged(self):
+        self.tagged = []
+        while True:
+            keys = TagMembership.all(keys_only=True).filter('tag =', self).fetch(500)
+            if not keys:
+                break
+            db.delete(keys)
+        counters.seed(self.counter_name(), 0)
+        self.tagged_count = 0
+        self.put()
+        Tag.patch_tag_cloud([self])
+        
+    @classmethod
+    def get_by_name(cls, tag_name):
+        return Tag.get_by_key_name(Tag.__key_name(tag_name))
+    
+    @classmethod
+    def get_tags_for_key(cls, key):
+        "Get the tags for the datastore object represented by key."
+        tag_keys = [db.Key.from_path('Tag', m.name()) for m in
+                    TagMembership.all(keys_only=True).ancestor(key).fetch(1000)]
+        if not tag_keys:
+            # The tags may still be in legacy lists that were not migrated.
+            return db.Query(Tag).filter('tagged =', key).fetch(1000)
+        return [tag for tag in db.get(tag_keys) if tag is not None]
+    
+    @classmethod
+    def get_or_create(cls, tag_name):
+        "Get the Tag object that has the tag value given by tag_value."
+        tag_key_name = Tag.__key_name(tag_name)
+        existing_tag = Tag.get_by_key_name(tag_key_name)
+        if existing_tag is None:
+            # The tag does not yet exist, so create it.
+            def create_tag_txn():
+                new_tag = Tag(key_name=tag_key_name, tag = tag_name)
+                new_tag.put()
+                return new_tag
+            existing_tag = db.run_in_transaction(create_tag_txn)
+            Tag.patch_tag_cloud([existing_tag])
+        return existing_tag
+    
+    @classmethod
+    def get_or_create_multi(cls, tag_names):
+        "Get the Tag objects for every tag value in tag_names, creating the missing ones."
+        tags = Tag.get_by_key_name([Tag.__key_name(name) for name in tag_names])
+        created = []
+        for i, name in enumerate(tag_names):
+            if tags[i] is None:
+                # Another request may be creating the same tag, so check
+                # again in a transaction rather than overwriting it.
+                def create_tag_txn():
+                    tag = Tag.get_by_key_name(Tag.__key_name(name))
+                    if tag is not None:
+                        return tag, False
+                    tag = Tag(key_name=Tag.__key_name(name), tag=name)
+                    tag.put()
+                    return tag, True
+                tags[i], was_created = db.run_in_transaction(create_tag_txn)
+                if was_created:
+                    created.append(tags[i])
+        if created:
+            Tag.patch_tag_cloud(created)
+        return tags
+    
+    @classmethod
+    def get_tags_by_frequency(cls, limit=1000):
+        """Return a list of Tags sorted by the number of objects to which they have been applied,
+        most frequently-used first.  If limit is given, return only that many tags; otherwise,
+        return all."""
+        tag_list = db.Query(Tag).filter('tagged_count >', 0).order("-tagged_count").fetch(limit)
+            
+        return tag_list
+
+    @classmethod
+    def tag_cloud(cls):
+        """Return the cached list of Tags sorted by name, holding at most
+        TAG_CLOUD_SIZE tags. Writers patch the cached list as tags are created
+        and counted rather than expiring it."""
+        tags = memcache.get(TAG_CLOUD_KEY)
+        if tags is None:
+            tags = db.Query(Tag).order("tag").fetch(TAG_CLOUD_SIZE)
+            memcache.add(TAG_CLOUD_KEY, tags)
+        return tags
+
+    @classmethod
+    def patch_tag_cloud(cls, tags):
+        """Write new or recounted Tags through to the cached tag cloud. The
+        patch is applied with compare-and-set, so concurrent patches are not
+        lost; if it keeps colliding the cloud is expired instead."""
+        client = memcache.Client()
+        for i in range(CAS_RETRIES):
+            cloud = client.gets(TAG_CLOUD_KEY)
+            if cloud is None:
+                # Nothing to patch, the next read loads the current tags.
+                return
+            full = len(cloud) >= TAG_CLOUD_SIZE
+            names = [tag.tag for tag in cloud]
+            for tag in tags:
+                position = bisect.bisect_left(names, tag.tag)
+                if position < len(names) and names[position] == tag.tag:
+                    cloud[position] = tag
+                elif position < len(names) or not full:
+                    # A full cloud stops at its last name, tags sorting after
+                    # it were never loaded.
+                    names.insert(position, tag.tag)
+                    cloud.insert(position, tag)
+            if client.cas(TAG_CLOUD_KEY, cloud[:TAG_CLOUD_SIZE]):
+                return
+        client.delete(TAG_CLOUD_KEY)
+
+    @classmethod
+    def get_tags_by_name(cls, limit=1000, ascending=True):
+        """Return a list of Tags sorted alphabetically by the name of the tag.
+        If a limit is given, return only that many tags; otherwise, return all.
+        If ascending is True, sort from a-z; otherwise, sort from z-a."""
+
+        tags = Tag.tag_cloud()
+        if len(tags) < TAG_CLOUD_SIZE:
+            # The cloud holds every tag.
+            if not ascending:
+                tags = tags[::-1]
+        elif not ascending or limit > len(tags):
+            order_by = "tag"
+            if not ascending:
+                order_by = "-tag"
+            tags = db.Query(Tag).order(order_by).fetch(limit)
+        return tags[:limit]
+    
+    @classmethod
+    def popular_tags(cls, limit=5):
+        tags = Tag.tag_cloud()
+        if len(tags) < TAG_CLOUD_SIZE:
+            # The cloud holds every tag.
+            return heapq.nlargest(limit, [tag for tag in tags if tag.tagged_count > 0],
+                                  key=lambda tag: tag.tagged_count)
+        cache_name = 'popular_tags_%d' % limit
+        tags = memcache.get(cache_name)
+        if tags is None:
+            tags = Tag.get_tags_by_frequency(limit)
+            memcache.add(cache_name, tags, COUNT_REFRESH_TIME)
+        return tags
+
+    @classmethod
+    def expire_cached_tags(cls):
+        memcache.delete(TAG_CLOUD_KEY)
+
+class TagMembership(db.Expando):
+    """Records that an entity is tagged with a tag. Memberships are children of
+    the tagged entity, keyed by the key name of the Tag, so tagging entities
+    with a popular tag does not contend on a single entity group.
+    
+    Memberships also carry the fields returned by the tagged entity's
+    tag_membership_fields(), so tagged entities can be queried by tag and
+    those fields without an IN filter over their keys."""
+    
+    tag = db.ReferenceProperty(Tag, collection_name='memberships')
+    "The Tag the parent entity is tagged with."
+    
+class Taggable:
+    """A mixin class that is used for making Google AppEnigne Model classes taggable.
+        Usage:
+            class Post(db.Model, taggable.Taggable):
+                body = db.TextProperty(required = True)
+                title = db.StringProperty()
+                added = db.DateTimeProperty(auto_now_add=True)
+                edited = db.DateTimeProperty()
+            
+                def __init__(self, parent=None, key_name=None, app=None, **entity_values):
+                    db.Model.__init__(self, parent, key_name, app, **entity_values)
+                    taggable.Taggable.__init__(self)
+    """
+    
+    def __init__(self):
+        self.__tags = None
+        if not self.is_saved():
+            # Nothing can be tagged with an object before it is saved.
+            self.__tags = []
+        self.__membership_fields = None
+        "The tag_membership_fields() last copied into the memberships."
+        self.tag_separator = ","
+        """The string that is used to separate individual tags in a string
+        representation of a list of tags.  Used by tags_string() to join the tags
+        into a string representation and tags setter to split a string into
+        individual tags."""
+
+    def tag_membership_fields(self):
+        """Returns a dict of the extra fields stored in the TagMembership entities
+        of this object. Override it to make them queryable by those fields, and
+        call update_tag_memberships() whenever they change."""
+        return {}
+    
+    def update_tag_memberships(self):
+        """Copies the current tag_membership_fields() into the memberships of this
+        object. Nothing is read or written when the fields did not change since
+        they were last copied, and only the memberships holding other values
+        are written."""
+        fields = self.tag_membership_fields()
+        if not fields or fields == self.__membership_fields:
+            return
+        if self.__tags is None:
+            memberships = TagMembership.all().ancestor(self.key()).fetch(1000)
+        elif self.__tags:
+            memberships = [m for m in db.get([tag.membership_key(self.key())
+                                              for tag in self.__tags])
+                           if m is not None]
+        else:
+            memberships = []
+        changed = []
+        for membership in memberships:
+            if [name for name, value in fields.items()
+                if getattr(membership, name, None) != value]:
+                for name, value in fields.items():
+                    setattr(membership, name, value)
+                changed.append(membership)
+        if changed:
+            db.put(changed)
+        self.__membership_fields = fields
+
+    def __get_tags(self):
+        "Get a List of Tag objects for all Tags that apply to this object."
+        if self.__tags is None or len(self.__tags) == 0:
+            self.__tags = Tag.get_tags_for_key(self.key())
+        return self.__tags
+
+    def __set_tags(self, tags):
+        import types
+        if type(tags) is types.UnicodeType:
+            # Convert unicode to a plain string
+            tags = str(tags)
+        if type(tags) is types.StringType:
+            # Tags is a string, split it on tag_seperator into a list
+            tags = string.split(tags, self.tag_separator)
+        if type(tags) is types.ListType:
+            tag_names = []
+            for each_tag in tags:
+                each_tag = string.strip(each_tag)
+                if len(each_tag) > 0 and each_tag not in tag_names:
+                    tag_names.append(each_tag)
+            current_tags = self.__get_tags()
+            current_names = [tag.tag for tag in current_tags]
+            # Tags previously assigned to this entity that are missing in the
+            # list being assigned, and tags in the list that were not assigned.
+            removed = [tag for tag in current_tags if tag.tag not in tag_names]
+            added_names = [name for name in tag_names if name not in current_names]
+            if removed or added_names:
+                added = Tag.get_or_create_multi(added_names)
+                fields = self.tag_membership_fields()
+                Tag.update_tagged(self.key(), added, removed, fields)
+                if fields != self.__membership_fields:
+                    # The new memberships hold other fields than the old ones.
+                    self.__membership_fields = None
+                self.__tags = [tag for tag in current_tags if tag.tag in tag_names] + added
+        else:
+            raise Exception, "tags must be either a unicode, a string or a list"
+        
+    tags = property(__get_tags, __set_tags, None, None)
+    
+    def tags_string(self):
+        "Create a formatted string version of this entity's tags"
+        to_str = ""
+        for each_tag in self.tags:
+            to_str += each_tag.tag
+            if each_tag != self.tags[-1]:
+                to_str += self.tag_separator
+        return to_str
+    
@@ -0,0 +1,456 @@
+import base64
+import cgi
+import os
+import unittest
+
+from google.appengine.api import datastore
+from google.appengine.api import users
+from google.appengine.ext import testbed
+
+from webob import Request
+
+import main
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class HandlerTest(unittest.TestCase):
+    "Runs requests through the application on top of the SDK stubs."
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_user_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        self.app = main.make_application()
+        # Profiles cached in process by an earlier test share its key ids.
+        for prop in main.CachedReferenceProperty._properties:
+            prop._cache.clear()
+        self.logout()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def login(self, username):
+        self.testbed.setup_env(USER_EMAIL='%s@example.com' % username,
+                               USER_ID=username, overwrite=True)
+
+    def logout(self):
+        self.testbed.setup_env(USER_EMAIL='', USER_ID='', overwrite=True)
+
+    def signup(self, username):
+        self.login(username)
+        profile = main.UserProfile(username=username, user=users.get_current_user(),
+                                   email='%s@example.com' % username)
+        profile.put()
+        return profile
+
+    def request(self, path, post=None):
+        request = Request.blank(path, POST=post)
+        return request.get_response(self.app)
+
+    def run_tasks(self):
+        "Runs the queued tasks, and the tasks they queue, until none is left."
+        while True:
+            tasks = self.taskqueue.GetTasks('default')
+            if not tasks:
+                return
+            for task in tasks:
+                self.taskqueue.DeleteTask('default', task['name'])
+                params = cgi.parse_qsl(base64.b64decode(task['body']))
+                response = self.request(task['url'], dict(params))
+                self.assertEqual(200, response.status_int)
+
+class ReferenceTest(HandlerTest):
+
+    def entries(self):
+        for username in ('alice', 'bob'):
+            profile = self.signup(username)
+            for i in range(3):
+                main.Entry(user_profile=profile, html='<p>%s</p>' % i).put()
+        return main.Entry.all().fetch(10)
+
+    def test_prefetch_resolves_every_author_in_one_get(self):
+        entries = self.entries()
+        gets = main.Entry.user_profile.datastore_gets
+        main.prefetch_references(entries, 'user_profile')
+        self.assertEqual(gets + 1, main.Entry.user_profile.datastore_gets)
+        self.assertEqual(['alice'] * 3 + ['bob'] * 3,
+                         sorted([entry.user_profile.username for entry in entries]))
+        self.assertEqual(gets + 1, main.Entry.user_profile.datastore_gets)
+
+    def test_authors_are_shared_through_memcache(self):
+        main.prefetch_references(self.entries(), 'user_profile')
+        # A process that has not seen the authors yet.
+        main.Entry.user_profile._cache.clear()
+        gets = main.Entry.user_profile.datastore_gets
+        hits = main.Entry.user_profile.memcache_hits
+        main.prefetch_references(main.Entry.all().fetch(10), 'user_profile')
+        self.assertEqual(gets, main.Entry.user_profile.datastore_gets)
+        self.assertEqual(hits + 2, main.Entry.user_profile.memcache_hits)
+        main.prefetch_references(main.Entry.all().fetch(10), 'user_profile')
+        self.assertEqual(hits + 2, main.Entry.user_profile.memcache_hits)
+
+    def test_invalidate_drops_cached_authors(self):
+        entries = self.entries()
+        main.prefetch_references(entries, 'user_profile')
+        profile = entries[0].user_profile
+        profile.name = 'Renamed'
+        profile.put()
+        main.CachedReferenceProperty.invalidate(profile.key())
+        entry = main.Entry.get(entries[0].key())
+        self.assertEqual('Renamed', entry.user_profile.name)
+
+class SearchTest(HandlerTest):
+
+    def test_finds_posted_entries(self):
+        self.signup('alice')
+        self.request('/post', {'content': 'the quick brown fox'})
+        self.request('/post', {'content': 'a lazy dog'})
+        self.run_tasks()
+        body = self.request('/search?q=brown+fox').body
+        self.assertTrue('quick brown fox' in body)
+        self.assertFalse('lazy dog' in body)
+
+    def test_finds_entries_indexed_before_the_posting_lists(self):
+        profile = self.signup('alice')
+        entry = main.Entry(user_profile=profile)
+        entry.put()
+        entry.setMarkdown('an entry from before the posting lists')
+        entry.put()
+        # The EntryIndex as it was written before it had a version.
+        index = datastore.Entity('EntryIndex', parent=entry.key())
+        index['bigrams'] = list(main.EntryIndex.create_bigram_set(
+            'an entry from before the posting lists'))
+        datastore.Put(index)
+        self.assertTrue('posting lists' in self.request('/search?q=from+before').body)
+        self.assertFalse('posting lists' in self.request('/search?q=from+after').body)
+
+    def test_finds_phrases_without_bigrams(self):
+        self.signup('alice')
+        self.request('/post', {'content': 'plan a b c'})
+        self.request('/post', {'content': 'plan a c b'})
+        self.run_tasks()
+        body = self.request('/search?q=a+b').body
+        self.assertTrue('plan a b c' in body)
+        self.assertFalse('plan a c b' in body)
+
+    def test_phrase_results_are_paged(self):
+        self.signup('alice')
+        for i in range(25):
+            self.request('/post', {'content': 'fox number %d.' % i})
+        self.run_tasks()
+        body = self.request('/search?q=fox+number').body
+        self.assertEqual(10, body.count('fox number'))
+        self.assertTrue('/search?q=fox+number&page=2' in body)
+        self.assertFalse('Previous' in body)
+        body = self.request('/search?q=fox+number&page=3').body
+        self.assertEqual(5, body.count('fox number'))
+        self.assertTrue('/search?q=fox+number&page=2' in body)
+        self.assertFalse('page=4' in body)
+
+    def test_saves_within_the_delay_share_one_index_task(self):
+        self.signup('alice')
+        # A window long enough that both saves fall in the same one.
+        index_delay = main.Entry.INDEX_DELAY
+        main.Entry.INDEX_DELAY = 10 ** 6
+        try:
+            self.request('/post', {'content': 'the first draft'})
+            entry = main.Entry.all().get()
+            self.request('/edit/%s' % entry.key(), {'content': 'the final text'})
+        finally:
+            main.Entry.INDEX_DELAY = index_delay
+        tasks = [task for task in self.taskqueue.GetTasks('default')
+                 if task['url'] == '/worker/searchindex']
+        self.assertEqual(1, len(tasks))
+        self.run_tasks()
+        self.assertTrue('final text' in self.request('/search?q=final+text').body)
+        self.assertFalse('first draft' in self.request('/search?q=first+draft').body)
+
+    def test_index_tasks_flush_their_postings(self):
+        self.signup('alice')
+        self.request('/post', {'content': 'the first entry'})
+        self.request('/post', {'content': 'the second entry'})
+        self.run_tasks()
+        self.assertEqual(2, len(main.searchindex.lookup(['th'])))
+        self.assertEqual(0, main.searchindex.PendingPostings.all().count())
+
+    def test_counts_indexed_documents(self):
+        self.signup('alice')
+        self.request('/post', {'content': 'first entry'})
+        self.request('/post', {'content': 'second entry'})
+        self.run_tasks()
+        self.assertEqual(2, main.EntryIndex.document_count())
+        entry = main.Entry.all().get()
+        self.request('/delete/%s' % entry.key())
+        self.run_tasks()
+        self.assertEqual(1, main.EntryIndex.document_count())
+        body = self.request('/search?q=entry&mode=ranked').body
+        self.assertEqual(1, body.count('entry</p>'))
+
+class ReindexTest(HandlerTest):
+
+    def tearDown(self):
+        main.EntryIndex.VERSION = 1
+        HandlerTest.tearDown(self)
+
+    def test_version_bump_removes_the_old_postings(self):
+        self.signup('alice')
+        self.request('/post', {'content': 'alpha'})
+        self.run_tasks()
+        entry = main.Entry.all().get()
+        self.assertEqual([entry.key().id()], main.searchindex.lookup(['al']))
+        main.EntryIndex.VERSION = 2
+        entry.html = '<p>omega</p>'
+        entry.put()
+        entry.index()
+        self.run_tasks()
+        self.assertEqual([], main.searchindex.lookup(['al']))
+        self.assertEqual([entry.key().id()], main.searchindex.lookup(['om']))
+        self.assertEqual(1, main.EntryIndex.document_count())
+
+    def test_failed_slice_keeps_its_index_writes(self):
+        profile = self.signup('alice')
+        for text in ('first entry', 'second entry'):
+            main.Entry(user_profile=profile, html='<p>%s</p>' % text).put()
+        self.request('/_admin/reindex', {})
+        put = main.db.put
+        def failing_put(models):
+            if [m for m in models if isinstance(m, main.EntryIndex)]:
+                raise main.db.Timeout()
+            return put(models)
+        main.db.put = failing_put
+        try:
+            task = self.taskqueue.GetTasks('default')[0]
+            body = base64.b64decode(task['body'])
+            self.assertEqual(500, self.request(task['url'], dict(cgi.parse_qsl(body))).status_int)
+        finally:
+            main.db.put = put
+        self.run_tasks()
+        for entry in main.Entry.all():
+            self.assertTrue(main.EntryIndex.get_for(entry.key()).is_posted())
+        self.assertEqual(2, len(main.searchindex.lookup(['en'])))
+        self.assertEqual(2, main.EntryIndex.document_count())
+
+class TimelineTest(HandlerTest):
+
+    def test_private_entries_leave_the_timeline_alone(self):
+        self.signup('alice')
+        self.request('/post', {'content': 'a private entry', 'status': 'private'})
+        self.assertEqual(None, main.timeline.Timeline.get_by_key_name('public'))
+        self.request('/post', {'content': 'a public entry'})
+        self.request('/post', {'content': 'another private entry', 'status': 'private'})
+        body = self.request('/').body
+        self.assertTrue('a public entry' in body)
+        self.assertFalse('private entry' in body)
+
+    def test_private_entries_leave_the_timeline(self):
+        self.signup('alice')
+        self.request('/post', {'content': 'soon to be private'})
+        entry = main.Entry.all().get()
+        self.assertTrue('soon to be private' in self.request('/').body)
+        self.request('/edit/%s' % entry.key(),
+                     {'content': 'soon to be private', 'status': 'private'})
+        self.assertFalse('soon to be private' in self.request('/').body)
+
+    def test_long_entries_are_read_past_the_byte_budget(self):
+        budget = main.timeline.MAX_HTML_BYTES
+        main.timeline.MAX_HTML_BYTES = 2500
+        try:
+            self.signup('alice')
+            for word in ('first', 'second', 'third'):
+                self.request('/post', {'content': '%s %s' % (word, 'x' * 1000)})
+            stored = main.timeline.Timeline.get_by_key_name('public').get_entries()
+            self.assertEqual([True, True, False], [e.html is not None for e in stored])
+            body = self.request('/').body
+            for word in ('first', 'second', 'third'):
+                self.assertTrue('%s xxx' % word in body)
+        finally:
+            main.timeline.MAX_HTML_BYTES = budget
+
+class CounterTest(HandlerTest):
+
+    def test_user_counters_follow_posts_edits_and_deletes(self):
+        profile = self.signup('alice')
+        public = main.Entry.user_counter(profile.key(), False)
+        private = main.Entry.user_counter(profile.key(), True)
+        main.counters.seed(public, 0)
+        main.counters.seed(private, 0)
+        self.request('/post', {'content': 'first [#news]'})
+        self.request('/post', {'content': 'second [#news]'})
+        self.assertEqual((2, 0), (main.counters.get_count(public),
+                                  main.counters.get_count(private)))
+        entry = main.Entry.all().get()
+        self.request('/edit/%s' % entry.key(),
+                     {'content': entry.markdown, 'status': 'private'})
+        self.assertEqual((1, 1), (main.counters.get_count(public),
+                                  main.counters.get_count(private)))
+        self.request('/delete/%s' % entry.key())
+        self.assertEqual((1, 0), (main.counters.get_count(public),
+                                  main.counters.get_count(private)))
+        self.assertEqual(1, main.taggable.Tag.get_by_name('news').count())
+
+class EditTest(HandlerTest):
+
+    def test_edits_render_new_fragments(self):
+        self.signup('alice')
+        self.request('/post', {'content': 'the first draft'})
+        entry = main.Entry.all().get()
+        self.assertTrue('first draft' in self.request('/alice').body)
+        body = self.request('/edit/%s' % entry.key(), {'content': 'the final text'}).body
+        self.assertTrue('final text' in body)
+        self.assertFalse('first draft' in body)
+        body = self.request('/alice').body
+        self.assertTrue('final text' in body)
+        self.assertFalse('first draft' in body)
+
+class FragmentTest(HandlerTest):
+
+    def test_deleted_entry_renders_no_fragment(self):
+        self.signup('alice')
+        self.request('/post', {'content': 'soon gone'})
+        entry = main.Entry.all().get()
+        entry.delete()
+        response = self.request('/entry/%s' % entry.key())
+        self.assertEqual(200, response.status_int)
+        self.assertFalse('soon gone' in response.body)
+
+    def test_stale_profiles_do_not_outlive_a_rename(self):
+        profile = self.signup('alice')
+        self.request('/post', {'content': 'an entry'})
+        entry = main.Entry.all().get()
+        self.assertTrue('/alice"' in self.request('/entry/%s' % entry.key()).body)
+        self.request('/settings', {'username': 'alicia', 'email': 'alice@example.com',
+                                   'web': 'http://example.com/'})
+        # Another process still holds the profile from before the rename.
+        main.Entry.user_profile._cache.set(profile.key(), profile)
+        self.assertTrue('/alice"' in self.request('/entry/%s' % entry.key()).body)
+        main.Entry.user_profile._cache.clear()
+        body = self.request('/entry/%s' % entry.key()).body
+        self.assertTrue('/alicia"' in body)
+        self.assertFalse('/alice"' in body)
+
+    def test_fragments_too_large_for_memcache_are_not_cached(self):
+        self.signup('alice')
+        self.request('/post', {'content': 'an entry'})
+        max_value_bytes = main.caching.MAX_VALUE_BYTES
+        main.caching.MAX_VALUE_BYTES = 10
+        try:
+            misses = main.entry_fragments.misses
+            for i in range(2):
+                response = self.request('/alice')
+                self.assertEqual(200, response.status_int)
+                self.assertTrue('an entry' in response.body)
+            self.assertEqual(misses + 2, main.entry_fragments.misses)
+        finally:
+            main.caching.MAX_VALUE_BYTES = max_value_bytes
+
+class TagTest(HandlerTest):
+
+    def test_memberships_follow_edits(self):
+        self.signup('alice')
+        self.request('/post', {'content': 'tagged [#news]'})
+        entry = main.Entry.all().get()
+        self.request('/edit/%s' % entry.key(), {'content': 'edited [#news]'})
+        entry = main.Entry.get(entry.key())
+        membership = main.taggable.TagMembership.all().ancestor(entry).get()
+        self.assertEqual(entry.modified_at, membership.modified_at)
+
+    def test_backfill_completes_legacy_memberships(self):
+        profile = self.signup('alice')
+        listed = main.Entry(user_profile=profile, html='<p>from a tag list</p>')
+        listed.put()
+        migrated = main.Entry(user_profile=profile, html='<p>migrated early</p>')
+        migrated.put()
+        tag = main.taggable.Tag(key_name='tag_news', tag='news', tagged=[listed.key()])
+        tag.put()
+        main.taggable.TagMembership(key_name='tag_news', parent=migrated, tag=tag).put()
+        self.logout()
+        body = self.request('/tag/news').body
+        self.assertFalse('from a tag list' in body)
+        self.assertFalse('migrated early' in body)
+        self.request('/_admin/backfill/tags', {})
+        self.run_tasks()
+        for path in ('/tag/news', '/alice/news'):
+            body = self.request(path).body
+            self.assertTrue('from a tag list' in body)
+            self.assertTrue('migrated early' in body)
+
+class ArchiveTest(HandlerTest):
+
+    def test_anonymous_visitors_see_public_entries(self):
+        self.signup('alice')
+        self.request('/post', {'content': 'a public entry'})
+        self.request('/post', {'content': 'a private entry', 'status': 'private'})
+        self.logout()
+        response = self.request('/alice')
+        self.assertEqual(200, response.status_int)
+        self.assertTrue('public entry' in response.body)
+        self.assertFalse('private entry' in response.body)
+
+class PageCacheTest(HandlerTest):
+
+    def setUp(self):
+        HandlerTest.setUp(self)
+        self.cache = main.pagecache.PageCache(self.app)
+
+    def get(self, path):
+        "Requests path as an anonymous visitor, through the page cache."
+        self.logout()
+        return Request.blank(path).get_response(self.cache).body
+
+    def post(self, username, content, status='public'):
+        self.login(username)
+        self.request('/post', {'content': content, 'status': status})
+
+    def assertCached(self, path, cached=True):
+        hits = main.pagecache.metrics.counts['hits']
+        self.get(path)
+        self.assertEqual(cached, main.pagecache.metrics.counts['hits'] > hits)
+
+    def test_posts_only_invalidate_the_pages_they_change(self):
+        self.signup('alice')
+        self.signup('bob')
+        self.post('bob', 'by bob [#misc]')
+        paths = ['/', '/about', '/alice', '/bob', '/tag/news', '/tag/misc']
+        for path in paths:
+            self.get(path)
+        self.post('alice', 'by alice [#news]')
+        for path in ['/bob', '/about', '/tag/misc']:
+            self.assertCached(path)
+        for path in ['/', '/alice', '/tag/news']:
+            self.assertTrue('by alice' in self.get(path))
+
+    def test_private_posts_leave_site_pages_alone(self):
+        self.signup('alice')
+        for path in ['/', '/tag/news', '/alice']:
+            self.get(path)
+        self.post('alice', 'a secret [#news]', 'private')
+        self.assertCached('/')
+        self.assertCached('/tag/news')
+        self.assertCached('/alice', False)
+
+    def test_pages_too_large_for_memcache_are_served_uncached(self):
+        self.signup('alice')
+        self.post('alice', 'an entry')
+        max_value_bytes = main.caching.MAX_VALUE_BYTES
+        main.caching.MAX_VALUE_BYTES = 100
+        try:
+            self.assertTrue('an entry' in self.get('/'))
+            self.assertCached('/', False)
+        finally:
+            main.caching.MAX_VALUE_BYTES = max_value_bytes
+        self.assertCached('/', False)
+        self.assertCached('/')
+
+class AdminTest(HandlerTest):
+
+    def test_admin_pages_leave_user_pages_alone(self):
+        self.signup('admin')
+        self.request('/post', {'content': 'posted by a user called admin [#news]'})
+        self.assertTrue('called admin' in self.request('/admin').body)
+        self.assertTrue('called admin' in self.request('/admin/rss').body)
+        self.assertTrue('called admin' in self.request('/admin/news').body)
+        self.assertEqual(200, self.request('/_admin/stats').status_int)
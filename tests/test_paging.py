@@ -0,0 +1,234 @@
+import unittest
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+import caching
+import paging
+
+class Item(db.Model):
+    n = db.IntegerProperty()
+
+class PagedQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        db.put([Item(n=n) for n in range(25)])
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def paged_query(self, **kwargs):
+        return paging.PagedQuery(Item.all().order('n'), 5, **kwargs)
+
+    def numbers(self, items):
+        return [item.n for item in items]
+
+class TokenTest(PagedQueryTest):
+
+    def test_tokens_fetch_adjacent_pages(self):
+        pq = self.paged_query()
+        pq.fetch_page(1)
+        pq.fetch_page(2)
+        next_token = pq.next_page_token()
+        prev_token = pq.prev_page_token()
+        memcache.flush_all()
+        self.assertEqual(range(10, 15),
+                         self.numbers(self.paged_query().fetch_page_by_token(next_token)))
+        self.assertEqual(range(0, 5),
+                         self.numbers(self.paged_query().fetch_page_by_token(prev_token)))
+
+    def test_token_cursor_is_not_persisted(self):
+        pq = self.paged_query()
+        pq.fetch_page(1)
+        pq.fetch_page(2)
+        cursor = pq.next_page_token().split('-', 1)[1]
+        memcache.flush_all()
+        forged = '2-' + cursor
+        pq = self.paged_query()
+        pq.fetch_page_by_token(forged)
+        self.assertEqual(2, pq.last_page_number)
+        self.assertEqual(range(15, 20),
+                         self.numbers(self.paged_query().fetch_page_by_token(pq.next_page_token())))
+        # Nothing the forged token led to was stored for page 2 or 3.
+        self.assertEqual(range(5, 10), self.numbers(self.paged_query().fetch_page(2)))
+        self.assertEqual(range(10, 15), self.numbers(self.paged_query().fetch_page(3)))
+
+    def test_known_cursor_wins_over_token(self):
+        pq = self.paged_query()
+        pq.fetch_page(1)
+        pq.fetch_page(2)
+        cursor = pq.next_page_token().split('-', 1)[1]
+        self.assertEqual(range(5, 10),
+                         self.numbers(self.paged_query().fetch_page_by_token('2-' + cursor)))
+
+    def test_huge_page_number_fetches_first_page(self):
+        pq = self.paged_query()
+        self.assertEqual(range(0, 5),
+                         self.numbers(pq.fetch_page_by_token('5000000-x')))
+        self.assertEqual(1, pq.last_page_number)
+        self.assertTrue(len(pq._page_cursors) <= 2)
+
+    def test_invalid_cursor_fetches_page_without_it(self):
+        pq = self.paged_query()
+        self.assertEqual(range(10, 15),
+                         self.numbers(pq.fetch_page_by_token('3-not-a-cursor')))
+        self.assertEqual(3, pq.last_page_number)
+
+class FingerprintTest(PagedQueryTest):
+
+    def test_filter_order_does_not_change_id(self):
+        a = paging.PagedQuery(Item.all().filter('n >', 3).filter('n <', 9), 5)
+        b = paging.PagedQuery(Item.all().filter('n <', 9).filter('n >', 3), 5)
+        self.assertEqual(a.id, b.id)
+
+    def test_orders_and_values_change_id(self):
+        ids = set([
+            paging.PagedQuery(Item.all().order('n'), 5).id,
+            paging.PagedQuery(Item.all().order('-n'), 5).id,
+            paging.PagedQuery(Item.all().filter('n =', 1), 5).id,
+            paging.PagedQuery(Item.all().filter('n =', 2), 5).id,
+            paging.PagedQuery(Item.all().filter('n =', '1'), 5).id,
+            ])
+        self.assertEqual(5, len(ids))
+
+    def test_mutating_methods_match_the_built_query(self):
+        pq = self.paged_query()
+        pq.filter('n >=', 10)
+        built = paging.PagedQuery(Item.all().order('n').filter('n >=', 10), 5)
+        self.assertEqual(built.id, pq.id)
+        self.assertEqual(range(10, 15), self.numbers(pq.fetch_page()))
+
+    def test_in_values_are_unordered(self):
+        a = paging.PagedQuery(Item.all().filter('n IN', [1, 2, 3]), 5)
+        b = paging.PagedQuery(Item.all().filter('n IN', [3, 1, 2]), 5)
+        self.assertEqual(a.id, b.id)
+
+    def test_metrics_sum_query_counters(self):
+        before = paging.metrics.stats()
+        pq = self.paged_query()
+        pq.fetch_page(1)
+        pq.fetch_page(3)
+        after = paging.metrics.stats()
+        self.assertEqual(before.get('page1_queries', 0) + 1,
+                         after['page1_queries'])
+        self.assertEqual(before.get('offset_queries', 0) + 1,
+                         after['offset_queries'])
+
+class CursorWalkTest(PagedQueryTest):
+
+    def test_walk_reaches_deep_pages_without_offsets(self):
+        pq = self.paged_query(cursor_walk=True)
+        self.assertEqual(range(15, 20), self.numbers(pq.fetch_page(4)))
+        self.assertEqual(0, pq._num_offset_queries)
+        self.assertEqual(3, pq._num_walk_hops)
+        pq = self.paged_query(cursor_walk=True)
+        self.assertEqual(range(10, 15), self.numbers(pq.fetch_page(3)))
+        self.assertEqual(0, pq._num_walk_hops)
+        self.assertEqual(1, pq._num_cursor_queries)
+
+    def test_walk_past_the_last_page(self):
+        pq = self.paged_query(cursor_walk=True)
+        self.assertEqual([], pq.fetch_page(9))
+        self.assertEqual(0, pq._num_offset_queries)
+        self.assertTrue(pq.has_page(5))
+        self.assertFalse(pq.has_page(7))
+        self.assertEqual(0, pq._num_count_calls)
+
+class ReadAheadTest(PagedQueryTest):
+
+    def test_next_page_is_served_from_the_lookahead(self):
+        self.assertEqual(range(0, 5),
+                         self.numbers(self.paged_query(read_ahead=True).fetch_page(1)))
+        pq = self.paged_query(read_ahead=True)
+        self.assertEqual(range(5, 10), self.numbers(pq.fetch_page(2)))
+        self.assertEqual(1, pq._num_lookahead_hits)
+        self.assertEqual(0, pq._num_cursor_queries + pq._num_offset_queries)
+        # The page after the lookahead is fetched with its cursor.
+        pq = self.paged_query(read_ahead=True)
+        self.assertEqual(range(10, 15), self.numbers(pq.fetch_page(3)))
+        self.assertEqual(1, pq._num_cursor_queries)
+
+    def test_lookahead_expires(self):
+        self.paged_query(read_ahead=True).fetch_page(1)
+        lookahead_time = paging.LOOKAHEAD_TIME
+        paging.LOOKAHEAD_TIME = -1
+        try:
+            self.paged_query(read_ahead=True).fetch_page(1)
+        finally:
+            paging.LOOKAHEAD_TIME = lookahead_time
+        pq = self.paged_query(read_ahead=True)
+        pq.fetch_page(2)
+        self.assertEqual(0, pq._num_lookahead_hits)
+
+    def test_has_page_needs_no_count(self):
+        pq = self.paged_query(read_ahead=True)
+        pq.fetch_page(1)
+        self.assertTrue(pq.has_page(2))
+        pq.fetch_page(5)
+        self.assertFalse(pq.has_page(6))
+        self.assertEqual(0, pq._num_count_calls)
+
+class CursorStoreTest(PagedQueryTest):
+
+    def tiered_store(self):
+        return paging.TieredCursorStore('test', paging.LocalCursorStore(),
+                                        paging.MemcacheCursorStore(),
+                                        paging.DatastoreCursorStore())
+
+    def test_cursors_of_another_generation_are_ignored(self):
+        pq = self.paged_query(generation=1)
+        for page in range(1, 5):
+            pq.fetch_page(page)
+        pq = self.paged_query(generation=1)
+        pq.fetch_page(4)
+        self.assertEqual(1, pq._num_restore)
+        self.assertEqual(1, pq._num_cursor_queries)
+        pq = self.paged_query(generation=2)
+        self.assertEqual(range(15, 20), self.numbers(pq.fetch_page(4)))
+        self.assertEqual(0, pq._num_restore)
+        self.assertEqual(1, pq._num_offset_queries)
+
+    def test_datastore_level_survives_memcache_eviction(self):
+        store = self.tiered_store()
+        pq = self.paged_query(cursor_store=store, generation=1)
+        for page in range(1, 5):
+            pq.fetch_page(page)
+        memcache.flush_all()
+        store = self.tiered_store()
+        pq = self.paged_query(cursor_store=store, generation=1)
+        self.assertEqual(range(15, 20), self.numbers(pq.fetch_page(4)))
+        self.assertEqual(1, pq._num_cursor_queries)
+        self.assertEqual(1, store.hits[2])
+        # The datastore hit was copied into the levels above it.
+        self.assertTrue(paging.MemcacheCursorStore().get(pq._get_memcache_key()))
+
+    def test_durable_generation_survives_memcache_eviction(self):
+        generation = caching.DurableGeneration('test_cursors')
+        pq = self.paged_query(cursor_store=self.tiered_store(),
+                              generation=generation.get())
+        for page in range(1, 5):
+            pq.fetch_page(page)
+        memcache.flush_all()
+        pq = self.paged_query(cursor_store=self.tiered_store(),
+                              generation=generation.get())
+        pq.fetch_page(4)
+        self.assertEqual(1, pq._num_restore)
+        generation.bump()
+        memcache.flush_all()
+        pq = self.paged_query(cursor_store=self.tiered_store(),
+                              generation=generation.get())
+        pq.fetch_page(4)
+        self.assertEqual(0, pq._num_restore)
+
+    def test_shallow_queries_are_not_stored_in_the_datastore(self):
+        pq = self.paged_query(cursor_store=self.tiered_store())
+        pq.fetch_page(1)
+        self.assertEqual(0, paging.PersistedCursors.all().count())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+import os
+import unittest
+
+from google.appengine.ext.webapp import template
+
+import benchmark
+import rendering
+
+class RenderingTest(unittest.TestCase):
+
+    def test_templates_render_like_webapp(self):
+        context = benchmark.template_context()
+        for name in sorted(os.listdir(rendering.TEMPLATE_DIR)):
+            if name.startswith('.'):
+                continue
+            self.assertEqual(template.render(rendering.path(name), context),
+                             rendering.render(name, context), name)
+
+    def test_renders_reuse_the_compiled_template(self):
+        compiled = rendering.get('public.html')
+        context = benchmark.template_context(2)
+        first = rendering.render('public.html', context)
+        self.assertTrue(rendering.get('public.html') is compiled)
+        self.assertEqual(first, rendering.render('public.html', context))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import random
+import unittest
+
+from google.appengine.ext import testbed
+
+import searchindex
+
+class ListHelperTest(unittest.TestCase):
+
+    def test_pack_ids_round_trip(self):
+        ids = [1, 2, 300, 2 ** 40, 2 ** 62]
+        self.assertEqual(ids, searchindex.unpack_ids(searchindex.pack_ids(ids)))
+        self.assertEqual([], searchindex.unpack_ids(searchindex.pack_ids([])))
+        self.assertEqual([], searchindex.unpack_ids(None))
+
+    def test_gallop(self):
+        ids = range(0, 100, 3)
+        for target in range(-1, 102):
+            for lo in (0, 5, 20, len(ids)):
+                expected = lo
+                while expected < len(ids) and ids[expected] < target:
+                    expected += 1
+                self.assertEqual(expected, searchindex.gallop(ids, target, lo))
+
+    def test_intersect_sorted(self):
+        rng = random.Random(1)
+        for i in range(50):
+            a = sorted(rng.sample(xrange(500), rng.randint(0, 50)))
+            b = sorted(rng.sample(xrange(500), rng.randint(0, 300)))
+            self.assertEqual(sorted(set(a) & set(b)),
+                             searchindex.intersect_sorted(a, b))
+
+class LookupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        # Small shards, so that the lists below are split into many.
+        self.shard_size = searchindex.SHARD_SIZE
+        searchindex.SHARD_SIZE = 8
+
+    def tearDown(self):
+        searchindex.SHARD_SIZE = self.shard_size
+        self.testbed.deactivate()
+
+    def index(self, documents):
+        for doc_id, bigrams in documents.items():
+            searchindex.queue_postings(doc_id, added=bigrams)
+        self.flush()
+
+    def flush(self):
+        while searchindex.flush_postings():
+            pass
+
+    def test_lookup_intersects_sharded_lists(self):
+        rng = random.Random(2)
+        documents = {}
+        for doc_id in rng.sample(xrange(1, 10000), 200):
+            documents[doc_id] = set([b for b in ('ab', 'bc', 'cd', 'de')
+                                     if rng.random() < 0.5])
+        self.index(documents)
+        head = searchindex.PostingList.get_by_key_name(
+            searchindex.PostingList.key_name('ab'))
+        self.assertTrue(len(head.shard_names) > 1)
+        for query in (['ab'], ['ab', 'bc'], ['ab', 'cd', 'de'], ['bc', 'cd', 'de', 'ab']):
+            expected = sorted([doc_id for doc_id, bigrams in documents.items()
+                               if bigrams.issuperset(query)])
+            self.assertEqual(expected, searchindex.lookup(query))
+
+    def test_lookup_missing_bigram(self):
+        self.index({1: set(['ab']), 2: set(['ab', 'bc'])})
+        self.assertEqual([], searchindex.lookup(['ab', 'zz']))
+        self.assertEqual([], searchindex.lookup([]))
+
+    def test_removed_postings(self):
+        self.index(dict([(doc_id, set(['ab', 'bc'])) for doc_id in range(1, 40)]))
+        for doc_id in range(1, 40, 2):
+            searchindex.queue_postings(doc_id, removed=['bc'])
+        self.flush()
+        self.assertEqual(range(2, 40, 2), searchindex.lookup(['ab', 'bc']))
+        self.assertEqual(range(1, 40), searchindex.lookup(['ab']))
+
+    def test_queued_changes_are_merged(self):
+        searchindex.queue_postings(1, added=['ab', 'bc'])
+        searchindex.queue_postings(1, added=['cd'], removed=['bc'])
+        searchindex.queue_postings(2, added=['ab'])
+        self.assertEqual([], searchindex.lookup(['ab']))
+        self.assertEqual(2, searchindex.flush_postings())
+        self.assertEqual([1, 2], searchindex.lookup(['ab']))
+        self.assertEqual([], searchindex.lookup(['bc']))
+        self.assertEqual([1], searchindex.lookup(['cd']))
+        self.assertEqual(0, searchindex.flush_postings())
+
+    def test_flush_keeps_changes_queued_again(self):
+        searchindex.queue_postings(1, added=['ab'])
+        update = searchindex.update_postings_multi
+        def queue_meanwhile(postings, deadline=None):
+            update(postings, deadline)
+            searchindex.queue_postings(1, removed=['ab'])
+        searchindex.update_postings_multi = queue_meanwhile
+        try:
+            searchindex.flush_postings()
+        finally:
+            searchindex.update_postings_multi = update
+        self.assertEqual([1], searchindex.lookup(['ab']))
+        self.flush()
+        self.assertEqual([], searchindex.lookup(['ab']))
+
+    def test_flush_stops_at_the_deadline(self):
+        self.index({1: set(['ab'])})
+        searchindex.queue_postings(2, added=['ab'])
+        self.assertEqual(None, searchindex.flush_postings(deadline=0))
+        self.assertEqual([1], searchindex.lookup(['ab']))
+        self.assertEqual(1, searchindex.flush_postings())
+        self.assertEqual([1, 2], searchindex.lookup(['ab']))
+
+    def test_rank_weighs_every_bigram_against_the_corpus(self):
+        self.index({1: set(['ab', 'cd']), 2: set(['ab']), 3: set(['ab'])})
+        ranked = searchindex.rank(['ab', 'cd'], 10, doc_count=10)
+        self.assertEqual([1, 3, 2], [doc_id for score, doc_id in ranked])
+        common = searchindex.idf(3, 10)
+        self.assertTrue(common > 0.5)
+        self.assertAlmostEqual(common + searchindex.idf(1, 10), ranked[0][0])
+        self.assertAlmostEqual(common, ranked[1][0])
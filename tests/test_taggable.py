@@ -0,0 +1,134 @@
+import unittest
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+import taggable
+
+class Note(db.Model, taggable.Taggable):
+    label = db.StringProperty()
+    def __init__(self, parent=None, key_name=None, app=None, **entity_values):
+        db.Model.__init__(self, parent, key_name, app, **entity_values)
+        taggable.Taggable.__init__(self)
+    def put(self):
+        key = db.Model.put(self)
+        self.update_tag_memberships()
+        return key
+    def tag_membership_fields(self):
+        return {'label': self.label}
+
+class TaggableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.calls = []
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'count_calls', self.count_call, 'datastore_v3')
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def count_call(self, service, call, request, response):
+        self.calls.append(call)
+
+    def memberships(self, note):
+        return taggable.TagMembership.all().ancestor(note).fetch(100)
+
+    def test_put_copies_changed_fields(self):
+        note = Note(label='old')
+        note.put()
+        note.tags = 'a,b'
+        note.label = 'new'
+        note.put()
+        self.assertEqual(['new', 'new'], [m.label for m in self.memberships(note)])
+        note = Note.get(note.key())
+        note.label = 'newer'
+        note.put()
+        self.assertEqual(['newer', 'newer'], [m.label for m in self.memberships(note)])
+
+    def test_new_untagged_objects_read_no_memberships(self):
+        del self.calls[:]
+        Note(label='x').put()
+        self.assertEqual(['Put'], self.calls)
+
+    def test_unchanged_put_leaves_memberships_alone(self):
+        note = Note(label='x')
+        note.put()
+        note.tags = 'a,b'
+        note.put()
+        del self.calls[:]
+        note.put()
+        self.assertEqual(['Put'], self.calls)
+
+    def test_legacy_tag_lists(self):
+        note = Note(label='x')
+        note.put()
+        tag = taggable.Tag(key_name='tag_old', tag='old', tagged=[note.key()])
+        tag.put()
+        self.assertEqual(['old'], [t.tag for t in taggable.Tag.get_tags_for_key(note.key())])
+        note.tags = 'new'
+        self.assertEqual(['new'], [t.tag for t in taggable.Tag.get_tags_for_key(note.key())])
+
+    def test_legacy_lists_are_not_migrated_inline(self):
+        note = Note(label='x')
+        note.put()
+        other = Note(label='y')
+        other.put()
+        tag = taggable.Tag(key_name='tag_old', tag='old',
+                           tagged=[note.key(), other.key()])
+        tag.put()
+        note.tags = 'new'
+        tag = taggable.Tag.get_by_name('old')
+        self.assertEqual([other.key()], tag.tagged)
+        self.assertEqual(0, taggable.TagMembership.all().filter('tag =', tag).count())
+        self.assertEqual([other.key()], tag.tagged_keys())
+
+    def test_memberships_are_only_a_collection_of_tags(self):
+        self.assertTrue(hasattr(taggable.Tag, 'memberships'))
+        self.assertFalse(hasattr(Note, 'memberships'))
+
+    def test_get_or_create_multi_keeps_existing_tags(self):
+        existing = taggable.Tag(key_name='tag_a', tag='a', tagged_count=3)
+        existing.put()
+        def stale_get(key_names):
+            # As if tag a was created by another request after this read.
+            del taggable.Tag.get_by_key_name
+            return [None] * len(key_names)
+        taggable.Tag.get_by_key_name = staticmethod(stale_get)
+        tags = taggable.Tag.get_or_create_multi(['a', 'b'])
+        self.assertEqual(['a', 'b'], [tag.tag for tag in tags])
+        self.assertEqual(3, taggable.Tag.get_by_name('a').tagged_count)
+        self.assertEqual(0, taggable.Tag.get_by_name('b').tagged_count)
+
+    def test_new_and_recounted_tags_are_written_through(self):
+        taggable.Tag.get_or_create('b')
+        self.assertEqual(['b'], [tag.tag for tag in taggable.Tag.tag_cloud()])
+        note = Note(label='x')
+        note.put()
+        note.tags = 'a,b'
+        del self.calls[:]
+        cloud = taggable.Tag.tag_cloud()
+        self.assertEqual([], self.calls)
+        self.assertEqual(['a', 'b'], [tag.tag for tag in cloud])
+        self.assertEqual([1, 1], [tag.tagged_count for tag in cloud])
+        self.assertEqual(['a', 'b'], sorted([tag.tag for tag in taggable.Tag.popular_tags()]))
+
+    def test_full_cloud_only_takes_tags_within_its_names(self):
+        cloud_size = taggable.TAG_CLOUD_SIZE
+        taggable.TAG_CLOUD_SIZE = 2
+        try:
+            for name in ('b', 'd'):
+                taggable.Tag.get_or_create(name)
+            taggable.Tag.expire_cached_tags()
+            self.assertEqual(['b', 'd'], [tag.tag for tag in taggable.Tag.tag_cloud()])
+            taggable.Tag.get_or_create('e')
+            taggable.Tag.get_or_create('a')
+            self.assertEqual(['a', 'b'], [tag.tag for tag in taggable.Tag.tag_cloud()])
+            self.assertEqual(['e', 'd'],
+                             [tag.tag for tag in taggable.Tag.get_tags_by_name(2, False)])
+        finally:
+            taggable.TAG_CLOUD_SIZE = cloud_size
@@ -0,0 +1,48 @@
+import random
+import unittest
+
+import benchmark
+import markdown_pool
+import xss
+
+class XssCleanerTest(unittest.TestCase):
+    "xss.strip must clean every document exactly like the cleaner it replaced."
+
+    def clean(self, strip, document):
+        "Returns what strip makes of document, or the type of its error."
+        try:
+            return strip(document)
+        except Exception, e:
+            return type(e)
+
+    def assertCleanedAsBefore(self, documents):
+        for document in documents:
+            self.assertEqual(self.clean(benchmark.LegacyXssCleaner().strip, document),
+                             self.clean(xss.strip, document))
+
+    def test_corpus(self):
+        md = markdown_pool.acquire(benchmark.ENTRY_EXTENSIONS)
+        try:
+            documents = [md.convert(source) for source in benchmark.SAMPLE_CORPUS]
+        finally:
+            markdown_pool.release(md)
+        documents.extend(benchmark.XSS_CORPUS)
+        documents.append(''.join(documents) * 10)
+        self.assertCleanedAsBefore(documents)
+
+    def test_spliced_documents(self):
+        # Pieces of the corpus cut at arbitrary points, so tags and
+        # entities are left unclosed or cut in half.
+        rng = random.Random(3)
+        corpus = ''.join(benchmark.XSS_CORPUS)
+        documents = []
+        for i in range(300):
+            pieces = []
+            for j in range(rng.randint(1, 6)):
+                start = rng.randint(0, len(corpus) - 1)
+                pieces.append(corpus[start:start + rng.randint(1, 80)])
+            documents.append(''.join(pieces))
+        self.assertCleanedAsBefore(documents)
+
+if __name__ == '__main__':
+    unittest.main()
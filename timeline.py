@@ -0,0 +1,158 @@
+'''
+This module contains the denormalized public timeline served on the front
+page.
+
+The timeline is a single entity holding the most recent public entries,
+newest first, with everything the entry list template needs embedded:
+the rendered html, the modification time and the author's username and
+name. Reading the front page is therefore one memcache get, or one
+datastore get by key when memcache has lost it, instead of a query plus a
+get per author.
+
+Handlers keep the timeline up to date as entries are posted, edited and
+deleted, and as authors change their profile.
+'''
+import pickle
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+MAX_ENTRIES = 30
+
+# Bytes of entry html a timeline holds at most, which keeps the pickled list
+# below the 1MB limit of both an entity and a memcache value. The html of
+# entries past the budget is left out and read from the entries themselves.
+MAX_HTML_BYTES = 800000
+
+# Seconds a timeline is kept in memcache. A reader may put back a list
+# that a concurrent writer has just replaced, so the cached list has to
+# expire on its own.
+CACHE_TIME = 60
+
+namespace = 'kl'
+
+class TimelineAuthor(object):
+    "The fields of a UserProfile used when listing entries."
+    def __init__(self, key, username, name):
+        self.key = key
+        self.username = username
+        self.name = name
+
+class TimelineEntry(object):
+    "The fields of an Entry used when listing entries."
+    def __init__(self, key, html, summary, modified_at, user_profile):
+        self.key = key
+        self.html = html
+        self.summary = summary
+        self.modified_at = modified_at
+        self.user_profile = user_profile
+
+    @classmethod
+    def from_entry(cls, entry):
+        profile = entry.user_profile
+        author = TimelineAuthor(profile.key(), profile.username, profile.name)
+        return TimelineEntry(entry.key(), unicode(entry.html or u''),
+                             entry.summary, entry.modified_at, author)
+
+class Timeline(db.Model):
+    "A list of TimelineEntry objects, newest first."
+
+    entries = db.BlobProperty()
+    "The pickled list of TimelineEntry objects."
+
+    def get_entries(self):
+        if not self.entries:
+            return []
+        return pickle.loads(self.entries)
+
+    def set_entries(self, entries):
+        budget = MAX_HTML_BYTES
+        kept = []
+        for entry in entries[:MAX_ENTRIES]:
+            if entry.html is not None:
+                size = len(entry.html.encode('utf-8'))
+                if size > budget:
+                    entry = TimelineEntry(entry.key, None, entry.summary,
+                                          entry.modified_at, entry.user_profile)
+                else:
+                    budget -= size
+            kept.append(entry)
+        self.entries = db.Blob(pickle.dumps(kept, 2))
+
+def _memcache_key(name):
+    return '%s_Timeline_%s' % (namespace, name)
+
+def get(name='public'):
+    '''Returns the list of TimelineEntry objects of the timeline, or None if
+    the timeline has not been built yet.'''
+    entries = memcache.get(_memcache_key(name))
+    if entries is None:
+        timeline = Timeline.get_by_key_name(name)
+        if timeline is None:
+            return None
+        entries = timeline.get_entries()
+        memcache.add(_memcache_key(name), entries, CACHE_TIME)
+    return entries
+
+def fill_html(entries):
+    '''Reads the html that the timeline left out of entries from the
+    entries themselves. Returns the entries that still exist.'''
+    missing = [e for e in entries if e.html is None]
+    if missing:
+        for e, entity in zip(missing, db.get([e.key for e in missing])):
+            if entity is not None:
+                e.html = unicode(entity.html or u'')
+    return [e for e in entries if e.html is not None]
+
+def _update(name, update):
+    '''Applies update to the list of entries of the timeline in a
+    transaction and returns the number of entries left.'''
+    def update_txn():
+        timeline = Timeline.get_by_key_name(name)
+        if timeline is None:
+            timeline = Timeline(key_name=name)
+        entries = update(timeline.get_entries())
+        timeline.set_entries(entries)
+        timeline.put()
+        return len(entries)
+    count = db.run_in_transaction(update_txn)
+    memcache.delete(_memcache_key(name))
+    return count
+
+def put_entry(entry, name='public'):
+    '''Adds entry to the timeline, or moves it to its new position if it is
+    already there. Private entries are removed instead.'''
+    if entry.is_private:
+        return remove_entry(entry.key(), name)
+    new_entry = TimelineEntry.from_entry(entry)
+    def update(entries):
+        entries = [e for e in entries if e.key != new_entry.key]
+        entries.append(new_entry)
+        entries.sort(key=lambda e: e.modified_at, reverse=True)
+        return entries
+    return _update(name, update)
+
+def remove_entry(key, name='public'):
+    '''Removes the entry with the given key from the timeline. Returns None
+    without writing if the timeline does not hold the entry.'''
+    entries = get(name)
+    if entries is None or key not in [e.key for e in entries]:
+        return None
+    def update(entries):
+        return [e for e in entries if e.key != key]
+    return _update(name, update)
+
+def update_author(profile, name='public'):
+    '''Refreshes the embedded fields of profile in every entry it wrote.'''
+    def update(entries):
+        for e in entries:
+            if e.user_profile.key == profile.key():
+                e.user_profile = TimelineAuthor(profile.key(), profile.username,
+                                                profile.name)
+        return entries
+    return _update(name, update)
+
+def rebuild(entries, name='public'):
+    '''Replaces the contents of the timeline with entries, newest first.'''
+    timeline_entries = [TimelineEntry.from_entry(e) for e in entries]
+    return _update(name, lambda old: timeline_entries)
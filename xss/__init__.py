@@ -1,3 +1,4 @@
+import re
 from htmllib import HTMLParser
 from cgi import escape
 from urlparse import urlparse
@@ -5,116 +6,151 @@ from formatter import AbstractFormatter
 from htmlentitydefs import entitydefs
 from xml.sax.saxutils import quoteattr
 
+# A list of the only tags allowed.  Be careful adding to this.  Adding
+# "script," for example, would not be smart.  'img' is out by default
+# because of the danger of IMG embedded commands, and/or web bugs.
+PERMITTED_TAGS = frozenset(['a', 'b', 'blockquote', 'br', 'i',
+                            'li', 'ol', 'ul', 'p', 'cite', 'h1', 'h2',
+                            'h3', 'h4', 'h5', 'h6', 'img', 'strong',
+                            'div', 'span', 'pre', 'code', 'em', 'table', 'thead', 'tbody', 'tr', 'th', 'td'])
+
+# A list of tags that require no closing tag.
+REQUIRES_NO_CLOSE = frozenset(['img', 'br'])
+
+# A dictionary showing the only attributes allowed for particular tags.
+# If a tag is not listed here, it is allowed no attributes.  Adding
+# "on" tags, like "onhover," would not be smart.  Also be very careful
+# of "background" and "style."  The attributes are written in this order.
+ALLOWED_ATTRIBUTES = \
+    {'a': ('href', 'title'),
+     'img': ('src', 'alt'),
+     'blockquote': ('type',),
+     'span': ('class',),
+     'th': ('align',),
+     'td': ('align',),
+     'div': ('class',)}
+
+# Attributes holding a URL, which has to pass url_is_acceptable().
+URL_ATTRIBUTES = frozenset(['href', 'src', 'background'])
+
+# The only schemes allowed in URLs (for href and src attributes).
+# Adding "javascript" or "vbscript" to this list would not be smart.
+ALLOWED_SCHEMES = frozenset(['http', 'https', 'ftp'])
+
+# URLs that urlparse() would split into an allowed scheme and a host name
+# with a dot in it. Host names with characters this does not list are left
+# to urlparse().
+_ACCEPTABLE_ABSOLUTE_URL = re.compile(
+    r'(?:%s)://[\w.:@%%~+-]*\.[\w.:@%%~+-]*(?:[/?#]|\Z)' %
+    '|'.join(sorted(ALLOWED_SCHEMES)), re.IGNORECASE)
+
 def xssescape(text):
     """Gets rid of < and > and & and, for good measure, :"""
     return escape(text, quote=True).replace(':','&#58;')
 
 class XssCleaner(HTMLParser):
+    permitted_tags = PERMITTED_TAGS
+    requires_no_close = REQUIRES_NO_CLOSE
+    allowed_attributes = ALLOWED_ATTRIBUTES
+    allowed_schemes = ALLOWED_SCHEMES
+
     def __init__(self, fmt = AbstractFormatter):
         HTMLParser.__init__(self, fmt)
-        self.result = ""
+        self.result = []
+        # The open permitted tags, innermost last.
         self.open_tags = []
-        # A list of the only tags allowed.  Be careful adding to this.  Adding
-        # "script," for example, would not be smart.  'img' is out by default 
-        # because of the danger of IMG embedded commands, and/or web bugs.
-        self.permitted_tags = ['a', 'b', 'blockquote', 'br', 'i', 
-                          'li', 'ol', 'ul', 'p', 'cite', 'h1', 'h2', 
-                          'h3', 'h4', 'h5', 'h6', 'img', 'strong', 
-                          'div', 'span', 'pre', 'code', 'em', 'table', 'thead', 'tbody', 'tr', 'th', 'td']
-
-        # A list of tags that require no closing tag.
-        self.requires_no_close = ['img', 'br']
-
-        # A dictionary showing the only attributes allowed for particular tags.
-        # If a tag is not listed here, it is allowed no attributes.  Adding
-        # "on" tags, like "onhover," would not be smart.  Also be very careful
-        # of "background" and "style."
-        self.allowed_attributes = \
-            {'a':['href','title'],
-             'img':['src','alt'],
-             'blockquote':['type'],
-             'span': ['class'],
-             'th': ['align'],
-             'td': ['align'],
-             'div': ['class']}
-
-        # The only schemes allowed in URLs (for href and src attributes).
-        # Adding "javascript" or "vbscript" to this list would not be smart.
-        self.allowed_schemes = ['http','https','ftp']
     def handle_data(self, data):
         if data:
-            self.result += xssescape(data)
+            self.result.append(xssescape(data))
     def handle_charref(self, ref):
         if len(ref) < 7 and ref.isdigit():
-            self.result += '&#%s;' % ref
+            self.result.append('&#%s;' % ref)
         else:
-            self.result += xssescape('&#%s' % ref)
+            self.result.append(xssescape('&#%s' % ref))
     def handle_entityref(self, ref):
         if ref in entitydefs:
-            self.result += '&%s;' % ref
+            self.result.append('&%s;' % ref)
         else:
-            self.result += xssescape('&%s' % ref)
+            self.result.append(xssescape('&%s' % ref))
     def handle_comment(self, comment):
         if comment:
-            self.result += xssescape("<!--%s-->" % comment)
+            self.result.append(xssescape("<!--%s-->" % comment))
 
     def handle_starttag(self, tag, method, attrs):
         if tag not in self.permitted_tags:
-            self.result += xssescape("<%s>" %  tag)
+            self.result.append(xssescape("<%s>" % tag))
+            return
+        result = self.result
+        result.append("<" + tag)
+        allowed = self.allowed_attributes.get(tag)
+        if allowed and attrs:
+            attrs = dict(attrs)
+            for attribute in allowed:
+                value = attrs.get(attribute)
+                if not value:
+                    continue
+                if attribute in URL_ATTRIBUTES:
+                    if self.url_is_acceptable(value):
+                        result.append(' %s="%s"' % (attribute, value))
+                else:
+                    result.append(' %s=%s' % (xssescape(attribute), quoteattr(value)))
+        if tag in self.requires_no_close:
+            result.append("/>")
         else:
-            bt = "<" + tag
-            if tag in self.allowed_attributes:
-                attrs = dict(attrs)
-                self.allowed_attributes_here = \
-                  [x for x in self.allowed_attributes[tag] if x in attrs \
-                   and len(attrs[x]) > 0]
-                for attribute in self.allowed_attributes_here:
-                    if attribute in ['href', 'src', 'background']:
-                        if self.url_is_acceptable(attrs[attribute]):
-                            bt += ' %s="%s"' % (attribute, attrs[attribute])
-                    else:
-                        bt += ' %s=%s' % \
-                           (xssescape(attribute), quoteattr(attrs[attribute]))
-            #if bt == "<a" or bt == "<img":
-            #    return
-            if tag in self.requires_no_close:
-                bt += "/"
-            bt += ">"                     
-            self.result += bt
-            self.open_tags.insert(0, tag)
-            
+            result.append(">")
+        self.open_tags.append(tag)
+
     def handle_endtag(self, tag, attrs):
-        bracketed = "</%s>" % tag
         if tag not in self.permitted_tags:
-            self.result += xssescape(bracketed)
-        elif tag in self.open_tags:
-            self.result += bracketed
-            self.open_tags.remove(tag)
-            
+            self.result.append(xssescape("</%s>" % tag))
+            return
+        open_tags = self.open_tags
+        for i in xrange(len(open_tags) - 1, -1, -1):
+            if open_tags[i] == tag:
+                del open_tags[i]
+                self.result.append("</%s>" % tag)
+                return
+
     def unknown_starttag(self, tag, attributes):
         self.handle_starttag(tag, None, attributes)
     def unknown_endtag(self, tag):
         self.handle_endtag(tag, None)
     def url_is_acceptable(self,url):
         ### Requires all URLs to be "absolute."
+        if url[:1] == '/' and url[:2] != '//':
+            return True
+        if self.allowed_schemes is ALLOWED_SCHEMES and _ACCEPTABLE_ABSOLUTE_URL.match(url):
+            return True
         parsed = urlparse(url)
         return (parsed[0] in self.allowed_schemes and '.' in parsed[1]) or (parsed[0] == '' and parsed[2][0] == '/')
     def strip(self, rawstring):
         """Returns the argument stripped of potentially harmful HTML or Javascript code"""
-        self.result = ""
+        self.reset()
+        self.result = result = []
+        self.open_tags = []
         self.feed(rawstring)
-        for endtag in self.open_tags:
+        for endtag in reversed(self.open_tags):
             if endtag not in self.requires_no_close:
-                self.result += "</%s>" % endtag
+                result.append("</%s>" % endtag)
+        self.result = ''.join(result)
         return self.result
     def xtags(self):
         """Returns a printable string informing the user which tags are allowed"""
-        self.permitted_tags.sort()
-        tg = ""
-        for x in self.permitted_tags:
-            tg += "<" + x
+        tg = []
+        for x in sorted(self.permitted_tags):
+            tg.append("<" + x)
             if x in self.allowed_attributes:
                 for y in self.allowed_attributes[x]:
-                    tg += ' %s=""' % y
-            tg += "> "
-        return xssescape(tg.strip())
\ No newline at end of file
+                    tg.append(' %s=""' % y)
+            tg.append("> ")
+        return xssescape(''.join(tg).strip())
+
+_cleaner = None
+
+def strip(rawstring):
+    """Returns the argument stripped of potentially harmful HTML or Javascript
+    code, using one XssCleaner for the whole process."""
+    global _cleaner
+    if _cleaner is None:
+        _cleaner = XssCleaner()
+    return _cleaner.strip(rawstring)